@@ -20,20 +20,30 @@ import base64
 import json
 import copy
 import math
+import queue
+import traceback
+import functools
+import concurrent.futures
+import psutil
 from PIL import Image
 from io import BytesIO
 import scripts.utils as utils
 import scripts.metadata as metadata
 import scripts.civitai as civitai
+import scripts.postprocess as postprocess
+import scripts.payload as payloads
+import scripts.imagecache as imagecache
+import scripts.aiotransport as aiotransport
+import scripts.catalog as catalog
+import scripts.gpus as gpus
 from os.path import exists
 from datetime import datetime as dt
 from datetime import date
 from pathlib import Path
 from collections import deque
 from PIL.PngImagePlugin import PngImageFile, PngInfo
-from torch.cuda import get_device_name, device_count
 from scripts.server import ArtServer
-from scripts.sdi import SDI
+from scripts.sdi import SDI, SDIError, SDIHung, generation_work, auto_boot_limit
 
 # environment setup
 cwd = os.getcwd()
@@ -52,12 +62,16 @@ for path in env_paths:
 print_lock = threading.Lock()
 
 
-# worker thread executes specified shell command
+# long-lived worker thread; one per GPU, executes jobs placed in its inbox
 class Worker(threading.Thread):
-    def __init__(self, command, callback=lambda: None, *args):
+    def __init__(self, callback=lambda: None, *args):
         threading.Thread.__init__(self)
-        self.command = command
+        self.command = None
         self.callback = callback
+        self.inbox = queue.Queue()
+        self.jobs_staged = 0
+        self.requeue = False        # put the current job back on the queue when it's done (see WATCHDOG_TIMEOUT)
+        self.job_finished = False   # has the controller been told the current job is done?
 
         # grab the worker info from the args
         self.worker = args[0]
@@ -68,106 +82,188 @@ class Worker(threading.Thread):
             self.output_buffer = args[1]
 
 
+    # pull jobs from the inbox until told to stop
     def run(self):
-        command = ''
+        while True:
+            job = self.inbox.get()
+            if job == None:
+                break
+            self.job_success = True
+            self.requeue = False
+            self.job_finished = False
+            try:
+                if not self.worker['sdi_instance'].wait_until_ready():
+                    # SD is out of service (or we're shutting down); let another GPU have the job
+                    self.requeue = True
+                    self.finish_job()
+                    continue
+                # job returns the prepared job, waiting on the prep pool if it's being prefetched
+                self.execute_job(job())
+            except Exception:
+                # don't let one bad job take down this GPU's thread
+                self.print("*** ERROR: unhandled exception while processing job:\n" + traceback.format_exc())
+                self.finish_job()
+
+
+    # tells the controller this worker is done with its current job; only the first call per job
+    # counts, so an error after a job has already been reported doesn't release the worker twice
+    def finish_job(self):
+        if not self.job_finished:
+            self.job_finished = True
+            self.callback(self.worker)
+
+
+    # waits for an SD request (Future) to finish and returns its result, or None if it failed;
+    # a failed required request (txt2img/img2img) marks the whole job as failed
+    def wait_for(self, request, required = True):
+        try:
+            return request.result()
+        except SDIHung:
+            # the watchdog restarted SD; the job will be run again
+            self.job_success = False
+            self.requeue = True
+            return None
+        except SDIError:
+            if required:
+                self.job_success = False
+            return None
+
+
+    # adds the images from a finished SD request (if it succeeded) to a job's samples
+    def add_samples(self, samples, result):
+        if result != None:
+            for image in result.images:
+                samples[image.name] = image
+
+
+    # queue a job for this worker; with prefetching enabled, start preparing it right away
+    def submit(self, command):
+        if control.config.get('prefetch_jobs') > 0:
+            self.inbox.put(control.prep_pool.submit(self.prepare_job, command).result)
+        else:
+            self.inbox.put(functools.partial(self.prepare_job, command))
+
+
+    # drop queued jobs that haven't started yet; returns how many were dropped
+    def clear_pending(self):
+        dropped = 0
+        while True:
+            try:
+                self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            dropped += 1
+        return dropped
+
+
+    # finish the current job (if any) and exit
+    def stop(self):
+        self.inbox.put(None)
+
+
+    # CPU/disk side of a job: settles random values, expands wildcards, inserts triggers, reads and
+    # encodes input images, etc. - everything up to the ready-to-POST payload; with prefetching enabled
+    # this runs on the controller's prep pool while this worker's GPU is still busy with earlier jobs
+    def prepare_job(self, job):
+        # work on a copy; the queued job is left as it was so that it can be run again from scratch
+        # if it's returned to the queue (see WATCHDOG_TIMEOUT)
+        job = job.copy()
         original_filename = ''
         original_exif = {}
         original_iptc = {}
         original_command = {}
         process_mode = False
+        use_controlnet = False
+        payload = {}
+        model = ''
 
-        if not int(self.command.get('seed')) > 0:
-            self.command['seed'] = -1
+        if not int(job.get('seed')) > 0:
+            job['seed'] = -1
         else:
             # increment seed if we've finished one or more complete loops
-            if control.models != []:
-                # multiple models in queue, only increment for each time we use all of them
-                complete = math.floor(control.loops / len(control.models))
-                seed = int(self.command.get('seed')) + complete
-                self.command['seed'] = seed
-            else:
-                seed = int(self.command.get('seed')) + control.loops
-                self.command['seed'] = seed
+            # (with multiple models in queue, only increment for each time we use all of them)
+            seed = int(job.get('seed')) + control.completed_model_cycles()
+            job['seed'] = seed
 
         # check for ADetailer params
         use_adetailer = False
-        if control.sdi_adetailer_available and self.command.get('adetailer_use') and self.command.get('adetailer_model') != '':
+        if control.sdi_adetailer_available and job.get('adetailer_use') and job.get('adetailer_model') != '':
             use_adetailer = True
-            if '<prompt>' in self.command.get('adetailer_prompt'):
-                self.command['adetailer_prompt'] = self.command.get('adetailer_prompt').replace('<prompt>', self.command.get('prompt'))
+            if '<prompt>' in job.get('adetailer_prompt'):
+                job['adetailer_prompt'] = job.get('adetailer_prompt').replace('<prompt>', job.get('prompt'))
 
         # if this is a process-mode prompt, skip past image generation stuff
-        if self.command.get('mode') != 'process':
+        if job.get('mode') != 'process':
 
             # handle IPTC metadata history stuff
-            if self.command['iptc_title_history']:
-                for key in self.command['iptc_title_history']:
-                    self.command['iptc_title'] += self.command['iptc_title_history'][key][-1]
+            if job['iptc_title_history']:
+                for key in job['iptc_title_history']:
+                    job['iptc_title'] += job['iptc_title_history'][key][-1]
 
-            if self.command['iptc_description_history']:
-                for key in self.command['iptc_description_history']:
-                    self.command['iptc_description'] += self.command['iptc_description_history'][key][-1]
+            if job['iptc_description_history']:
+                for key in job['iptc_description_history']:
+                    job['iptc_description'] += job['iptc_description_history'][key][-1]
 
-            if self.command['iptc_keywords_history']:
-                for key in self.command['iptc_keywords_history']:
-                    for k in self.command['iptc_keywords_history'][key][-1]:
-                        if k not in self.command['iptc_keywords']:
-                            self.command['iptc_keywords'].append(k)
+            if job['iptc_keywords_history']:
+                for key in job['iptc_keywords_history']:
+                    for k in job['iptc_keywords_history'][key][-1]:
+                        if k not in job['iptc_keywords']:
+                            job['iptc_keywords'].append(k)
 
             # if this is a random prompt, settle on random values
-            if self.command.get('mode') == 'random':
-                if float(self.command.get('min_scale')) > 0 and float(self.command.get('max_scale')) > 0:
-                    self.command['scale'] = round(random.uniform(float(self.command.get('min_scale')), float(self.command.get('max_scale'))), 1)
-                if float(self.command.get('min_strength')) > 0 and float(self.command.get('max_strength')) > 0:
-                    self.command['strength'] = round(random.uniform(float(self.command.get('min_strength')), float(self.command.get('max_strength'))), 2)
-                if self.command.get('random_input_image_dir') != "":
-                    self.command['input_image'] = utils.InputManager(self.command.get('random_input_image_dir')).pick_random()
+            if job.get('mode') == 'random':
+                if float(job.get('min_scale')) > 0 and float(job.get('max_scale')) > 0:
+                    job['scale'] = round(random.uniform(float(job.get('min_scale')), float(job.get('max_scale'))), 1)
+                if float(job.get('min_strength')) > 0 and float(job.get('max_strength')) > 0:
+                    job['strength'] = round(random.uniform(float(job.get('min_strength')), float(job.get('max_strength'))), 2)
+                if job.get('random_input_image_dir') != "":
+                    job['input_image'] = utils.InputManager(job.get('random_input_image_dir')).pick_random()
 
             # settle on random values for ranges specified in scale directive
-            if '-' in str(self.command['scale']):
+            if '-' in str(job['scale']):
                 try:
-                    values = str(self.command['scale']).split('-', 1)
+                    values = str(job['scale']).split('-', 1)
                     first = float(values[0].strip())
                     second = float(values[1].strip())
                     if second >= first:
-                        self.command['scale'] = round(random.uniform(first, second), 1)
+                        job['scale'] = round(random.uniform(first, second), 1)
                     else:
-                        self.command['scale'] = round(random.uniform(second, first), 1)
+                        job['scale'] = round(random.uniform(second, first), 1)
                 except:
                     pass
 
             # settle on random values for ranges specified in strength directive
-            if '-' in str(self.command['strength']):
+            if '-' in str(job['strength']):
                 try:
-                        values = str(self.command['strength']).split('-', 1)
+                        values = str(job['strength']).split('-', 1)
                         first = float(values[0].strip())
                         second = float(values[1].strip())
                         if second >= first:
-                            self.command['strength'] = round(random.uniform(first, second), 2)
+                            job['strength'] = round(random.uniform(first, second), 2)
                         else:
-                            self.command['strength'] = round(random.uniform(second, first), 2)
+                            job['strength'] = round(random.uniform(second, first), 2)
                 except:
                     pass
 
             # settle on random values for ranges specified in steps directive
-            if '-' in str(self.command['steps']):
+            if '-' in str(job['steps']):
                 try:
-                        values = str(self.command['steps']).split('-', 1)
+                        values = str(job['steps']).split('-', 1)
                         first = int(values[0].strip())
                         second = int(values[1].strip())
                         if second >= first:
-                            self.command['steps'] = random.randint(first, second)
+                            job['steps'] = random.randint(first, second)
                         else:
-                            self.command['steps'] = random.randint(second, first)
+                            job['steps'] = random.randint(second, first)
                 except:
                     pass
 
             # settle of random styles if necessary
-            if len(self.command['styles']) > 0:
-                if self.command['styles'][0].startswith('random'):
+            if len(job['styles']) > 0:
+                if job['styles'][0].startswith('random'):
                     num = 1
                     styles = []
-                    temp = self.command['styles'][0].split(' ')
+                    temp = job['styles'][0].split(' ')
                     if len(temp) > 1:
                         num = int(temp[1])
                     # pick random styles
@@ -184,82 +280,75 @@ class Worker(threading.Thread):
                             for s in control.sdi_styles:
                                 styles.append(s)
                     # update command with random styles
-                    self.command['styles'] = styles
-
-            # check if a model change is needed
-            if self.command.get('ckpt_file') != '' and (self.command.get('ckpt_file') != self.worker['sdi_instance'].model_loaded):
-                self.worker['sdi_instance'].load_model(self.command.get('ckpt_file'))
-                while self.worker['sdi_instance'].options_change_in_progress:
-                    # wait for model change to complete
-                    time.sleep(0.25)
-            elif self.command.get('ckpt_file') == '':
+                    job['styles'] = styles
+
+            # note the model this job needs; it's loaded when the job actually runs
+            if job.get('ckpt_file') != '':
+                model = job.get('ckpt_file')
+            elif control.config.get('ckpt_file') != '' and control.default_model_validated:
                 # revert to default config.txt model if necessary
-                if control.config.get('ckpt_file') != '' and control.default_model_validated and (control.config.get('ckpt_file') != self.worker['sdi_instance'].model_loaded):
-                    self.worker['sdi_instance'].load_model(control.config.get('ckpt_file'))
-                    while self.worker['sdi_instance'].options_change_in_progress:
-                        # wait for model change to complete
-                        time.sleep(0.25)
-
-            if self.command.get('prompt').strip() == '.':
-                self.command['prompt'] = ''
+                model = control.config.get('ckpt_file')
+
+            if job.get('prompt').strip() == '.':
+                job['prompt'] = ''
             else:
                 # clean up potentially dangerous prompt content:
-                while '--' in self.command.get('prompt'):
-                     self.command['prompt'] = self.command.get('prompt').replace('--', '-')
+                while '--' in job.get('prompt'):
+                     job['prompt'] = job.get('prompt').replace('--', '-')
 
             # check for auto-insertion of model trigger word
-            if (control.model_trigger_words != None) and (self.command.get('auto_insert_model_trigger') != 'off'):
+            if (control.model_trigger_words != None) and (job.get('auto_insert_model_trigger') != 'off'):
                 # check to see if the model we're using has an associated trigger
-                if control.model_trigger_words.get(self.command.get('ckpt_file')) != None:
-                    trigger = control.model_trigger_words.get(self.command.get('ckpt_file'))
-                    p = self.command.get('prompt')
+                if control.model_trigger_words.get(job.get('ckpt_file')) != None:
+                    trigger = control.model_trigger_words.get(job.get('ckpt_file'))
+                    p = job.get('prompt')
                     if trigger not in p:
                         # trigger word isn't in prompt, we need to add it
-                        if self.command.get('auto_insert_model_trigger') == 'first_comma':
+                        if job.get('auto_insert_model_trigger') == 'first_comma':
                             if ',' in p:
-                                self.command['prompt'] = p.split(',', 1)[0] + ', ' + trigger + ',' + p.split(',', 1)[1]
+                                job['prompt'] = p.split(',', 1)[0] + ', ' + trigger + ',' + p.split(',', 1)[1]
                             else:
-                                self.command['prompt'] = p + ', ' + trigger
-                        elif self.command.get('auto_insert_model_trigger') == 'end':
-                            self.command['prompt'] = p + ', ' + trigger
-                        elif self.command.get('auto_insert_model_trigger') == 'start':
-                            self.command['prompt'] = trigger + ', ' + p
-                        elif 'keyword:' in self.command.get('auto_insert_model_trigger'):
-                            keyword = self.command.get('auto_insert_model_trigger')
+                                job['prompt'] = p + ', ' + trigger
+                        elif job.get('auto_insert_model_trigger') == 'end':
+                            job['prompt'] = p + ', ' + trigger
+                        elif job.get('auto_insert_model_trigger') == 'start':
+                            job['prompt'] = trigger + ', ' + p
+                        elif 'keyword:' in job.get('auto_insert_model_trigger'):
+                            keyword = job.get('auto_insert_model_trigger')
                             keyword = keyword.split('keyword:', 1)[1].strip()
                             if keyword in p:
                                 # the keyword we need to replace with the trigger is in the prompt, replace it
-                                self.command['prompt'] = p.replace(keyword, trigger)
+                                job['prompt'] = p.replace(keyword, trigger)
 
                 # check to see if the hi-res model we're using has an associated trigger if necessary
                 # BK 2023-10-29
-                if self.command.get('highres_ckpt_file') != '':
-                    if control.model_trigger_words.get(self.command.get('highres_ckpt_file')) != None:
-                        trigger = control.model_trigger_words.get(self.command.get('highres_ckpt_file'))
-                        p = self.command.get('highres_prompt')
+                if job.get('highres_ckpt_file') != '':
+                    if control.model_trigger_words.get(job.get('highres_ckpt_file')) != None:
+                        trigger = control.model_trigger_words.get(job.get('highres_ckpt_file'))
+                        p = job.get('highres_prompt')
                         if p.strip() == '':
-                            p = self.command.get('prompt')
+                            p = job.get('prompt')
                         if trigger not in p:
                             # trigger word isn't in highres prompt, we need to add it
-                            if self.command.get('auto_insert_model_trigger') == 'first_comma':
+                            if job.get('auto_insert_model_trigger') == 'first_comma':
                                 if ',' in p:
-                                    self.command['highres_prompt'] = p.split(',', 1)[0] + ', ' + trigger + ',' + p.split(',', 1)[1]
+                                    job['highres_prompt'] = p.split(',', 1)[0] + ', ' + trigger + ',' + p.split(',', 1)[1]
                                 else:
-                                    self.command['highres_prompt'] = p + ', ' + trigger
-                            elif self.command.get('auto_insert_model_trigger') == 'end':
-                                self.command['highres_prompt'] = p + ', ' + trigger
-                            elif self.command.get('auto_insert_model_trigger') == 'start':
-                                self.command['highres_prompt'] = trigger + ', ' + p
-                            elif 'keyword:' in self.command.get('auto_insert_model_trigger'):
-                                keyword = self.command.get('auto_insert_model_trigger')
+                                    job['highres_prompt'] = p + ', ' + trigger
+                            elif job.get('auto_insert_model_trigger') == 'end':
+                                job['highres_prompt'] = p + ', ' + trigger
+                            elif job.get('auto_insert_model_trigger') == 'start':
+                                job['highres_prompt'] = trigger + ', ' + p
+                            elif 'keyword:' in job.get('auto_insert_model_trigger'):
+                                keyword = job.get('auto_insert_model_trigger')
                                 keyword = keyword.split('keyword:', 1)[1].strip()
                                 if keyword in p:
                                     # the keyword we need to replace with the trigger is in the prompt, replace it
-                                    self.command['highres_prompt'] = p.replace(keyword, trigger)
+                                    job['highres_prompt'] = p.replace(keyword, trigger)
 
             # check for wildcard replacements
-            p = self.command.get('prompt')
-            #print('before wildcard replace: ' + self.command['prompt'])
+            p = job.get('prompt')
+            #print('before wildcard replace: ' + job['prompt'])
             for k, v in control.wildcards.items():
                 key = '__' + k.lower() + '__'
                 if key in p.lower():
@@ -294,98 +383,96 @@ class Worker(threading.Thread):
                         # make the replacement(s)
                         p = utils.wildcard_replace(p, key, replace, replace_all)
                         # check IPTC metadata and make the same replacement if necessary
-                        self.command['iptc_title'] = utils.wildcard_replace(self.command.get('iptc_title'), key, replace, replace_all)
-                        self.command['iptc_description'] = utils.wildcard_replace(self.command.get('iptc_description'), key, replace, replace_all)
-                        self.command['iptc_keywords'] = utils.wildcard_replace_list(self.command.get('iptc_keywords'), key, replace, replace_all)
-                        self.command['iptc_copyright'] = utils.wildcard_replace(self.command.get('iptc_copyright'), key, replace, replace_all)
+                        job['iptc_title'] = utils.wildcard_replace(job.get('iptc_title'), key, replace, replace_all)
+                        job['iptc_description'] = utils.wildcard_replace(job.get('iptc_description'), key, replace, replace_all)
+                        job['iptc_keywords'] = utils.wildcard_replace_list(job.get('iptc_keywords'), key, replace, replace_all)
+                        job['iptc_copyright'] = utils.wildcard_replace(job.get('iptc_copyright'), key, replace, replace_all)
 
             # handle special hard-coded prompt directive wildcards
             if '__!iptc_title__' in p.lower():
-                p = utils.wildcard_replace(p, '__!iptc_title__', self.command.get('iptc_title'), True)
+                p = utils.wildcard_replace(p, '__!iptc_title__', job.get('iptc_title'), True)
             if '__!iptc_description__' in p.lower():
-                p = utils.wildcard_replace(p, '__!iptc_description__', self.command.get('iptc_description'), True)
+                p = utils.wildcard_replace(p, '__!iptc_description__', job.get('iptc_description'), True)
             if '__!iptc_keywords__' in p.lower():
-                p = utils.wildcard_replace_list(p, '__!iptc_keywords__', self.command.get('iptc_keywords'), True)
+                p = utils.wildcard_replace_list(p, '__!iptc_keywords__', job.get('iptc_keywords'), True)
 
-            self.command['prompt'] = p
-            #print('after wildcard replace: ' + self.command['prompt'])
+            job['prompt'] = p
+            #print('after wildcard replace: ' + job['prompt'])
 
             # check for auto-dimensions
-            orig_size = [self.command.get('width'), self.command.get('height')]
-            if self.command.get('auto_size') == 'match_controlnet_image_size':
-                if self.command.get('controlnet_input_image') != '':
-                    new_size = utils.get_image_size(self.command.get('controlnet_input_image'))
+            orig_size = [job.get('width'), job.get('height')]
+            if job.get('auto_size') == 'match_controlnet_image_size':
+                if job.get('controlnet_input_image') != '':
+                    new_size = utils.get_image_size(job.get('controlnet_input_image'))
                     if new_size != []:
-                        self.command['width'] = new_size[0]
-                        self.command['height'] = new_size[1]
+                        job['width'] = new_size[0]
+                        job['height'] = new_size[1]
 
-            elif self.command.get('auto_size') == 'match_input_image_size':
-                if self.command.get('input_image') != '':
-                    new_size = utils.get_image_size(self.command.get('input_image'))
+            elif job.get('auto_size') == 'match_input_image_size':
+                if job.get('input_image') != '':
+                    new_size = utils.get_image_size(job.get('input_image'))
                     if new_size != []:
-                        self.command['width'] = new_size[0]
-                        self.command['height'] = new_size[1]
+                        job['width'] = new_size[0]
+                        job['height'] = new_size[1]
 
-            elif self.command.get('auto_size') == 'match_controlnet_image_aspect_ratio':
-                if self.command.get('controlnet_input_image') != '':
-                    new_size = utils.match_image_aspect_ratio(self.command.get('controlnet_input_image'), orig_size)
+            elif job.get('auto_size') == 'match_controlnet_image_aspect_ratio':
+                if job.get('controlnet_input_image') != '':
+                    new_size = utils.match_image_aspect_ratio(job.get('controlnet_input_image'), orig_size)
                     if new_size != []:
-                        self.command['width'] = new_size[0]
-                        self.command['height'] = new_size[1]
+                        job['width'] = new_size[0]
+                        job['height'] = new_size[1]
 
-            elif self.command.get('auto_size') == 'match_input_image_aspect_ratio':
-                if self.command.get('input_image') != '':
-                    new_size = utils.match_image_aspect_ratio(self.command.get('input_image'), orig_size)
+            elif job.get('auto_size') == 'match_input_image_aspect_ratio':
+                if job.get('input_image') != '':
+                    new_size = utils.match_image_aspect_ratio(job.get('input_image'), orig_size)
                     if new_size != []:
-                        self.command['width'] = new_size[0]
-                        self.command['height'] = new_size[1]
+                        job['width'] = new_size[0]
+                        job['height'] = new_size[1]
 
-            elif "resize_longest_dimension:" in self.command.get('auto_size'):
-                new_long_dim = self.command.get('auto_size').split(':', 1)[1].strip()
+            elif "resize_longest_dimension:" in job.get('auto_size'):
+                new_long_dim = job.get('auto_size').split(':', 1)[1].strip()
                 new_size = utils.resize_based_on_longest_dimension(new_long_dim, orig_size)
                 if new_size != []:
-                    self.command['width'] = new_size[0]
-                    self.command['height'] = new_size[1]
+                    job['width'] = new_size[0]
+                    job['height'] = new_size[1]
 
             # check for ControlNet params
             use_controlnet = False
             scribble_mode = False
             cn_params = [64, 64, 64]
             img2img = False
-            if control.sdi_controlnet_available and self.command.get('controlnet_input_image') != '' and (self.command.get('controlnet_model') != '' or 'reference' in self.command.get('controlnet_pre')):
+            if control.sdi_controlnet_available and job.get('controlnet_input_image') != '' and (job.get('controlnet_model') != '' or 'reference' in job.get('controlnet_pre')):
                 use_controlnet = True
-                if self.command.get('input_image') != '':
+                if job.get('input_image') != '':
                     img2img = True
 
-                # encode CN image
-                encoded = base64.b64encode(open(self.command.get('controlnet_input_image'), "rb").read())
-                encodedString = str(encoded, encoding='utf-8')
-                cn_img_payload = 'data:image/png;base64,' + encodedString
+                # CN image; it's encoded when the request body is built
+                cn_img_payload = payloads.PayloadImage(job.get('controlnet_input_image'))
 
                 # get preprocessor params
-                if len(self.command.get('controlnet_pre')) >= 3:
+                if len(job.get('controlnet_pre')) >= 3:
                     found = False
                     for p in control.sdi_controlnet_preprocessors:
-                        #if self.command.get('controlnet_pre').lower() == p[0]:
-                        #    self.command['controlnet_pre'] = p[0]
+                        #if job.get('controlnet_pre').lower() == p[0]:
+                        #    job['controlnet_pre'] = p[0]
                         #    cn_params = p[1]
                         #    break
-                        if self.command.get('controlnet_pre').lower() == p.lower():
-                            self.command['controlnet_pre'] = p
+                        if job.get('controlnet_pre').lower() == p.lower():
+                            job['controlnet_pre'] = p
                             # these are the openpose defaults; not sure if these are needed
                             # TODO: investigate
                             cn_params = [512, 64, 64]
                             found = True
                             break
                     if not found:
-                        self.command['controlnet_pre'] = 'none'
+                        job['controlnet_pre'] = 'none'
                 else:
-                    self.command['controlnet_pre'] = 'none'
+                    job['controlnet_pre'] = 'none'
 
                 # check for auto-model from filename
-                auto = self.command.get('controlnet_model').lower().strip()
+                auto = job.get('controlnet_model').lower().strip()
                 if auto.startswith('auto'):
-                    cn_img = self.command.get('controlnet_input_image')
+                    cn_img = job.get('controlnet_input_image')
                     cn_img = utils.filename_from_abspath(cn_img)
                     auto_model = ''
                     # attempt to extract controlnet model from cn input file
@@ -424,65 +511,63 @@ class Worker(threading.Thread):
                         self.print('WARNING: automatic ControlNet model specified, but unable to determine valid CN model from input image filename: ' + cn_img + '; disabling ControlNet!')
                     else:
                         # we have a valid model, use it
-                        self.command['controlnet_model'] = auto_model
+                        job['controlnet_model'] = auto_model
 
             # parameters to pass to SD instance
             payload = {}
-            if self.command.get('input_image') != '':
+            if job.get('input_image') != '':
                 #img2img
-                encoded = base64.b64encode(open(self.command.get('input_image'), "rb").read())
-                encodedString = str(encoded, encoding='utf-8')
-                img_payload = 'data:image/png;base64,' + encodedString
+                img_payload = payloads.PayloadImage(job.get('input_image'))
 
                 payload = {
                   "init_images": [img_payload],
-                  "sampler_index": str(self.command.get('sampler')),
+                  "sampler_index": str(job.get('sampler')),
                   #"resize_mode": 0,
-                  "denoising_strength": self.command.get('strength'),
-                  "prompt": str(self.command.get('prompt')),
-                  "seed": self.command.get('seed'),
-                  "batch_size": self.command.get('batch_size'),     # gpu makes this many at once
-                  "n_iter": self.command.get('samples'),            # number of iterations to run
-                  "steps": self.command.get('steps'),
-                  "cfg_scale": self.command.get('scale'),
-                  "width": self.command.get('width'),
-                  "height": self.command.get('height'),
+                  "denoising_strength": job.get('strength'),
+                  "prompt": str(job.get('prompt')),
+                  "seed": job.get('seed'),
+                  "batch_size": job.get('batch_size'),     # gpu makes this many at once
+                  "n_iter": job.get('samples'),            # number of iterations to run
+                  "steps": job.get('steps'),
+                  "cfg_scale": job.get('scale'),
+                  "width": job.get('width'),
+                  "height": job.get('height'),
                   #"restore_faces": False,
-                  "tiling": self.command.get('tiling'),
-                  "negative_prompt": str(self.command.get('neg_prompt')),
+                  "tiling": job.get('tiling'),
+                  "negative_prompt": str(job.get('neg_prompt')),
                   "alwayson_scripts": {}
                 }
             else:
                 # txt2img
                 payload = {
-                  "enable_hr": self.command.get('highres_fix'),
-                  "denoising_strength": self.command.get('strength'),
-                  "sampler_index": str(self.command.get('sampler')),
-                  "prompt": str(self.command.get('prompt')),
-                  "seed": self.command.get('seed'),
-                  "batch_size": self.command.get('batch_size'),     # gpu makes this many at once
-                  "n_iter": self.command.get('samples'),            # number of iterations to run
-                  "steps": self.command.get('steps'),
-                  "cfg_scale": self.command.get('scale'),
-                  "width": self.command.get('width'),
-                  "height": self.command.get('height'),
+                  "enable_hr": job.get('highres_fix'),
+                  "denoising_strength": job.get('strength'),
+                  "sampler_index": str(job.get('sampler')),
+                  "prompt": str(job.get('prompt')),
+                  "seed": job.get('seed'),
+                  "batch_size": job.get('batch_size'),     # gpu makes this many at once
+                  "n_iter": job.get('samples'),            # number of iterations to run
+                  "steps": job.get('steps'),
+                  "cfg_scale": job.get('scale'),
+                  "width": job.get('width'),
+                  "height": job.get('height'),
                   #"restore_faces": False,
-                  "tiling": self.command.get('tiling'),
-                  "negative_prompt": str(self.command.get('neg_prompt')),
+                  "tiling": job.get('tiling'),
+                  "negative_prompt": str(job.get('neg_prompt')),
                   "alwayson_scripts": {}
                 }
 
-                if self.command['highres_fix'] == 'yes':
-                    if self.command.get('highres_upscaler') != '':
-                        payload["hr_upscaler"] = str(self.command.get('highres_upscaler'))
-                    if self.command.get('highres_ckpt_file') != '':
-                        payload["hr_checkpoint_name"] = str(self.command.get('highres_ckpt_file'))
-                    if self.command.get('highres_sampler') != '':
-                        payload["hr_sampler_name"] = str(self.command.get('highres_sampler'))
-                    if self.command.get('highres_prompt') != '':
-                        if self.command.get('highres_prompt').lower().strip() == '<remove loras>':
+                if job['highres_fix'] == 'yes':
+                    if job.get('highres_upscaler') != '':
+                        payload["hr_upscaler"] = str(job.get('highres_upscaler'))
+                    if job.get('highres_ckpt_file') != '':
+                        payload["hr_checkpoint_name"] = str(job.get('highres_ckpt_file'))
+                    if job.get('highres_sampler') != '':
+                        payload["hr_sampler_name"] = str(job.get('highres_sampler'))
+                    if job.get('highres_prompt') != '':
+                        if job.get('highres_prompt').lower().strip() == '<remove loras>':
                             # use the main prompt with loras/hypernets stripped out
-                            mp = str(self.command.get('prompt'))
+                            mp = str(job.get('prompt'))
 
                             while '<lora:' in mp and '>' in mp:
                                 p = mp
@@ -506,40 +591,40 @@ class Worker(threading.Thread):
 
                             payload["hr_prompt"] = str(mp)
                         else:
-                            if '<prompt>' in self.command.get('highres_prompt'):
-                                self.command['highres_prompt'] = self.command.get('highres_prompt').replace('<prompt>', self.command.get('prompt'))
-                            payload["hr_prompt"] = str(self.command.get('highres_prompt'))
-                    if self.command.get('highres_neg_prompt') != '':
-                        if '<neg_prompt>' in self.command.get('highres_neg_prompt'):
-                            self.command['highres_neg_prompt'] = self.command.get('highres_neg_prompt').replace('<neg_prompt>', self.command.get('neg_prompt'))
-                        payload["hr_negative_prompt"] = str(self.command.get('highres_neg_prompt'))
-                    if self.command.get('highres_steps') != '':
-                        payload["hr_second_pass_steps"] = self.command.get('highres_steps')
+                            if '<prompt>' in job.get('highres_prompt'):
+                                job['highres_prompt'] = job.get('highres_prompt').replace('<prompt>', job.get('prompt'))
+                            payload["hr_prompt"] = str(job.get('highres_prompt'))
+                    if job.get('highres_neg_prompt') != '':
+                        if '<neg_prompt>' in job.get('highres_neg_prompt'):
+                            job['highres_neg_prompt'] = job.get('highres_neg_prompt').replace('<neg_prompt>', job.get('neg_prompt'))
+                        payload["hr_negative_prompt"] = str(job.get('highres_neg_prompt'))
+                    if job.get('highres_steps') != '':
+                        payload["hr_second_pass_steps"] = job.get('highres_steps')
                     # add upscaling factor if necessary
                     if control.config.get('hires_fix_mode') == 'advanced':
-                        if self.command.get('highres_scale_factor') == '':
+                        if job.get('highres_scale_factor') == '':
                             # set default so we'll have it in metadata
-                            self.command['highres_scale_factor'] = 2.0
-                        payload["hr_scale"] = self.command.get('highres_scale_factor')
+                            job['highres_scale_factor'] = 2.0
+                        payload["hr_scale"] = job.get('highres_scale_factor')
                 else:
                     # remove these so they don't go into metadata when HR fix is disabled
-                    self.command['highres_scale_factor'] = ''
-                    self.command['highres_upscaler'] = ''
-                    self.command['highres_ckpt_file'] = ''
-                    self.command['highres_sampler'] = ''
-                    self.command['highres_steps'] = ''
-                    self.command['highres_prompt'] = ''
-                    self.command['highres_neg_prompt'] = ''
+                    job['highres_scale_factor'] = ''
+                    job['highres_upscaler'] = ''
+                    job['highres_ckpt_file'] = ''
+                    job['highres_sampler'] = ''
+                    job['highres_steps'] = ''
+                    job['highres_prompt'] = ''
+                    job['highres_neg_prompt'] = ''
 
             # add styles to payload if present
-            if self.command.get('styles') != None and len(self.command.get('styles')) > 0:
-                payload["styles"] = self.command.get('styles')
+            if job.get('styles') != None and len(job.get('styles')) > 0:
+                payload["styles"] = job.get('styles')
 
             # add refiner to payload if present
-            if self.command.get('refiner_ckpt_file') != '':
-                payload["refiner_checkpoint"] = str(self.command.get('refiner_ckpt_file'))
-                if self.command.get('refiner_switch') != '':
-                    payload["refiner_switch_at"] = self.command.get('refiner_switch')
+            if job.get('refiner_ckpt_file') != '':
+                payload["refiner_checkpoint"] = str(job.get('refiner_ckpt_file'))
+                if job.get('refiner_switch') != '':
+                    payload["refiner_switch_at"] = job.get('refiner_switch')
 
             # add CN params to existing payload if ControlNet is enabled
             # https://github.com/Mikubill/sd-webui-controlnet/wiki/API
@@ -549,19 +634,19 @@ class Worker(threading.Thread):
                         "args": [{
                             "input_image": cn_img_payload,
                             "mask": "",
-                            "module": str(self.command.get('controlnet_pre')),
-                            "model": str(self.command.get('controlnet_model')),
-                            "weight": float(self.command.get('controlnet_weight')),
+                            "module": str(job.get('controlnet_pre')),
+                            "model": str(job.get('controlnet_model')),
+                            "weight": float(job.get('controlnet_weight')),
                             #"resize_mode": "Scale to Fit (Inner Fit)",
-                            "lowvram": self.command.get('controlnet_lowvram'),
+                            "lowvram": job.get('controlnet_lowvram'),
                             #"processor_res": cn_params[0],
                             #"threshold_a": cn_params[1],
                             #"threshold_b": cn_params[2],
                             "guidance_start": 0,
                             "guidance_end": 1,
-                            "control_mode": str(self.command.get('controlnet_controlmode')),
-                            "pixel_perfect": self.command.get('controlnet_pixelperfect')
-                            #"guessmode": self.command.get('controlnet_guessmode')  # removed in CN extension v 1.1.09
+                            "control_mode": str(job.get('controlnet_controlmode')),
+                            "pixel_perfect": job.get('controlnet_pixelperfect')
+                            #"guessmode": job.get('controlnet_guessmode')  # removed in CN extension v 1.1.09
                         }]
                     }
                 }
@@ -571,24 +656,24 @@ class Worker(threading.Thread):
             # add ADetailer params to existing payload if ADetailer is enabled
             # https://github.com/Bing-su/adetailer/wiki/API
             if use_adetailer:
-                ad_payload = utils.build_adetailer_payload(self.command, True)
-                if self.command.get('input_image') != '':
-                    ad_payload = utils.build_adetailer_payload(self.command, False)
+                ad_payload = utils.build_adetailer_payload(job, True)
+                if job.get('input_image') != '':
+                    ad_payload = utils.build_adetailer_payload(job, False)
                 payload["alwayson_scripts"].update(ad_payload)
 
             # handle override settings here: clip_skip, vae, etc
             override_settings = {}
-            if self.command.get('clip_skip') != '':
-                override_settings["CLIP_stop_at_last_layers"] = int(self.command.get('clip_skip'))
+            if job.get('clip_skip') != '':
+                override_settings["CLIP_stop_at_last_layers"] = int(job.get('clip_skip'))
 
-            if self.command.get('input_image') == '' and self.command['highres_fix'] == 'yes' and self.command.get('highres_vae') != '':
+            if job.get('input_image') == '' and job['highres_fix'] == 'yes' and job.get('highres_vae') != '':
                 # BK 2023-09-26 revert, no separate Auto1111 VAE API setting
-                #override_settings["sd_vae"] = str(self.command.get('highres_vae'))
+                #override_settings["sd_vae"] = str(job.get('highres_vae'))
                 pass
             else:
-                if self.command.get('vae') != '':
-                    override_settings["sd_vae"] = self.command.get('vae')
-                self.command['highres_vae'] = ''
+                if job.get('vae') != '':
+                    override_settings["sd_vae"] = job.get('vae')
+                job['highres_vae'] = ''
 
             if override_settings != {}:
                 payload["override_settings"] = override_settings
@@ -596,10 +681,10 @@ class Worker(threading.Thread):
         else:
             # !MODE=process -specific stuff here
             process_mode = True
-            original_exif = metadata.read_exif(self.command.get('input_image'))
-            original_iptc = metadata.read_iptc(self.command.get('input_image'))
+            original_exif = metadata.read_exif(job.get('input_image'))
+            original_iptc = metadata.read_iptc(job.get('input_image'))
 
-            if self.command['use_upscale'] == 'yes' and (self.command['upscale_model'] == 'sd' or self.command['upscale_model'] == 'ultimate'):
+            if job['use_upscale'] == 'yes' and (job['upscale_model'] == 'sd' or job['upscale_model'] == 'ultimate'):
                 # get original image parameters if we're doing a SD upscale
                 original_details = ''
                 if original_exif != None:
@@ -610,21 +695,55 @@ class Worker(threading.Thread):
                     else:
                         original_command = utils.extract_params_from_command(original_details)
 
-            original_filename = utils.filename_from_abspath(self.command.get('input_image')).lower().strip()
+            original_filename = utils.filename_from_abspath(job.get('input_image')).lower().strip()
             # remove extension
             original_filename = original_filename[:-4]
 
             # check for !OUTPUT_DIR, create if necessary
-            if self.command.get('output_dir') != '':
-                if not os.path.exists(self.command.get('output_dir')):
+            if job.get('output_dir') != '':
+                if not os.path.exists(job.get('output_dir')):
                     try:
                         # attempt to create output directory
-                        Path(self.command.get('output_dir')).mkdir(parents=True, exist_ok=True)
+                        Path(job.get('output_dir')).mkdir(parents=True, exist_ok=True)
                     except:
                         # error creating specified output_dir, fallback to default
-                        self.print("Specified OUTPUT_DIR could not be created: " + self.command.get('output_dir'))
+                        self.print("Specified OUTPUT_DIR could not be created: " + job.get('output_dir'))
                         self.print("Using default output directory instead...")
-                        self.command['output_dir'] = ''
+                        job['output_dir'] = ''
+
+        # build the request body now too, so that image encoding also happens ahead of time
+        body = None
+        if payload != {}:
+            body = payloads.encode_payload(payload)
+
+        return {
+            'command': job,
+            'payload': payload,
+            'body': body,
+            'model': model,
+            'process_mode': process_mode,
+            'use_adetailer': use_adetailer,
+            'original_exif': original_exif,
+            'original_iptc': original_iptc,
+            'original_command': original_command
+        }
+
+
+    # GPU side of a job: loads the model if necessary, runs the job through SD and handles the output
+    def execute_job(self, prep):
+        self.command = prep['command']
+        payload = prep['payload']
+        body = prep['body']
+        process_mode = prep['process_mode']
+        use_adetailer = prep['use_adetailer']
+        original_exif = prep['original_exif']
+        original_iptc = prep['original_iptc']
+        original_command = prep['original_command']
+
+        # check if a model change is needed
+        if prep['model'] != '' and prep['model'] != self.worker['sdi_instance'].model_loaded:
+            # wait for model change to complete
+            self.wait_for(self.worker['sdi_instance'].load_model(prep['model']), False)
 
         # !MODE = process enters here:
         command = utils.create_command(self.command, self.command.get('prompt_file'), self.worker['id'])
@@ -648,7 +767,10 @@ class Worker(threading.Thread):
         #samples_dir = os.path.join(output_dir, "gpu_" + str(gpu_id))
         samples_dir = output_dir + '/' + "gpu_" + str(gpu_id)
 
-        #self.worker['sdi_instance'].last_job_success = True
+        # images SD returns for this job are kept in memory (by file name, in the order they arrive);
+        # they're only written to samples_dir when SAVE_INTERMEDIATE_PNGS is on
+        samples = {}
+
         if control.config.get('debug_test_mode') and not process_mode:
             # simulate SD work
             work_time = round(random.uniform(2, 6), 2)
@@ -656,23 +778,17 @@ class Worker(threading.Thread):
         else:
             # invoke SD
             if not process_mode:
+                # remember the secondary models this job makes SD load (used for model-affinity dispatch)
+                self.worker['sdi_instance'].last_highres_model = payload.get('hr_checkpoint_name', '')
+                self.worker['sdi_instance'].last_refiner_model = payload.get('refiner_checkpoint', '')
                 if self.command.get('input_image') != '':
-                    if use_controlnet:
-                        #self.worker['sdi_instance'].do_controlnet_img2img(payload, samples_dir)
-                        self.worker['sdi_instance'].do_img2img(payload, samples_dir)
-                    else:
-                        self.worker['sdi_instance'].do_img2img(payload, samples_dir)
+                    request = self.worker['sdi_instance'].img2img(body, samples_dir, generation_work(payload))
                 else:
-                    if use_controlnet:
-                        #self.worker['sdi_instance'].do_controlnet_txt2img(payload, samples_dir)
-                        self.worker['sdi_instance'].do_txt2img(payload, samples_dir)
-                    else:
-                        self.worker['sdi_instance'].do_txt2img(payload, samples_dir)
-                while self.worker['sdi_instance'].busy and self.worker['sdi_instance'].isRunning:
-                    time.sleep(0.25)
+                    request = self.worker['sdi_instance'].txt2img(body, samples_dir, generation_work(payload))
+                self.add_samples(samples, self.wait_for(request))
 
         # upscale here if requested
-        if (self.worker['sdi_instance'].last_job_success or process_mode) and self.worker['sdi_instance'].isRunning:
+        if (self.job_success or process_mode) and self.worker['sdi_instance'].isRunning:
             # only if we're not shutting down
             use_upscale = False
             if self.command['use_upscale'] == 'yes':
@@ -695,7 +811,7 @@ class Worker(threading.Thread):
                     new_files = []
                     if not process_mode:
                         # upscale all newly-generated images for non-process mode
-                        new_files = os.listdir(samples_dir)
+                        new_files = list(samples.values())
                     else:
                         # if process mode, upscale the designated image
                         new_files.append(self.command.get('input_image'))
@@ -714,14 +830,13 @@ class Worker(threading.Thread):
                             else:
                                 self.worker['sdi_instance'].log('processing ' + self.command.get('input_image') + '...')
                         for file in new_files:
-                            encoded = None
                             if not process_mode:
-                                encoded = base64.b64encode(open(os.path.join(samples_dir, file), "rb").read())
+                                # send back the image exactly as SD encoded it
+                                img_payload = file.payload_image()
                             else:
                                 # this whole process_mode thread is pretty hacky...
-                                encoded = base64.b64encode(open(self.command.get('input_image'), "rb").read())
-                            encodedString = str(encoded, encoding='utf-8')
-                            img_payload = 'data:image/png;base64,' + encodedString
+                                # each input is only processed once; stream it rather than caching it
+                                img_payload = payloads.PayloadImage(self.command.get('input_image'), cache=False)
                             if use_upscale:
                                 if self.command['upscale_model'] != 'sd' and self.command['upscale_model'] != 'ultimate':
                                     # normal upscale
@@ -741,7 +856,9 @@ class Worker(threading.Thread):
                                         #"upscale_first": false,
                                         "image": img_payload
                                     }
-                                    self.worker['sdi_instance'].do_upscale(payload, samples_dir)
+                                    request = self.worker['sdi_instance'].upscale(payload, samples_dir)
+                                    # a failed upscale just leaves the original image in place
+                                    required = False
                                 else:
                                     # SD upscale uses img2img
                                     # use whatever params we can find in original image
@@ -857,10 +974,8 @@ class Worker(threading.Thread):
                                                     sd_model = refiner_model
 
                                     if sd_model != '' and (sd_model != self.worker['sdi_instance'].model_loaded):
-                                        self.worker['sdi_instance'].load_model(sd_model)
-                                        while self.worker['sdi_instance'].options_change_in_progress:
-                                            # wait for model change to complete
-                                            time.sleep(0.25)
+                                        # wait for model change to complete
+                                        self.wait_for(self.worker['sdi_instance'].load_model(sd_model), False)
 
                                     payload = {
                                       "init_images": [img_payload],
@@ -940,7 +1055,8 @@ class Worker(threading.Thread):
                                         ad_payload = utils.build_adetailer_payload(self.command, True)
                                         payload["alwayson_scripts"].update(ad_payload)
 
-                                    self.worker['sdi_instance'].do_img2img(payload, samples_dir)
+                                    request = self.worker['sdi_instance'].img2img(payload, samples_dir)
+                                    required = True
                             else:
                                 # We're just doing ADetailer; no upscale...
                                 payload = {
@@ -949,33 +1065,36 @@ class Worker(threading.Thread):
                                 }
                                 ad_payload = utils.build_adetailer_payload(self.command, True)
                                 payload["alwayson_scripts"].update(ad_payload)
-                                self.worker['sdi_instance'].do_img2img(payload, samples_dir)
+                                request = self.worker['sdi_instance'].img2img(payload, samples_dir)
+                                required = True
 
-                            while self.worker['sdi_instance'].busy and self.worker['sdi_instance'].isRunning:
-                                time.sleep(0.25)
+                            self.add_samples(samples, self.wait_for(request, required))
 
                         # remove originals if upscaled version present
                         if not process_mode:
-                            new_files = os.listdir(samples_dir)
+                            new_files = list(samples.keys())
                             for f in new_files:
                                 if (".png" in f):
                                     basef = f.replace(".png", "")
                                     if basef[-2:] == "_u":
                                         # this is an upscaled image, delete the original
                                         # or save it in /original if desired
-                                        if exists(samples_dir + "/" + basef[:-2] + ".png"):
+                                        if basef[:-2] + ".png" in samples:
+                                            original = samples.pop(basef[:-2] + ".png")
                                             if self.command['upscale_keep_org'] == 'yes':
-                                                # move the original to /original
+                                                # save the original to /original
                                                 orig_dir = output_dir + "/original"
                                                 Path(orig_dir).mkdir(parents=True, exist_ok=True)
-                                                os.replace(samples_dir + "/" + basef[:-2] + ".png", \
-                                                    orig_dir + "/" + basef[:-2] + ".png")
-                                            else:
-                                                os.remove(samples_dir + "/" + basef[:-2] + ".png")
+                                                if original.path != '':
+                                                    os.replace(original.path, orig_dir + "/" + original.name)
+                                                else:
+                                                    original.save(orig_dir + "/" + original.name)
+                                            elif original.path != '':
+                                                os.remove(original.path)
 
 
         # find the new image(s) that SD created: re-name, process, and move them
-        if self.worker['sdi_instance'].last_job_success and self.worker['sdi_instance'].isRunning:
+        if self.job_success and self.worker['sdi_instance'].isRunning:
             # only if we're not shutting down
             self.worker['work_state'] = "+exif data"
             if control.config.get('debug_test_mode'):
@@ -983,10 +1102,9 @@ class Worker(threading.Thread):
                 work_time = round(random.uniform(1, 2), 2)
                 time.sleep(work_time)
             else:
-                new_files = []
-                if exists(samples_dir):
-                    new_files = os.listdir(samples_dir)
+                new_files = list(samples.keys())
                 nf_count = 0
+                finalize_files = []
                 for f in new_files:
                     if (".png" in f):
                         # save just the essential prompt params to metadata
@@ -1020,19 +1138,6 @@ class Worker(threading.Thread):
                             ad_text = " (ADetailer applied: "
                             ad_text += str(self.command.get('adetailer_model')) + ' @ ' + str(self.command.get('adetailer_strength')) + ' strength)'
 
-
-                        pngImage = PngImageFile(samples_dir + "/" + f)
-                        im = pngImage.convert('RGB')
-                        exif = None
-                        if not process_mode:
-                            exif = im.getexif()
-                            exif[0x9286] = meta_prompt
-                            exif[0x9c9c] = meta_prompt.encode('utf16')
-                            exif[0x0131] = "https://github.com/rbbrdckybk/dream-factory"
-                        else:
-                            exif = original_exif
-                        exif[0x9c9d] = ('AI art' + upscale_text + ad_text).encode('utf16')
-
                         newfilename = ''
                         if self.command['filename'] != '':
                             # user specified custom filename format
@@ -1154,57 +1259,57 @@ class Worker(threading.Thread):
 
                             # make the final name filesystem-safe
                             newfilename = utils.slugify(newfilename)
-
-                            x = 0
-                            testname = newfilename
-                            while exists(output_dir + "/" + testname + ".jpg"):
-                                testname = newfilename + '-' + str(x)
-                                x += 1
-                            newfilename = testname
+                            # (the post-processor adds a suffix if the name is already taken)
                         else:
                             # use default filename format
                             newfilename = dt.now().strftime('%Y%m%d-%H%M%S-') + str(nf_count)
                             nf_count += 1
 
-                        quality = control.config.get('jpg_quality')
-                        #output_fn = output_dir + "/" + newfilename + ".jpg"
-                        output_fn = os.path.join(output_dir, newfilename + ".jpg")
-                        if process_mode and self.command.get('output_dir') != '':
-                            output_fn =os.path.join(self.command.get('output_dir'), newfilename + ".jpg")
-
-                        try:
-                            im.save(output_fn, exif=exif, quality=quality)
-                        except:
-                            self.print("OS error when attempting to save output image!")
-
-                        iptc_append = False
-                        if process_mode:
-                            # re-attach original iptc info
-                            metadata.attach_iptc_info(output_fn, original_iptc)
-                            if self.command.get('iptc_append'):
-                                iptc_append = True
-
-                        # add IPTC metadata if necesary
-                        if (self.command.get('iptc_title') != ''
-                                or self.command.get('iptc_description') != ''
-                                or self.command.get('iptc_keywords') != []
-                                or self.command.get('iptc_copyright') != ''):
-
-                            if not iptc_append:
-                                metadata.write_iptc_info(output_fn,
-                                    self.command.get('iptc_title'),
-                                    self.command.get('iptc_description'),
-                                    self.command.get('iptc_keywords'),
-                                    self.command.get('iptc_copyright'))
-                            else:
-                                metadata.write_iptc_info_append(output_fn,
-                                    self.command.get('iptc_title'),
-                                    self.command.get('iptc_description'),
-                                    self.command.get('iptc_keywords'),
-                                    self.command.get('iptc_copyright'))
-
-                        if exists(samples_dir + "/" + f):
-                            os.remove(samples_dir + "/" + f)
+                        finalize_files.append({
+                            'src': f,
+                            'image': samples[f].data if samples[f].path == '' else None,
+                            'name': newfilename,
+                            'meta_prompt': meta_prompt,
+                            'description': 'AI art' + upscale_text + ad_text
+                        })
+
+                if len(finalize_files) > 0:
+                    # move this job's images into their own staging dir, and hand JPEG conversion & metadata
+                    # off to the post-processor so that this GPU can start its next job right away
+                    # (images that are only in memory go along with the task itself)
+                    staging_dir = ''
+                    if exists(samples_dir):
+                        self.jobs_staged += 1
+                        staging_dir = samples_dir + '-' + str(self.jobs_staged)
+                        while exists(staging_dir):
+                            # left over from an earlier run
+                            self.jobs_staged += 1
+                            staging_dir = samples_dir + '-' + str(self.jobs_staged)
+                        os.replace(samples_dir, staging_dir)
+
+                    dest_dir = output_dir
+                    if process_mode and self.command.get('output_dir') != '':
+                        dest_dir = self.command.get('output_dir')
+
+                    exif_source = ''
+                    if process_mode:
+                        exif_source = self.command.get('input_image')
+
+                    task = {
+                        'files': finalize_files,
+                        'samples_dir': staging_dir,
+                        'dest_dir': dest_dir,
+                        'quality': control.config.get('jpg_quality'),
+                        'exif_source': exif_source,
+                        'iptc_append': self.command.get('iptc_append') == True,
+                        'iptc': {
+                            'title': self.command.get('iptc_title'),
+                            'description': self.command.get('iptc_description'),
+                            'keywords': self.command.get('iptc_keywords'),
+                            'copyright': self.command.get('iptc_copyright')
+                        }
+                    }
+                    control.postprocessor.submit(task, self.print)
 
 
         self.worker['work_state'] = ""
@@ -1217,11 +1322,13 @@ class Worker(threading.Thread):
             pass
 
         exec_time = time.time() - start_time
-        if self.worker['sdi_instance'].last_job_success:
+        if self.job_success:
             self.print("finished job #" + str(self.worker['jobs_done']+1) + " in " + str(round(exec_time, 2)) + " seconds.")
+        elif self.requeue:
+            self.print("job #" + str(self.worker['jobs_done']+1) + " was cut short by an SD restart after " + str(round(exec_time, 2)) + " seconds; returning it to the queue.")
         else:
             self.print("job #" + str(self.worker['jobs_done']+1) + " failed after " + str(round(exec_time, 2)) + " seconds.")
-        self.callback(self.worker)
+        self.finish_job()
 
 
     def print(self, text):
@@ -1237,6 +1344,10 @@ class Worker(threading.Thread):
 # controller manages worker thread(s) and user input
 class Controller:
     def __init__(self, config_file):
+        # how long each part of startup takes (see startup_step()), for the report once SD is up
+        self.startup_steps = [['Python startup/imports', time.time() - psutil.Process().create_time()]]
+        self.startup_mark = time.time()
+        self.startup_reported = False
         self.config_file = config_file
         self.config = {}
         self.prompt_file = ""
@@ -1245,9 +1356,12 @@ class Controller:
         self.prompt_manager = None
         self.input_manager = None
         self.output_buffer = deque([], maxlen=300)
-        self.work_queue = deque()
+        self.work_queue = utils.WorkQueue()
         self.upscale_work_queue = deque()           # higher-priority queue for upscales, never cleared
         self.workers = []
+        self.boot_limit = 0                         # SD instances that may start up at once (see boot_workers())
+        self.wakeup = threading.Condition()         # main work loop sleeps on this until there's something to do
+        self.wakeup_pending = False
         self.work_done = False
         self.is_paused = False
         self.loops = 0
@@ -1259,6 +1373,7 @@ class Controller:
         self.server_startup_time = time.time()
         self.shutting_down = False
         self.sdi_ports_assigned = 0
+        self.gpu_busy_times = {}                    # GPU index: BusyTime shared by the SD instances on it
         #self.sdi_setup_request_made = False        # made this worker-level
         self.sdi_sampler_request_made = False
         self.sdi_samplers = None
@@ -1290,6 +1405,10 @@ class Controller:
         self.sdi_adetailer_available = False
         self.wildcards = None
         self.default_model_validated = False
+        self.sd_fingerprint = ''                    # fingerprint of the SD install (see scripts/catalog.py)
+        self.discovery_futures = []                 # outstanding startup discovery queries
+        self.discovery_started = 0
+        self.discovery_seconds = 0                  # how long it took to get answers to all of them
         self.max_output_size = 0
         self.civitai_startup_done = False
         self.civitai_new_stage = False
@@ -1299,9 +1418,26 @@ class Controller:
         self.model_index = 0
         self.highres_models = []
         self.highres_model_index = 0
+        # for MULTI_MODEL_MODE = parallel; queued work is split into one lane per model
+        # and each GPU is pinned to its own lane(s) so it only has to load its model(s) once
+        self.sweep_lanes = None                     # dict of model: WorkQueue, None when not sweeping
+        self.sweep_pins = {}                        # worker id: list of lane models
+        self.sweep_progress = {}                    # model: [jobs done, total jobs]
+        # for model-affinity dispatch; the job at the head of the queue and how many times it's been passed over
+        self.dispatch_head = None
+        self.dispatch_head_skips = 0
+        # guards each worker's list of assigned jobs, which both the main loop and worker threads update
+        self.worker_lock = threading.Lock()
 
         # read config options
         self.init_config()
+        self.startup_step('config')
+
+        # converts finished images to JPEGs with metadata in the background (see POSTPROCESS_WORKERS)
+        self.postprocessor = postprocess.PostProcessor(self.config['postprocess_workers'])
+        # keeps encoded init/ControlNet images in memory (see IMAGE_CACHE_MB)
+        imagecache.cache.configure(self.config['image_cache_mb'] * 1024 * 1024)
+        self.startup_step('post-processor')
 
         if self.config['sd_location'] == '':
             print('\nERROR: path to stable diffusion not specified in config file! ')
@@ -1325,16 +1461,27 @@ class Controller:
 
         if not self.config.get('debug_test_mode'):
             # initialize GPU(s)
-            self.init_gpu_workers()
+            source = self.init_gpu_workers()
+            self.startup_step('GPU discovery (' + source + ')')
         else:
             # create some dummy devices for testing
             self.init_dummy_workers()
 
+        # prepares upcoming jobs ahead of time (see PREFETCH_JOBS); enough threads for every
+        # worker's prefetched jobs to be prepared at once
+        prep_threads = max(1, len(self.workers) * self.config['prefetch_jobs'])
+        self.prep_pool = concurrent.futures.ThreadPoolExecutor(max_workers=prep_threads, thread_name_prefix='job-prep')
+
         # do an initial read of user-installed files
         self.read_wildcards()
         self.read_embeddings()
         #self.read_loras()          # 2023-05-30 API call now available for this
         self.init_controlnet()
+        self.startup_step('wildcards/embeddings/ControlNet')
+
+        # start with what SD had available last time if its install hasn't changed
+        self.load_catalog()
+        self.startup_step('catalog cache')
 
 
     # clean up empty output dirs
@@ -1906,6 +2053,20 @@ class Controller:
             'max_output_size' : 0,
             'auto_use_refiner' : True,
             'hires_fix_mode' : 'simple',
+            'multi_model_mode' : 'sequential',
+            'queue_planner' : True,
+            'queue_planner_max_jobs' : 100000,
+            'dispatch_model_affinity' : True,
+            'dispatch_lookahead' : 100,
+            'dispatch_max_skips' : 20,
+            'prefetch_jobs' : 1,
+            'postprocess_workers' : 2,
+            'save_intermediate_pngs' : False,
+            'image_cache_mb' : 256,
+            'sd_transport' : 'threads',
+            'watchdog_timeout' : 300,
+            'sd_attach' : False,
+            'sd_detach_on_exit' : False,
 
             'auto_insert_model_trigger' : 'start',
             'neg_prompt' : '',
@@ -1930,7 +2091,8 @@ class Controller:
 
             'sd_location' : "",
             'sd_port' : 7861,
-            'gpu_init_stagger' : 1
+            'gpu_init_stagger' : 1,
+            'sd_instances_per_gpu' : 1
         }
 
         file = utils.TextFile(self.config_file)
@@ -1978,12 +2140,26 @@ class Controller:
                             self.config.update({'sd_port' : int(value)})
 
                     elif command == 'gpu_init_stagger':
+                        if value == 'auto':
+                            self.config.update({'gpu_init_stagger' : 0})
+                        else:
+                            try:
+                                int(value)
+                            except:
+                                print("*** WARNING: specified 'GPU_INIT_STAGGER' is not a valid number; it will be ignored!")
+                            else:
+                                self.config.update({'gpu_init_stagger' : max(int(value), 1)})
+
+                    elif command == 'sd_instances_per_gpu':
                         try:
                             int(value)
                         except:
-                            print("*** WARNING: specified 'GPU_INIT_STAGGER' is not a valid number; it will be ignored!")
+                            print("*** WARNING: specified 'SD_INSTANCES_PER_GPU' is not a valid number; it will be ignored!")
                         else:
-                            self.config.update({'gpu_init_stagger' : int(value)})
+                            if int(value) >= 1:
+                                self.config.update({'sd_instances_per_gpu' : int(value)})
+                            else:
+                                print("*** WARNING: specified 'SD_INSTANCES_PER_GPU' must be at least 1; it will be ignored!")
 
                     elif command == 'webserver_use':
                         if value == 'yes' or value == 'no':
@@ -2094,6 +2270,136 @@ class Controller:
                             print("*** WARNING: specified 'HIRES_FIX_MODE' value not recognized; defaulting to simple!")
                             self.config.update({'hires_fix_mode' : 'simple'})
 
+                    elif command == 'multi_model_mode':
+                        value = value.lower()
+                        if value == 'sequential' or value == 'parallel':
+                            self.config.update({'multi_model_mode' : value})
+                        else:
+                            print("*** WARNING: specified 'MULTI_MODEL_MODE' value not recognized; defaulting to sequential!")
+                            self.config.update({'multi_model_mode' : 'sequential'})
+
+                    elif command == 'queue_planner':
+                        if value == 'yes' or value == 'no':
+                            if value == 'yes':
+                                self.config.update({'queue_planner' : True})
+                            else:
+                                self.config.update({'queue_planner' : False})
+
+                    elif command == 'queue_planner_max_jobs':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'QUEUE_PLANNER_MAX_JOBS' is not a valid number; it will be ignored!")
+                        else:
+                            if int(value) >= 0:
+                                self.config.update({'queue_planner_max_jobs' : int(value)})
+                            else:
+                                print("*** WARNING: specified 'QUEUE_PLANNER_MAX_JOBS' may not be negative; it will be ignored!")
+
+                    elif command == 'dispatch_model_affinity':
+                        if value == 'yes' or value == 'no':
+                            if value == 'yes':
+                                self.config.update({'dispatch_model_affinity' : True})
+                            else:
+                                self.config.update({'dispatch_model_affinity' : False})
+
+                    elif command == 'dispatch_lookahead':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'DISPATCH_LOOKAHEAD' is not a valid number; it will be ignored!")
+                        else:
+                            if int(value) > 0:
+                                self.config.update({'dispatch_lookahead' : int(value)})
+                            else:
+                                print("*** WARNING: specified 'DISPATCH_LOOKAHEAD' must be at least 1; it will be ignored!")
+
+                    elif command == 'dispatch_max_skips':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'DISPATCH_MAX_SKIPS' is not a valid number; it will be ignored!")
+                        else:
+                            if int(value) >= 0:
+                                self.config.update({'dispatch_max_skips' : int(value)})
+                            else:
+                                print("*** WARNING: specified 'DISPATCH_MAX_SKIPS' may not be negative; it will be ignored!")
+
+                    elif command == 'prefetch_jobs':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'PREFETCH_JOBS' is not a valid number; it will be ignored!")
+                        else:
+                            if int(value) >= 0:
+                                self.config.update({'prefetch_jobs' : int(value)})
+                            else:
+                                print("*** WARNING: specified 'PREFETCH_JOBS' may not be negative; it will be ignored!")
+
+                    elif command == 'postprocess_workers':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'POSTPROCESS_WORKERS' is not a valid number; it will be ignored!")
+                        else:
+                            if int(value) >= 0:
+                                self.config.update({'postprocess_workers' : int(value)})
+                            else:
+                                print("*** WARNING: specified 'POSTPROCESS_WORKERS' may not be negative; it will be ignored!")
+
+                    elif command == 'save_intermediate_pngs':
+                        if value == 'yes' or value == 'no':
+                            if value == 'yes':
+                                self.config.update({'save_intermediate_pngs' : True})
+                            else:
+                                self.config.update({'save_intermediate_pngs' : False})
+
+                    elif command == 'image_cache_mb':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'IMAGE_CACHE_MB' is not a valid number; it will be ignored!")
+                        else:
+                            if int(value) >= 0:
+                                self.config.update({'image_cache_mb' : int(value)})
+                            else:
+                                print("*** WARNING: specified 'IMAGE_CACHE_MB' may not be negative; it will be ignored!")
+
+                    elif command == 'sd_transport':
+                        value = value.lower()
+                        if value == 'threads' or value == 'asyncio':
+                            if value == 'asyncio' and not aiotransport.available():
+                                print("*** WARNING: 'SD_TRANSPORT = asyncio' requires the aiohttp package (pip install aiohttp); using threads instead!")
+                            else:
+                                self.config.update({'sd_transport' : value})
+                        else:
+                            print("*** WARNING: specified 'SD_TRANSPORT' must be threads or asyncio; it will be ignored!")
+
+                    elif command == 'watchdog_timeout':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'WATCHDOG_TIMEOUT' is not a valid number; it will be ignored!")
+                        else:
+                            if int(value) >= 0:
+                                self.config.update({'watchdog_timeout' : int(value)})
+                            else:
+                                print("*** WARNING: specified 'WATCHDOG_TIMEOUT' may not be negative; it will be ignored!")
+
+                    elif command == 'sd_attach':
+                        if value == 'yes' or value == 'no':
+                            if value == 'yes':
+                                self.config.update({'sd_attach' : True})
+                            else:
+                                self.config.update({'sd_attach' : False})
+
+                    elif command == 'sd_detach_on_exit':
+                        if value == 'yes' or value == 'no':
+                            if value == 'yes':
+                                self.config.update({'sd_detach_on_exit' : True})
+                            else:
+                                self.config.update({'sd_detach_on_exit' : False})
+
                     elif command == 'max_output_size':
                         value = value.replace(',', '').strip()
                         if value != '':
@@ -2288,6 +2594,9 @@ class Controller:
 
     # handle graceful cleanup here
     def sigterm_handler(self, *args):
+        if self.shutting_down:
+            # already cleaning up (e.g. Ctrl+C pressed twice); exiting from here would cut that short
+            return
         # save the state here or do whatever you want
         self.print('********** Exiting; handling clean up ***************')
         self.shutdown()
@@ -2309,6 +2618,24 @@ class Controller:
         if self.is_paused:
             self.is_paused = False
             self.print("Un-pausing; workers will resume working...")
+            self.notify()
+
+
+    # wakes up the main work loop; call this whenever something happens that it
+    # may need to act on (new work, a worker going idle, an SD instance becoming ready, etc)
+    def notify(self):
+        with self.wakeup:
+            self.wakeup_pending = True
+            self.wakeup.notify_all()
+
+
+    # blocks the main work loop until notify() is called
+    # returns immediately if a notification arrived since the last wait
+    def wait_for_wakeup(self, timeout=None):
+        with self.wakeup:
+            if not self.wakeup_pending:
+                self.wakeup.wait(timeout)
+            self.wakeup_pending = False
 
 
     def shutdown(self):
@@ -2319,9 +2646,16 @@ class Controller:
                 # stop the webserver if it's running
                 self.server.stop()
 
+            # let images that are still being finalized finish before their staging dirs are cleaned up
+            self.postprocessor.shutdown()
+
             # clean up gpu sd instance threads
             for worker in self.workers:
+                if worker.get('thread') != None:
+                    worker['thread'].stop()
                 worker['sdi_instance'].cleanup()
+            # with SD_TRANSPORT = asyncio, stop the shared event loop and its handler threads
+            aiotransport.shutdown()
 
             # clean up temp directory
             temp = os.path.join('server', 'temp')
@@ -2333,92 +2667,77 @@ class Controller:
 
             self.is_paused = True
             self.work_done = True
+            self.notify()
 
 
-    # adds a GPU to the list of workers
+    # adds SD_INSTANCES_PER_GPU workers for device id, each with an SD instance on a port of its own;
+    # the first keeps the device's id as its worker id, any others are suffixed (e.g. cuda:0-2)
     def add_gpu_worker(self, id, name, dummy = False):
         sdi_gpu_id = id.replace('cuda:', '')
-        sdi_port = self.config['sd_port'] + self.sdi_ports_assigned
-        self.sdi_ports_assigned += 1
-
-        if not dummy:
-            self.workers.append({'id': id, \
-                'name': name, \
-                'work_state': "", \
-                'jobs_done': 0, \
-                'job_prompt_info': '', \
-                'job_start_time': float(0), \
-                'sdi_setup_request_made' : False, \
-                'idle': True, \
-                'sdi_instance': SDI(sdi_gpu_id, sdi_port, self.config['sd_location'], self, id) \
-            })
-        else:
-            # TODO fix dummy workers to work in sim mode
-            self.workers.append({'id': id, \
-                'name': name, \
-                'work_state': "", \
-                'jobs_done': 0, \
-                'job_prompt_info': '', \
-                'job_start_time': float(0), \
-                'sdi_setup_request_made' : True, \
-                'idle': True, \
-                'sdi_instance': None \
-            })
-
-        self.print("initialized worker '" + id + "': " + name)
+        for instance in range(1, self.config['sd_instances_per_gpu'] + 1):
+            worker_id = id
+            if instance > 1:
+                worker_id = id + '-' + str(instance)
+            sdi_port = self.config['sd_port'] + self.sdi_ports_assigned
+            self.sdi_ports_assigned += 1
+
+            if not dummy:
+                self.workers.append({'id': worker_id, \
+                    'name': name, \
+                    'work_state': "", \
+                    'jobs_done': 0, \
+                    'job_prompt_info': '', \
+                    'job_start_time': float(0), \
+                    'sdi_setup_request_made' : False, \
+                    'idle': True, \
+                    'assigned_jobs': deque(), \
+                    'sdi_instance': SDI(sdi_gpu_id, sdi_port, self.config['sd_location'], self, worker_id, instance) \
+                })
+            else:
+                # TODO fix dummy workers to work in sim mode
+                self.workers.append({'id': worker_id, \
+                    'name': name, \
+                    'work_state': "", \
+                    'jobs_done': 0, \
+                    'job_prompt_info': '', \
+                    'job_start_time': float(0), \
+                    'sdi_setup_request_made' : True, \
+                    'idle': True, \
+                    'assigned_jobs': deque(), \
+                    'sdi_instance': None \
+                })
+
+            self.print("initialized worker '" + worker_id + "': " + name)
 
 
     # build a list of gpu workers
     def init_gpu_workers(self):
         if self.config['use_gpu_devices'] == "auto":
-            # attempt to auto-detect GPUs
-            self.print("detected " + str(device_count()) + " total GPU device(s)...")
-            for i in range(device_count()):
-                name = ""
-                worker = "cuda:" + str(i)
-                try:
-                    name = get_device_name(worker)
-                except AssertionError:
-                    self.print("unable to initialize device '" + worker + "'; removing it as a GPU candidate...")
-
-                # if we can see the gpu name, add it to the list of workers
-                if name != '':
-                    self.add_gpu_worker(worker, name)
-
-        elif ',' in self.config['use_gpu_devices']:
-            # we're specifying multiple GPUs
-            gpus = self.config['use_gpu_devices'].split(',')
-            for gpu in gpus:
-                name = ""
-                worker = "cuda:" + gpu.strip()
-                try:
-                    name = get_device_name(worker)
-                except AssertionError:
-                    self.print("unable to initialize device '" + worker + "'; removing it as a GPU candidate...")
-
-                # if we can see the gpu name, add it to the list of workers
-                if name != '':
-                    self.add_gpu_worker(worker, name)
-
-        else:
-            # add exactly 1 gpu
-            gpu = -1
+            # attempt to auto-detect GPUs (see scripts/gpus.py)
+            devices, source = gpus.detect()
+            self.print("detected " + str(len(devices)) + " total GPU device(s) via " + source + "...")
+            for index, name in devices:
+                self.add_gpu_worker("cuda:" + str(index), name)
+            return source
+
+        # we're specifying the GPU(s) to use, so there's no need to enumerate them all
+        ids = []
+        for gpu in self.config['use_gpu_devices'].split(','):
             try:
-                gpu = int(self.config['use_gpu_devices'].strip())
+                ids.append(int(gpu.strip()))
             except ValueError:
                 self.print("ERROR: can't understand USE_GPU_DEVICES configuration: " + self.config['use_gpu_devices'])
-
-            if gpu > -1:
-                name = ""
-                worker = "cuda:" + str(gpu)
-                try:
-                    name = get_device_name(worker)
-                except AssertionError:
-                    self.print("unable to initialize device '" + worker + "'; removing it as a GPU candidate...")
-
-                # if we can see the gpu name, add it to the list of workers
-                if name != '':
-                    self.add_gpu_worker(worker, name)
+        for gpu in ids:
+            worker = "cuda:" + str(gpu)
+            name = gpus.quick_name(gpu)
+            if name == None:
+                # no cheap way to look it up; SD will find out soon enough if it doesn't exist
+                name = "GPU " + str(gpu)
+            if name != '':
+                self.add_gpu_worker(worker, name)
+            else:
+                self.print("unable to initialize device '" + worker + "'; removing it as a GPU candidate...")
+        return 'USE_GPU_DEVICES'
 
 
     # build a list of dummy workers for debugging/testing
@@ -2435,9 +2754,8 @@ class Controller:
             name = ''
             if ':' in worker:
                 if worker.split(':' ,1)[0] == 'cuda':
-                    try:
-                        name = get_device_name(worker)
-                    except AssertionError:
+                    name = gpus.quick_name(int(worker.split(':', 1)[1]))
+                    if name == None or name == '':
                         name = "Dummy GPU Device"
 
             elif worker == 'cpu':
@@ -2454,16 +2772,271 @@ class Controller:
             if ':' in worker["id"]:
                 if worker["id"].split(':' ,1)[0] == 'cuda':
                     # this is a gpu worker
-                    if worker['sdi_instance'].ready and not worker['sdi_instance'].busy:
+                    if worker['sdi_instance'].ready and not worker['sdi_instance'].busy \
+                            and not worker['sdi_instance'].options_change_in_progress:
                         # the worker has been initialized and isn't performing tasks
                         if worker["idle"]:
                             # worker is idle, return it
                             return worker
+        return None
+
 
-        # none of the gpu workers are idle
+    # returns a busy gpu worker with room to take on another job ahead of time if PREFETCH_JOBS
+    # is enabled, otherwise returns None; only for when there's queued work and no idle worker
+    def get_prefetch_gpu_worker(self):
+        if self.config.get('prefetch_jobs') > 0:
+            for worker in self.workers:
+                if worker["id"].startswith('cuda:') and worker['sdi_instance'] != None and worker['sdi_instance'].ready:
+                    # the running job plus up to prefetch_jobs waiting behind it
+                    if not worker["idle"] and len(worker['assigned_jobs']) <= self.config.get('prefetch_jobs'):
+                        return worker
         return None
 
 
+    # returns the model a worker will have loaded once it's through the jobs already assigned to it
+    def expected_model(self, worker):
+        with self.worker_lock:
+            for job in reversed(worker['assigned_jobs']):
+                model = self.job_model(job)
+                if model != '':
+                    return model
+        return worker['sdi_instance'].model_loaded
+
+
+    # returns the model a job will need loaded when it runs
+    # (mirrors the model change logic in Worker.run); '' means any model will do
+    def job_model(self, job):
+        if job.get('mode') == 'process':
+            # process-mode jobs only load a model for SD upscales; it comes from the input image's metadata
+            if job.get('use_upscale') == 'yes' and (job.get('upscale_model') == 'sd' or job.get('upscale_model') == 'ultimate'):
+                if job.get('override_ckpt_file', '') != '':
+                    model = self.validate_model(job.get('override_ckpt_file'))
+                    if model != '':
+                        return model
+                if job.get('original_ckpt_file', '') != '':
+                    return self.validate_model(job.get('original_ckpt_file'))
+            return ''
+        if job.get('ckpt_file') != '':
+            return job.get('ckpt_file')
+        if self.config.get('ckpt_file') != '' and self.default_model_validated:
+            return self.config.get('ckpt_file')
+        return ''
+
+
+    # scores how well a job fits the models an SD instance already has resident:
+    # 2 = main model already loaded (or job doesn't care), +1 if the highres/refiner
+    # model matches what the instance used last (so it's likely still cached by SD)
+    def job_affinity(self, worker, job):
+        sdi = worker['sdi_instance']
+        score = 0
+        model = self.job_model(job)
+        if model == '' or model == self.expected_model(worker):
+            score += 2
+        if job.get('highres_ckpt_file', '') != '' and job.get('highres_ckpt_file') == sdi.last_highres_model:
+            score += 1
+        elif job.get('refiner_ckpt_file', '') != '' and job.get('refiner_ckpt_file') == sdi.last_refiner_model:
+            score += 1
+        return score
+
+
+    # returns the set of models/VAE a job will make SD switch to
+    def job_plan_key(self, job):
+        highres = ''
+        vae = ''
+        if job.get('mode') != 'process':
+            if job.get('highres_fix') == 'yes' and job.get('input_image') == '':
+                highres = job.get('highres_ckpt_file', '')
+            if not (job.get('input_image') == '' and job.get('highres_fix') == 'yes' and job.get('highres_vae', '') != ''):
+                vae = job.get('vae', '')
+        return (self.job_model(job), highres, job.get('refiner_ckpt_file', ''), vae)
+
+
+    # counts how many model/VAE switches running a list of jobs in order would require
+    # jobs that don't specify a model/VAE work with whatever is loaded and never cause a switch
+    def count_model_switches(self, jobs):
+        switches = 0
+        current = ['', '', '', '']
+        for job in jobs:
+            key = self.job_plan_key(job)
+            for i in range(len(key)):
+                if key[i] != '' and key[i] != current[i]:
+                    if current[i] != '':
+                        switches += 1
+                    current[i] = key[i]
+        return switches
+
+
+    # reorders the work queue to minimize model/VAE switches
+    # jobs are grouped by the models/VAE they use (groups are ordered by first appearance),
+    # and the original prompt file order is kept within each group
+    # the planner has to look at every job, so queues larger than queue_planner_max_jobs are left
+    # in prompt file order rather than being generated up front
+    def plan_work_queue(self):
+        if len(self.work_queue) < 2:
+            return
+        if len(self.work_queue) > self.config.get('queue_planner_max_jobs'):
+            self.print("queue planner: " + str(len(self.work_queue)) + " work items exceeds QUEUE_PLANNER_MAX_JOBS; keeping prompt file order.")
+            return
+        groups = {}
+        for job in self.work_queue:
+            key = self.job_plan_key(job)
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(job)
+        if len(groups) < 2:
+            return
+
+        before = self.count_model_switches(self.work_queue)
+        planned = utils.WorkQueue()
+        for key in groups:
+            planned.extend(groups[key])
+        after = self.count_model_switches(planned)
+        if after < before:
+            self.work_queue = planned
+        self.print("queue planner: " + str(before) + " model/VAE switches in prompt file order, " + str(min(before, after)) + " after reordering.")
+
+
+    # removes and returns the next job for the specified worker from the work queue
+    # prefers jobs that fit the worker's currently-loaded model(s) to avoid model swaps;
+    # the job at the head of the queue is never passed over more than dispatch_max_skips times
+    def get_next_job(self, worker):
+        if self.sweep_lanes != None and len(self.work_queue) == 0:
+            return self.get_next_sweep_job(worker)
+
+        if not self.config.get('dispatch_model_affinity') or len(self.work_queue) < 2:
+            return self.work_queue.popleft()
+
+        window = self.work_queue.peek(self.config.get('dispatch_lookahead'))
+        if window[0] is not self.dispatch_head:
+            # a different job is at the head now (the last one was taken, or one was put in front of it)
+            self.dispatch_head = window[0]
+            self.dispatch_head_skips = 0
+        if self.dispatch_head_skips >= self.config.get('dispatch_max_skips'):
+            return self.work_queue.popleft()
+
+        best_index = 0
+        best_score = -1
+        for i in range(len(window)):
+            score = self.job_affinity(worker, window[i])
+            if score > best_score:
+                best_index = i
+                best_score = score
+                if score == 3:
+                    break
+
+        if best_index == 0 or best_score < 2:
+            # only pass over the head job for one that saves a main model swap
+            return self.work_queue.popleft()
+
+        self.dispatch_head_skips += 1
+        job = window[best_index]
+        del self.work_queue[best_index]
+        return job
+
+
+    # removes and returns the next job for the specified worker during a parallel model sweep
+    # workers take work from the lane(s) they're pinned to; once those are empty they help
+    # finish whichever lane has the most work left (preferring one for the model they already have loaded)
+    def get_next_sweep_job(self, worker):
+        loaded = self.expected_model(worker)
+        lane = None
+        pinned = self.sweep_pins.get(worker['id'], [])
+        if loaded in pinned and len(self.sweep_lanes[loaded]) > 0:
+            lane = loaded
+        else:
+            for model in pinned:
+                if len(self.sweep_lanes[model]) > 0:
+                    lane = model
+                    break
+
+        if lane == None:
+            if loaded in self.sweep_lanes and len(self.sweep_lanes[loaded]) > 0:
+                lane = loaded
+            else:
+                for model in self.sweep_lanes:
+                    if lane == None or len(self.sweep_lanes[model]) > len(self.sweep_lanes[lane]):
+                        lane = model
+        return self.sweep_lanes[lane].popleft()
+
+
+    # returns how many jobs are waiting in the work queue
+    def queued_job_count(self):
+        count = len(self.work_queue)
+        if self.sweep_lanes != None:
+            for model in self.sweep_lanes:
+                count += len(self.sweep_lanes[model])
+        return count
+
+
+    # returns how many complete passes through the prompt file's model list(s) have been made
+    def completed_model_cycles(self):
+        if self.sweep_lanes != None:
+            # every loop of a parallel sweep covers all models
+            return self.loops
+        if len(self.models) > 0:
+            # multiple models in queue, only increment for each time we use all of them
+            return math.floor(self.loops / len(self.models))
+        return self.loops
+
+
+    # pins GPU workers to sweep lanes round-robin
+    # with more GPUs than models several GPUs share a model, otherwise each GPU gets several models
+    def assign_sweep_lanes(self):
+        self.sweep_pins = {}
+        lanes = list(self.sweep_lanes.keys())
+        workers = self.workers
+        if len(workers) == 0 or len(lanes) == 0:
+            return
+        if len(workers) >= len(lanes):
+            for i in range(len(workers)):
+                self.sweep_pins[workers[i]['id']] = [lanes[i % len(lanes)]]
+        else:
+            for i in range(len(workers)):
+                self.sweep_pins[workers[i]['id']] = lanes[i::len(workers)]
+
+        for worker in workers:
+            short_names = []
+            for model in self.sweep_pins[worker['id']]:
+                short_names.append(model.split('[', 1)[0].strip())
+            self.print("parallel model sweep: " + worker['id'] + " assigned " + ', '.join(short_names))
+
+
+    # builds the queue for a parallel model sweep: every (model x highres model) pass is
+    # queued at once, split into one lane per main model (or per highres model if only those vary)
+    # lanes are generated lazily; each pass gets its own copy of the config so that embedded
+    # directives neither accumulate across passes nor interfere with each other
+    def init_sweep_work_queue(self):
+        models = list(self.models)
+        highres_models = list(self.highres_models)
+        if len(models) == 0:
+            models = [self.prompt_manager.config.get('ckpt_file')]
+        if len(highres_models) == 0:
+            highres_models = [self.prompt_manager.config.get('highres_ckpt_file')]
+
+        self.sweep_lanes = {}
+        self.sweep_progress = {}
+        total = 0
+        for model in models:
+            for highres_model in highres_models:
+                config = copy.deepcopy(self.prompt_manager.config)
+                config['ckpt_file'] = model
+                config['highres_ckpt_file'] = highres_model
+                lane = model
+                if len(self.models) == 0:
+                    lane = highres_model
+                if lane not in self.sweep_lanes:
+                    self.sweep_lanes[lane] = utils.WorkQueue()
+                    self.sweep_progress[lane] = [0, 0]
+                count = self.prompt_manager.count_combinations(config)
+                jobs = self.prompt_manager.iter_combinations(config, {'sweep_model' : lane})
+                self.sweep_lanes[lane].add_source(jobs, count)
+                self.sweep_progress[lane][1] += count
+                total += count
+
+        self.orig_work_queue_size = total
+        self.assign_sweep_lanes()
+
+
     # returns the current number of working workers
     def num_workers_working(self):
         working = 0
@@ -2473,28 +3046,67 @@ class Controller:
         return working
 
 
-    # start a new worker thread
+    # hand a job to the worker's long-lived thread (started on first use)
     def do_work(self, worker, command):
-        worker['idle'] = False
-        thread = Worker(command, self.work_done_callback, worker, self.output_buffer)
-        thread.start()
+        with self.worker_lock:
+            worker['assigned_jobs'].append(command)
+            worker['idle'] = False
+        if worker.get('thread') == None:
+            worker['thread'] = Worker(self.work_done_callback, worker, self.output_buffer)
+            worker['thread'].start()
+        worker['thread'].submit(command)
 
 
     # callback for worker threads when finished
     def work_done_callback(self, *args):
-        self.jobs_done += 1
-        self.total_jobs_done += 1
-        # args[0] contains worker data; set this worker back to idle
-        args[0]['idle'] = True
+        requeue = args[0].get('thread') != None and args[0]['thread'].requeue
+        # args[0] contains worker data; set this worker back to idle unless it has more jobs lined up
+        with self.worker_lock:
+            if len(args[0]['assigned_jobs']) > 0:
+                job = args[0]['assigned_jobs'].popleft()
+                if requeue:
+                    self.requeue_job(job)
+            args[0]['idle'] = len(args[0]['assigned_jobs']) == 0
         args[0]['work_state'] = ""
-        args[0]['jobs_done'] += 1
+        if not requeue:
+            self.jobs_done += 1
+            self.total_jobs_done += 1
+            args[0]['jobs_done'] += 1
+            if args[0]['job_prompt_info'] != '' and args[0]['job_prompt_info'].get('sweep_model') in self.sweep_progress:
+                self.sweep_progress[args[0]['job_prompt_info'].get('sweep_model')][0] += 1
         args[0]['job_start_time'] = 0
         args[0]['job_prompt_info'] = ''
+        self.notify()
+
+
+    # puts a job that was cut short by an SD restart back at the front of the queue it came from;
+    # job is as it was queued (Worker.prepare_job works on a copy), so it's prepared afresh next time
+    def requeue_job(self, job):
+        job = job.copy()
+        if job.get('prompt') == 'df_gallery_upscale':
+            self.upscale_work_queue.appendleft(job)
+        elif self.sweep_lanes != None and job.get('sweep_model') in self.sweep_lanes:
+            self.sweep_lanes[job.get('sweep_model')].appendleft(job)
+        else:
+            self.work_queue.appendleft(job)
 
 
     def clear_work_queue(self):
         self.print("clearing work queue...")
         self.work_queue.clear()
+        # also drop any jobs that were handed to workers ahead of time but haven't started yet
+        for worker in self.workers:
+            if worker.get('thread') != None:
+                with self.worker_lock:
+                    dropped = worker['thread'].clear_pending()
+                    for i in range(dropped):
+                        worker['assigned_jobs'].pop()
+                    worker['idle'] = len(worker['assigned_jobs']) == 0
+        self.sweep_lanes = None
+        self.sweep_pins = {}
+        self.sweep_progress = {}
+        self.dispatch_head = None
+        self.dispatch_head_skips = 0
         self.loops = 0
         self.jobs_done = 0
         self.orig_work_queue_size = 0
@@ -2503,6 +3115,19 @@ class Controller:
     # build a work queue with the specified prompt and style files
     def init_work_queue(self):
 
+        # parallel multi-model sweep; queue every model at once and spread them across GPUs
+        parallel = self.config.get('multi_model_mode') == 'parallel' and self.prompt_manager.config.get('mode') == 'standard'
+        if parallel and len(self.prompt_manager.embedded_directives() & {'ckpt_file', 'highres_ckpt_file'}) > 0:
+            # models switched by embedded directives aren't known until the queue gets to them
+            parallel = False
+            if self.loops == 0:
+                self.print("parallel model sweep: this prompt file changes models with embedded !CKPT_FILE/!HIGHRES_CKPT_FILE directives; running it sequentially instead.")
+        if parallel and (len(self.models) > 0 or len(self.highres_models) > 0):
+            self.init_sweep_work_queue()
+            self.print("queued " + str(self.queued_job_count()) + " work items across " + str(len(self.sweep_lanes)) + " models.")
+            self.notify()
+            return
+
         # check for a multiple models scenario
         # BK 2023-10-30
         check_main = False
@@ -2535,14 +3160,17 @@ class Controller:
 
         # process mode
         if self.prompt_manager.config.get('mode') == 'process':
-            self.work_queue = self.prompt_manager.build_process_work()
+            self.work_queue = utils.WorkQueue(self.prompt_manager.build_process_work())
             self.orig_work_queue_size = len(self.work_queue)
+            if self.config.get('queue_planner'):
+                self.plan_work_queue()
 
         # random mode; queue up a few random prompts
         elif self.prompt_manager.config.get('mode') == 'random':
+            snapshot = utils.ConfigSnapshot(self.prompt_manager.config)
             for i in range(self.config['random_queue_size']):
                 #work = "Test work item #" + str(i+1)
-                work = self.prompt_manager.config.copy()
+                work = utils.Job(snapshot)
                 work['prompt'] = self.prompt_manager.pick_random()
                 work['prompt_file'] = self.prompt_file
                 self.work_queue.append(work)
@@ -2551,8 +3179,11 @@ class Controller:
         else:
             self.work_queue = self.prompt_manager.build_combinations()
             self.orig_work_queue_size = len(self.work_queue)
+            if self.config.get('queue_planner'):
+                self.plan_work_queue()
 
         self.print("queued " + str(len(self.work_queue)) + " work items.")
+        self.notify()
 
 
     # loads a new prompt file
@@ -2562,6 +3193,7 @@ class Controller:
         if not self.default_model_validated:
             self.print("Waiting for model initialization to finish before loading requested prompt file...")
             opt.prompt_file = new_file
+            self.notify()
         else:
             if self.prompt_file != '':
                 # clean up empty output subdirs on every prompt file switch
@@ -2835,6 +3467,7 @@ class Controller:
                         response = actual_file + " queued for upscaling!"
                         if self.is_paused:
                             self.is_paused = False
+                        self.notify()
                     else:
                         response = actual_file + " is already queued for upscaling!"
                 else:
@@ -3097,12 +3730,156 @@ class Controller:
     def current_active_inits(self):
         active_inits = 0
         for worker in self.workers:
-            if worker['sdi_instance'].init and not worker['sdi_instance'].ready:
+            if worker['sdi_instance'].init and not worker['sdi_instance'].ready and not worker['sdi_instance'].out_of_service:
                 # we started init but it isn't ready, therefore in process of init
                 active_inits += 1
         return active_inits
 
 
+    # notes that the startup step called name has just finished
+    def startup_step(self, name):
+        now = time.time()
+        self.startup_steps.append([name, now - self.startup_mark])
+        self.startup_mark = now
+
+
+    # once every SD instance is up (or has failed) and has told us what it has, prints how long startup
+    # took and where the time went
+    def report_startup(self):
+        if self.startup_reported or not self.sdi_model_request_made or len(self.discovery_futures) > 0:
+            return
+        instances = []
+        for worker in self.workers:
+            sdi = worker['sdi_instance']
+            if sdi.out_of_service:
+                instances.append(worker['id'] + ' failed')
+            elif not sdi.ready:
+                return
+            elif sdi.attached:
+                instances.append(worker['id'] + ' attached')
+            else:
+                instances.append(worker['id'] + ' ' + str(round(sdi.boot_seconds, 1)) + 's')
+        self.startup_reported = True
+
+        steps = []
+        for name, seconds in self.startup_steps:
+            steps.append(name + ' ' + str(round(seconds, 1)) + 's')
+        total = time.time() - psutil.Process().create_time()
+        self.print('startup took ' + str(round(total, 1)) + 's: ' + ' | '.join(steps))
+        self.print('   SD startup: ' + ', '.join(instances) + ' | SD discovery queries: ' + str(round(self.discovery_seconds, 1)) + 's')
+
+
+    # once a batch of work is done, prints how busy each SD instance was kept while it ran (and with
+    # SD_INSTANCES_PER_GPU > 1, each GPU) to help tune SD_INSTANCES_PER_GPU, then starts the clocks over
+    def report_utilization(self):
+        instances = []
+        for worker in self.workers:
+            if worker['sdi_instance'] != None:
+                summary = worker['sdi_instance'].utilization_summary()
+                if summary != '':
+                    instances.append(worker['id'] + ' ' + summary)
+        if len(instances) > 0:
+            self.print('SD utilization during this work: ' + ', '.join(instances))
+        for worker in self.workers:
+            if worker['sdi_instance'] != None:
+                worker['sdi_instance'].busy_time.reset()
+        for busy_time in self.gpu_busy_times.values():
+            busy_time.reset()
+
+
+    # asks SD for everything we need to know about (models, samplers, LoRAs, etc) as soon as any instance
+    # is ready; the queries all go out at once, spread across whichever instances are ready, and each
+    # one's response updates us as it arrives - work can start as soon as the model list is in
+    def start_discovery(self):
+        ready = []
+        for worker in self.workers:
+            if worker['id'].startswith('cuda:') and worker['sdi_instance'].ready and not worker['sdi_instance'].out_of_service:
+                ready.append(worker['sdi_instance'])
+        if len(ready) == 0:
+            return
+
+        # [flag, SDI method]; models first, since that's what everything else waits on
+        queries = [
+            ['sdi_model_request_made', 'get_server_models'],
+            ['sdi_sampler_request_made', 'get_server_samplers'],
+            ['sdi_hypernetwork_request_made', 'get_server_hypernetworks'],
+            ['sdi_lora_request_made', 'get_server_loras'],
+            ['sdi_VAE_request_made', 'get_server_VAEs'],
+            ['sdi_style_request_made', 'get_server_styles'],
+            ['sdi_script_request_made', 'get_server_scripts'],
+            ['sdi_upscaler_request_made', 'get_server_upscalers']
+        ]
+        if self.sdi_controlnet_available:
+            queries.append(['sdi_controlnet_request_made', 'get_server_controlnet_models'])
+            queries.append(['sdi_controlnet_pre_request_made', 'get_server_controlnet_modules'])
+
+        sent = 0
+        for flag, query in queries:
+            if not getattr(self, flag):
+                if self.discovery_started == 0:
+                    self.discovery_started = time.time()
+                setattr(self, flag, True)
+                future = getattr(ready[sent % len(ready)], query)()
+                with self.worker_lock:
+                    self.discovery_futures.append(future)
+                future.add_done_callback(self.discovery_done)
+                sent += 1
+
+
+    # once every discovery query has been answered, saves what SD has available for next time
+    def discovery_done(self, future):
+        with self.worker_lock:
+            futures = self.discovery_futures
+            if len(futures) == 0 or not all(f.done() for f in futures):
+                return
+            self.discovery_futures = []
+        self.discovery_seconds = time.time() - self.discovery_started
+        for f in futures:
+            if f.cancelled() or f.exception() != None:
+                # incomplete; better to have SD asked again next time than to cache it
+                return
+        cached = {}
+        for field in catalog.FIELDS:
+            cached[field] = getattr(self, field)
+        if catalog.save(self.sd_fingerprint, cached):
+            self.print('saved SD catalog to ' + catalog.CATALOG_FILE)
+
+
+    # uses the catalog saved by a previous run if the SD install hasn't changed since (see scripts/catalog.py),
+    # so the web UI and prompt validation have it right away; it's refreshed once an SD instance is up
+    def load_catalog(self):
+        self.sd_fingerprint = catalog.fingerprint(self.config['sd_location'])
+        cached = catalog.load(self.sd_fingerprint)
+        if cached == None:
+            return
+        for field in catalog.FIELDS:
+            if field in cached:
+                setattr(self, field, cached[field])
+        self.update_models(self.sdi_models)
+        if self.sdi_upscalers != None:
+            self.check_default_upscaler()
+        loras = 0
+        if self.sdi_loras != None:
+            loras = len(self.sdi_loras)
+        self.print('using cached SD catalog (' + str(len(self.sdi_models)) + ' models, ' + str(loras) \
+            + ' LoRAs); it will be refreshed once SD is up')
+
+
+    # starts as many not-yet-started SD instances as GPU_INIT_STAGGER allows; this doesn't wait for
+    # them, each GPU's monitor marks it ready (and the main loop gives it work) as soon as it's up
+    def boot_workers(self):
+        if self.boot_limit == 0:
+            self.boot_limit = self.config['gpu_init_stagger']
+            if self.boot_limit == 0:
+                self.boot_limit, reason = auto_boot_limit(self.config['sd_location'])
+                self.print("starting up to " + str(self.boot_limit) + " SD instance(s) at once (" + reason + ")")
+        for worker in self.workers:
+            if not worker['sdi_instance'].init:
+                if self.current_active_inits() >= self.boot_limit:
+                    break
+                worker['sdi_instance'].initialize()
+
+
 # entry point
 if __name__ == '__main__':
 
@@ -3130,14 +3907,18 @@ if __name__ == '__main__':
         control.print("ERROR: unable to initialize any GPUs for work; exiting!")
         exit()
 
+    # the main loop is woken via control.notify() whenever there's something to do;
+    # this is only a safety net for any state change that doesn't signal
+    idle_wakeup_interval = 5
+
     # main work loop
     while not control.work_done:
-        # check for un-initialized workers
-        for worker in control.workers:
-            if not worker['sdi_instance'].init:
-                if control.current_active_inits() < control.config['gpu_init_stagger']:
-                    # init this worker as long as we're not already at the init limit
-                    worker['sdi_instance'].initialize()
+        # start any un-initialized workers we have room for
+        control.boot_workers()
+
+        # find out what SD has available once there's an instance to ask
+        control.start_discovery()
+        control.report_startup()
 
         # do background civitai hash/lookup work
         if not control.civitai_startup_done \
@@ -3166,6 +3947,11 @@ if __name__ == '__main__':
         worker = control.get_idle_gpu_worker()
         skip = False
 
+        if worker == None and not control.is_paused and control.default_model_validated \
+                and (control.queued_job_count() > 0 or len(control.upscale_work_queue) > 0):
+            # everyone's busy, but there's work waiting; line some up behind running jobs (PREFETCH_JOBS)
+            worker = control.get_prefetch_gpu_worker()
+
         if worker != None:
             #if not control.sdi_setup_request_made:
             if not worker['sdi_setup_request_made']:
@@ -3174,77 +3960,6 @@ if __name__ == '__main__':
                 worker['sdi_setup_request_made'] = True
                 skip = True
 
-            if not control.sdi_sampler_request_made:
-                # get available samplers from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_samplers()
-                control.sdi_sampler_request_made = True
-                skip = True
-
-            if not control.sdi_model_request_made:
-                # get available models from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_models()
-                control.sdi_model_request_made = True
-                skip = True
-
-            if not control.sdi_hypernetwork_request_made:
-                # get available hypernetworks from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_hypernetworks()
-                control.sdi_hypernetwork_request_made = True
-                skip = True
-
-            if not control.sdi_lora_request_made:
-                # get available loras from the server
-                # when the first worker is ready
-                #worker['sdi_instance'].update_server_loras()
-                worker['sdi_instance'].get_server_loras()
-                control.sdi_lora_request_made = True
-                skip = True
-
-            if not control.sdi_VAE_request_made:
-                # get available VAEs from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_VAEs()
-                control.sdi_VAE_request_made = True
-                skip = True
-
-            if not control.sdi_style_request_made:
-                # get available styles from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_styles()
-                control.sdi_style_request_made = True
-                skip = True
-
-            if not control.sdi_script_request_made:
-                # get available scripts from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_scripts()
-                control.sdi_script_request_made = True
-                skip = True
-
-            if not control.sdi_upscaler_request_made:
-                # get available upscalers from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_upscalers()
-                control.sdi_upscaler_request_made = True
-                skip = True
-
-            if not control.sdi_controlnet_request_made and control.sdi_controlnet_available:
-                # get available controlnet models from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_controlnet_models()
-                control.sdi_controlnet_request_made = True
-                skip = True
-
-            if not control.sdi_controlnet_pre_request_made and control.sdi_controlnet_available:
-                # get available controlnet modules from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_controlnet_modules()
-                control.sdi_controlnet_pre_request_made = True
-                skip = True
-
             # worker is idle, start some work
             if not control.is_paused and not skip and control.default_model_validated:
                 # load initial prompt file if specified
@@ -3259,9 +3974,9 @@ if __name__ == '__main__':
                     # check for gallery upscale jobs in the queue
                     new_work = control.upscale_work_queue.popleft()
                     control.do_work(worker, new_work)
-                elif len(control.work_queue) > 0:
+                elif control.queued_job_count() > 0:
                     # get a new prompt or setting directive from the queue
-                    new_work = control.work_queue.popleft()
+                    new_work = control.get_next_job(worker)
                     control.do_work(worker, new_work)
                 else:
                     # if we're in random prompts mode, re-fill the queue
@@ -3272,7 +3987,10 @@ if __name__ == '__main__':
                         should_stop = False
                         # check for multiple model scenario, should go through all once
                         if not control.repeat_jobs:
-                            if len(control.models) > 0:
+                            if control.sweep_lanes != None:
+                                # parallel sweeps queue every model at once; all done
+                                should_stop = True
+                            elif len(control.models) > 0:
                                 if control.model_index == len(control.models)-1:
                                     # we've reached the end of the models list
                                     # check that we've also reached the end of the highres list if present
@@ -3301,8 +4019,12 @@ if __name__ == '__main__':
                                 if control.jobs_done > 0:
                                     control.print('No more work in queue; waiting for all workers to finish...')
                                 while control.num_workers_working() > 0:
-                                    time.sleep(.05)
-                                if control.jobs_done > 0:
+                                    control.wait_for_wakeup()
+                                if control.queued_job_count() > 0 or len(control.upscale_work_queue) > 0:
+                                    # the watchdog returned unfinished jobs to the queue; keep going
+                                    control.is_paused = False
+                                elif control.jobs_done > 0:
+                                    control.report_utilization()
                                     control.print('All work done; pausing server - add some more work via the control panel!')
                                 else:
                                     control.print('Startup complete; GPU worker(s) ready - queue some work via the control panel!')
@@ -3312,10 +4034,13 @@ if __name__ == '__main__':
                             control.jobs_done = 0
                             control.init_work_queue()
             else:
-                time.sleep(.1)
+                # nothing we can do until a worker/SD instance changes state,
+                # work is queued, or the user un-pauses
+                control.wait_for_wakeup(idle_wakeup_interval)
 
         else:
-            time.sleep(.05)
+            # no idle workers; sleep until one frees up (or something else happens)
+            control.wait_for_wakeup(idle_wakeup_interval)
 
     print('\nShutting down...')
     if control and control.total_jobs_done > 0:
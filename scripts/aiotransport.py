@@ -0,0 +1,286 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# Optional asyncio transport for SD API requests (SD_TRANSPORT = asyncio). Instead of each request
+# blocking a pooled thread while it waits on SD, every instance's requests run on one event loop;
+# threads are only used to hand responses to the (blocking) SDI callbacks. Requires aiohttp.
+
+import json
+import time
+import asyncio
+import threading
+import concurrent.futures
+import requests
+import scripts.payload as payloads
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# threads that run response callbacks (JSON parsing, image decoding, etc)
+HANDLER_THREADS = 16
+
+# connection attempts made before a request is given up on (the body is always a complete
+# bytes object, so it can simply be sent again; see send() for which failures are retried)
+CONNECT_ATTEMPTS = 4
+
+# idle connections are closed after this many seconds, before SD's server (uvicorn, which closes
+# them after 5) can; a request sent on a connection just as it's being closed can't safely be retried
+KEEPALIVE_SECONDS = 4
+
+transport = None
+transport_lock = threading.Lock()
+
+
+# returns whether the asyncio transport can be used
+def available():
+    return aiohttp != None
+
+
+# returns the process-wide transport, starting it on first use
+def get():
+    global transport
+    with transport_lock:
+        if transport == None:
+            transport = AsyncTransport()
+        return transport
+
+
+# shuts the process-wide transport down, if it was ever started
+def shutdown():
+    global transport
+    with transport_lock:
+        if transport != None:
+            transport.close()
+            transport = None
+
+
+# returns the requests equivalent of an aiohttp error, which is what the SDI callers expect
+def requests_error(e):
+    if isinstance(e, asyncio.TimeoutError):
+        error = requests.exceptions.Timeout(str(e))
+    elif isinstance(e, aiohttp.ClientConnectionError):
+        error = requests.exceptions.ConnectionError(str(e))
+    else:
+        error = requests.exceptions.RequestException(str(e))
+    error.__cause__ = e
+    return error
+
+
+# enough of a requests.Response for the SDI callbacks; generation responses are streamed,
+# everything else is read completely before it's handed over
+class AsyncResponse:
+    def __init__(self, transport, response, content = None):
+        self.transport = transport
+        self.response = response
+        self.status_code = response.status
+        self.reason = response.reason
+        self.url = str(response.url)
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(str(self.status_code) + ' Error: ' + str(self.reason) + ' for url: ' + self.url, response=self)
+
+    # yields the body in chunks; for streamed responses each chunk is read on the event loop
+    # as it's asked for, so only one is held at a time
+    def iter_content(self, chunk_size):
+        if self.content != None:
+            for start in range(0, len(self.content), chunk_size):
+                yield self.content[start:start+chunk_size]
+            return
+        while True:
+            chunk = self.transport.call(self.response.content.read(chunk_size))
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+    # nothing to do: execute() releases the connection on the event loop once the callback is done
+    def close(self):
+        pass
+
+
+class AsyncTransport:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.handlers = concurrent.futures.ThreadPoolExecutor(max_workers=HANDLER_THREADS, thread_name_prefix='sd-handler')
+        self.instances = {}         # SDI: {'session', 'generation', 'control', 'connections'}
+        self.sessions = []          # every session opened, so that close() can close any still open
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run_loop, name='sd-asyncio', daemon=True)
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # schedules coro on the event loop from another thread; returns a concurrent Future
+    def schedule(self, coro):
+        with self.lock:
+            if self.closed:
+                coro.close()
+                raise requests.exceptions.ConnectionError('the asyncio transport has been shut down')
+            return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # runs coro on the event loop from another thread and waits for its result
+    def call(self, coro):
+        try:
+            return self.schedule(coro).result()
+        except concurrent.futures.CancelledError:
+            # close() cancelled it
+            raise requests.exceptions.ConnectionError('the asyncio transport has been shut down')
+
+    # cancels whatever is still pending, closes every session and stops the event loop and the
+    # handler threads; requests made after this fail with a ConnectionError
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.instances = {}
+        asyncio.run_coroutine_threadsafe(self.close_all(), self.loop).result()
+        # callbacks still running may be reading a (now released) response; let them fail first
+        self.handlers.shutdown(wait=True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def close_all(self):
+        tasks = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for session in self.sessions:
+            if not session.closed:
+                await session.close()
+
+    # sets up an SD instance's session and concurrency limits; control_limit is how many of its
+    # control-plane requests (queries, health checks, interrupts) may be in flight at once,
+    # generation and option changes always run one at a time
+    def register(self, sdi, control_limit):
+        self.call(self.open_instance(sdi, control_limit))
+
+    async def open_instance(self, sdi, control_limit):
+        instance = {'session': None, 'generation': asyncio.Semaphore(1), 'control': asyncio.Semaphore(control_limit), 'connections': 0}
+
+        # count new connections for the worker panel's connection reuse stats
+        async def connection_created(session, context, params):
+            instance['connections'] += 1
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(connection_created)
+
+        connector = aiohttp.TCPConnector(limit=control_limit + 1, keepalive_timeout=KEEPALIVE_SECONDS)
+        instance['session'] = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        with self.lock:
+            self.instances[sdi] = instance
+            self.sessions.append(instance['session'])
+
+    # refuses any new requests for an SD instance and closes its session (once pending, a
+    # Future, is done if it's given); requests still in flight at that point fail
+    def unregister(self, sdi, pending = None):
+        with self.lock:
+            instance = self.instances.pop(sdi, None)
+        if instance == None:
+            return
+        def close(*args):
+            try:
+                self.schedule(instance['session'].close())
+            except requests.exceptions.ConnectionError:
+                # the transport was shut down first, which closed the session
+                pass
+        if pending != None:
+            pending.add_done_callback(close)
+        else:
+            close()
+
+    def instance(self, sdi):
+        with self.lock:
+            instance = self.instances.get(sdi)
+        if instance == None:
+            raise RuntimeError('SD instance on ' + sdi.worker_name + ' is not registered with the async transport')
+        return instance
+
+    def connections_opened(self, sdi):
+        with self.lock:
+            instance = self.instances.get(sdi)
+        if instance == None:
+            return 0
+        return instance['connections']
+
+    # queues an SDRequest; returns a concurrent Future (usable from any thread) that resolves to
+    # the request's result; cancelling it while a generation is running interrupts SD
+    def submit(self, request, generation = False):
+        instance = self.instance(request.sdi_ref)
+        return self.schedule(self.execute(request, instance, generation))
+
+    async def execute(self, request, instance, generation):
+        limit = instance['generation'] if generation else instance['control']
+        async with limit:
+            # request bodies (which may include images) are built off the event loop
+            body = None
+            args = request.http_args()
+            if 'json' in args:
+                body = await self.loop.run_in_executor(self.handlers, payloads.encode_payload, args['json'])
+            try:
+                response = await self.send(instance, request.sdi_ref, request.method, request.endpoint, request.kind, body)
+            except asyncio.CancelledError:
+                if generation:
+                    await self.interrupt(instance, request.sdi_ref)
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                return await self.loop.run_in_executor(self.handlers, request.failed, requests_error(e))
+            try:
+                return await self.loop.run_in_executor(self.handlers, request.finish, response)
+            finally:
+                response.response.release()
+
+    # same as an InterruptRequest: tells SD to stop whatever it's generating
+    async def interrupt(self, instance, sdi):
+        try:
+            response = await self.send(instance, sdi, 'POST', '/sdapi/v1/interrupt', 'interrupt', b'{}')
+            response.response.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    # makes an HTTP request to an SD instance from another thread (see SDI.http)
+    # errors are raised as their requests equivalents, which is what callers expect
+    def request(self, sdi, method, endpoint, kind, data = None, headers = None):
+        try:
+            return self.call(self.send(self.instance(sdi), sdi, method, endpoint, kind, data))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise requests_error(e) from e
+
+    # makes an HTTP request to an SD instance; timeouts come from HTTP_TIMEOUTS
+    # body, if given, is sent as JSON
+    async def send(self, instance, sdi, method, endpoint, kind, body = None):
+        session = instance['session']
+        headers = None
+        if body != None:
+            headers = {'Content-Type': 'application/json'}
+        connect, read = sdi.http_timeouts(kind)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+        start = time.time()
+        attempt = 1
+        while True:
+            try:
+                response = await session.request(method, sdi.url + endpoint, data=body, headers=headers, timeout=timeout)
+                break
+            except (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError) as e:
+                # SD may have dropped an idle connection; try again on a fresh one - but a disconnect can
+                # also come after SD got the request, so only GETs (which change nothing) are sent twice
+                if attempt >= CONNECT_ATTEMPTS or (isinstance(e, aiohttp.ServerDisconnectedError) and method != 'GET'):
+                    raise
+                await asyncio.sleep(0.1 * (2 ** (attempt - 1)))
+                attempt += 1
+
+        content = None
+        if kind != 'generate':
+            content = await response.read()
+            response.release()
+        sdi.record_http(kind, time.time() - start)
+        return AsyncResponse(self, response, content)
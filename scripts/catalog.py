@@ -0,0 +1,100 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# On-disk cache of what SD has available (models, samplers, LoRAs, etc), so that a restart can use
+# the last known catalog right away instead of waiting for an SD instance to start up and answer.
+# The catalog is keyed by a fingerprint of the SD install; anything that adds, removes or replaces
+# files under its models/embeddings/extensions directories changes the fingerprint.
+
+import os
+import json
+import hashlib
+
+CATALOG_FILE = os.path.join('cache', 'catalog.json')
+
+# bump whenever what's stored changes
+CATALOG_VERSION = 1
+
+# the Controller attributes that make up the catalog
+FIELDS = [
+    'sdi_models',
+    'sdi_samplers',
+    'sdi_hypernetworks',
+    'sdi_loras',
+    'sdi_VAEs',
+    'sdi_styles',
+    'sdi_upscalers',
+    'sdi_controlnet_models',
+    'sdi_controlnet_preprocessors',
+    'sdi_txt2img_scripts',
+    'sdi_img2img_scripts',
+    'sdi_ultimate_upscale_available',
+    'sdi_adetailer_available'
+]
+
+# [directory under the SD install, how many levels of subdirectories to look at (None = all)];
+# each extension is only checked at the top, they can contain any number of files of their own
+FINGERPRINT_DIRS = [
+    ['models', None],
+    ['embeddings', None],
+    ['extensions', 1]
+]
+
+# individual files that also affect the catalog
+FINGERPRINT_FILES = ['styles.csv']
+
+
+# returns a fingerprint of the SD install at path_to_sd: the mtime and file count of every directory
+# in FINGERPRINT_DIRS (adding, removing or renaming a file updates its directory's mtime)
+def fingerprint(path_to_sd):
+    h = hashlib.sha1()
+    for top, max_depth in FINGERPRINT_DIRS:
+        root = os.path.join(path_to_sd, top)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            relative = os.path.relpath(dirpath, root)
+            depth = 0 if relative == '.' else relative.count(os.sep) + 1
+            if max_depth != None and depth >= max_depth:
+                dirnames[:] = []
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+            h.update((top + '/' + relative + '|' + str(mtime) + '|' + str(len(filenames)) + '\n').encode('utf-8'))
+    for name in FINGERPRINT_FILES:
+        try:
+            stat = os.stat(os.path.join(path_to_sd, name))
+            h.update((name + '|' + str(stat.st_mtime_ns) + '|' + str(stat.st_size) + '\n').encode('utf-8'))
+        except OSError:
+            pass
+    return h.hexdigest()
+
+
+# returns the cached catalog ({field: value}) if there is one for this fingerprint, otherwise None
+def load(fingerprint):
+    try:
+        with open(CATALOG_FILE, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != CATALOG_VERSION or data.get('fingerprint') != fingerprint:
+        return None
+    catalog = data.get('catalog')
+    if not isinstance(catalog, dict) or catalog.get('sdi_models') == None:
+        return None
+    return catalog
+
+
+# saves catalog ({field: value}) for this fingerprint; returns whether it could be written
+def save(fingerprint, catalog):
+    data = {'version': CATALOG_VERSION, 'fingerprint': fingerprint, 'catalog': catalog}
+    temp_file = CATALOG_FILE + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(CATALOG_FILE), exist_ok=True)
+        with open(temp_file, 'w', encoding="utf-8") as f:
+            json.dump(data, f)
+        # replace the old file in one go, so an interrupted write can't leave a broken one behind
+        os.replace(temp_file, CATALOG_FILE)
+    except OSError:
+        return False
+    return True
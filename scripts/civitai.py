@@ -264,6 +264,7 @@ class BackgroundWorker():
         self.control_ref.civitai_startup_stage += 1
         self.control_ref.civitai_new_stage = True
         self.working = False
+        self.control_ref.notify()
 
 
     # do hash calculation work in the background
@@ -282,6 +283,7 @@ class BackgroundWorker():
         self.control_ref.civitai_startup_stage += 1
         self.control_ref.civitai_new_stage = True
         self.working = False
+        self.control_ref.notify()
 
     # for debugging
     def print(self, text, force=False):
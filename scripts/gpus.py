@@ -0,0 +1,125 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# GPU discovery. SD runs in its own processes, so all Dream Factory needs is each GPU's index and
+# name; these come from NVML (the nvidia-ml-py package) if it's installed, or from nvidia-smi, and
+# torch - which takes seconds and hundreds of MB to import - is only used if neither is available.
+# Like torch, devices hidden by CUDA_VISIBLE_DEVICES are left out and the rest are renumbered from 0.
+
+import os
+import re
+import subprocess
+
+# optional, fastest way to query the driver
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+NVIDIA_SMI_TIMEOUT = 15
+
+# "GPU 0: NVIDIA GeForce RTX 3090 (UUID: GPU-xxxxxxxx-...)"
+NVIDIA_SMI_LINE = re.compile(r'^GPU (\d+): (.+?)(?: \(UUID: ([^)]+)\))?$')
+
+
+# returns ([[index, name], ...], source) for the GPUs CUDA will let SD use; the list is empty
+# if none were found (or can't be detected on this system)
+def detect():
+    for source, probe in [['NVML', nvml_devices], ['nvidia-smi', nvidia_smi_devices]]:
+        devices = probe()
+        if devices != None:
+            return visible(devices), source
+    return torch_devices(), 'torch'
+
+
+# for USE_GPU_DEVICES lists, which don't need every GPU enumerated: returns the name of GPU index
+# if NVML can tell us cheaply, '' if NVML says there's no such GPU, or None if NVML isn't available
+def quick_name(index):
+    devices = nvml_devices()
+    if devices == None:
+        return None
+    for device in visible(devices):
+        if device[0] == index:
+            return device[1]
+    return ''
+
+
+# [[index, name, uuid], ...] from NVML, or None if it isn't available
+def nvml_devices():
+    if pynvml == None:
+        return None
+    try:
+        pynvml.nvmlInit()
+    except pynvml.NVMLError:
+        return None
+    try:
+        devices = []
+        for i in range(pynvml.nvmlDeviceGetCount()):
+            handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+            devices.append([i, decode(pynvml.nvmlDeviceGetName(handle)), decode(pynvml.nvmlDeviceGetUUID(handle))])
+        return devices
+    except pynvml.NVMLError:
+        return None
+    finally:
+        try:
+            pynvml.nvmlShutdown()
+        except pynvml.NVMLError:
+            pass
+
+
+# [[index, name, uuid], ...] from nvidia-smi -L, or None if it isn't available
+def nvidia_smi_devices():
+    try:
+        result = subprocess.run(['nvidia-smi', '-L'], capture_output=True, text=True, timeout=NVIDIA_SMI_TIMEOUT)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if result.returncode != 0:
+        return None
+    devices = []
+    for line in result.stdout.splitlines():
+        match = NVIDIA_SMI_LINE.match(line.strip())
+        if match != None:
+            devices.append([int(match.group(1)), match.group(2).strip(), match.group(3) or ''])
+    return devices
+
+
+# [[index, name], ...] from torch (already limited to visible devices)
+def torch_devices():
+    try:
+        from torch.cuda import get_device_name, device_count
+    except ImportError:
+        return []
+    devices = []
+    for i in range(device_count()):
+        try:
+            devices.append([i, get_device_name('cuda:' + str(i))])
+        except AssertionError:
+            pass
+    return devices
+
+
+# applies CUDA_VISIBLE_DEVICES (indexes or UUIDs) to devices; returns [[index, name], ...]
+# numbered the way CUDA will number them
+def visible(devices):
+    setting = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if setting == None:
+        return [[device[0], device[1]] for device in devices]
+    selected = []
+    for entry in setting.split(','):
+        entry = entry.strip()
+        match = None
+        for device in devices:
+            if (entry.isdigit() and int(entry) == device[0]) or (entry != '' and device[2].startswith(entry)):
+                match = device
+                break
+        if match == None:
+            # CUDA ignores everything from the first entry it can't use
+            break
+        selected.append([len(selected), match[1]])
+    return selected
+
+
+def decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return value
@@ -0,0 +1,133 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# Process-wide LRU cache of input images (init & ControlNet images). Prompt files often use the same
+# few images for every job, so their base64 encoding and dimensions are kept here rather than being
+# re-read for each one. Entries are keyed by (path, mtime, size), so an edited file is picked up again.
+
+import os
+import threading
+import binascii
+from collections import OrderedDict
+from PIL import Image
+
+# rough per-entry overhead counted against the budget
+ENTRY_OVERHEAD = 256
+
+
+class ImageCache:
+    def __init__(self, budget = 256 * 1024 * 1024):
+        self.budget = budget
+        self.used = 0
+        self.entries = OrderedDict()    # key -> {'encoded', 'dims', 'cost'}, least recently used first
+        self.keys = {}                  # path -> current key
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def configure(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    # returns the cache key for path, or None if it isn't a readable file
+    def key(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    # returns the cached entry for key (creating an empty one if needed) and marks it most recently used
+    def entry(self, key):
+        entry = self.entries.get(key)
+        if entry == None:
+            # drop whatever we had for an older version of the file
+            old = self.keys.get(key[0])
+            if old != None and old in self.entries:
+                self.used -= self.entries.pop(old)['cost']
+            entry = {'encoded': None, 'dims': None, 'cost': ENTRY_OVERHEAD}
+            self.entries[key] = entry
+            self.keys[key[0]] = key
+            self.used += entry['cost']
+        else:
+            self.entries.move_to_end(key)
+        return entry
+
+    # removes least recently used entries until we're within budget
+    def evict(self):
+        while self.used > self.budget and len(self.entries) > 0:
+            key, entry = self.entries.popitem(last=False)
+            self.used -= entry['cost']
+            if self.keys.get(key[0]) == key:
+                del self.keys[key[0]]
+
+    # returns the image's base64 encoding (bytes, no data URL prefix), or None if it
+    # can't be cached (caching disabled, image too large for the budget, or unreadable)
+    def encoded(self, path):
+        key = self.key(path)
+        if key == None or self.budget <= 0 or 4 * ((key[2] + 2) // 3) + ENTRY_OVERHEAD > self.budget:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry['encoded'] != None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry['encoded']
+            self.misses += 1
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) != key[2]:
+            # changed while we were reading it
+            return None
+        encoded = binascii.b2a_base64(data, newline=False)
+
+        with self.lock:
+            entry = self.entry(key)
+            if entry['encoded'] == None:
+                entry['encoded'] = encoded
+                entry['cost'] += len(encoded)
+                self.used += len(encoded)
+                self.evict()
+        return encoded
+
+    # returns the image's [w, h], or [] if it doesn't exist or isn't a valid image
+    def dimensions(self, path):
+        key = self.key(path)
+        if key == None:
+            return []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry['dims'] != None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(entry['dims'])
+            self.misses += 1
+
+        try:
+            with Image.open(path) as img:
+                dims = list(img.size)
+        except:
+            return []
+
+        if self.budget > 0:
+            with self.lock:
+                self.entry(key)['dims'] = dims
+                self.evict()
+        return list(dims)
+
+    def summary(self):
+        with self.lock:
+            if self.hits + self.misses == 0:
+                return ''
+            return 'image cache: ' + str(self.hits) + ' hits, ' + str(self.misses) + ' misses | ' \
+                + str(len(self.entries)) + ' images, ' + str(round(self.used / (1024 * 1024), 1)) + ' MB of ' \
+                + str(round(self.budget / (1024 * 1024))) + ' MB'
+
+
+# the process-wide cache; sized from IMAGE_CACHE_MB at startup
+cache = ImageCache()
@@ -0,0 +1,137 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# Builds SD API request bodies. Images are put in payloads as PayloadImage references rather than
+# as base64 strings; when the body is built, the rest of the payload is serialized first and each
+# image's base64 is then encoded straight from its file (or bytes) into its place in a body that's
+# allocated at its final size, so a large image is only ever held once in encoded form.
+
+import os
+import re
+import json
+import uuid
+import binascii
+import scripts.imagecache as imagecache
+
+# optional, faster JSON backend
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# bytes of source image read (and encoded) at a time; must be a multiple of 3
+READ_SIZE = 3 * 256 * 1024
+
+DATA_URL_PREFIX = b'data:image/png;base64,'
+
+
+# an image to be sent as a base64 data URL, from either a file or bytes in memory
+# files only used once (e.g. !MODE = process inputs) should pass cache = False
+class PayloadImage:
+    def __init__(self, path = None, data = None, cache = True):
+        self.path = path
+        self.data = data
+        self.cache = cache
+        self.encoded = None     # base64 from the image cache, for files
+        self.resolved = False
+
+    # files are looked up in the image cache (see scripts/imagecache.py) once per body;
+    # ones it won't hold (or that bypass it) are streamed from disk instead
+    def resolve(self):
+        if not self.resolved:
+            if self.path != None and self.data == None and self.cache:
+                self.encoded = imagecache.cache.encoded(self.path)
+            self.resolved = True
+
+    def source_size(self):
+        if self.data != None:
+            return len(self.data)
+        return os.path.getsize(self.path)
+
+    # size of the JSON string the image becomes, quotes included
+    def encoded_size(self):
+        self.resolve()
+        if self.encoded != None:
+            return len(DATA_URL_PREFIX) + len(self.encoded) + 2
+        return len(DATA_URL_PREFIX) + 4 * ((self.source_size() + 2) // 3) + 2
+
+    # encodes the image into body starting at offset; returns the offset after it
+    def write_into(self, body, offset):
+        end = offset + self.encoded_size()
+        body[offset:offset+1] = b'"'
+        offset += 1
+        body[offset:offset+len(DATA_URL_PREFIX)] = DATA_URL_PREFIX
+        offset += len(DATA_URL_PREFIX)
+        if self.encoded != None:
+            body[offset:offset+len(self.encoded)] = self.encoded
+            offset += len(self.encoded)
+        elif self.data != None:
+            view = memoryview(self.data)
+            for start in range(0, len(view), READ_SIZE):
+                offset = write_base64(body, offset, view[start:start+READ_SIZE])
+        else:
+            with open(self.path, 'rb') as f:
+                while True:
+                    chunk = f.read(READ_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    offset = write_base64(body, offset, chunk)
+        body[offset:offset+1] = b'"'
+        offset += 1
+        if offset != end:
+            # the file changed size while it was being read
+            raise ValueError('image ' + str(self.path) + ' changed while it was being encoded')
+        return offset
+
+
+def write_base64(body, offset, chunk):
+    encoded = binascii.b2a_base64(chunk, newline=False)
+    body[offset:offset+len(encoded)] = encoded
+    return offset + len(encoded)
+
+
+# serializes obj to JSON bytes, with orjson if it's installed
+def dumps(obj):
+    if orjson != None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+# swaps the PayloadImages in obj for placeholder strings (noting them in images)
+def replace_images(obj, images, marker):
+    if isinstance(obj, PayloadImage):
+        images.append(obj)
+        return marker + str(len(images) - 1) + marker
+    if isinstance(obj, dict):
+        return {k: replace_images(v, images, marker) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [replace_images(v, images, marker) for v in obj]
+    return obj
+
+
+# builds the request body for payload; returns a bytearray to send as-is
+# (anything that's already a bytes-like body is passed through)
+def encode_payload(payload):
+    if isinstance(payload, (bytes, bytearray)):
+        return payload
+    images = []
+    marker = 'df' + uuid.uuid4().hex
+    text = dumps(replace_images(payload, images, marker))
+    if len(images) == 0:
+        return bytearray(text)
+
+    # split the serialized payload around the (quoted) placeholders
+    parts = re.split(b'"' + marker.encode() + b'(\\d+)' + marker.encode() + b'"', text)
+    size = sum(len(parts[x]) for x in range(0, len(parts), 2))
+    for x in range(1, len(parts), 2):
+        size += images[int(parts[x])].encoded_size()
+
+    body = bytearray(size)
+    offset = 0
+    for x in range(len(parts)):
+        if x % 2 == 0:
+            body[offset:offset+len(parts[x])] = parts[x]
+            offset += len(parts[x])
+        else:
+            offset = images[int(parts[x])].write_into(body, offset)
+    return body
@@ -0,0 +1,180 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# Finalizes generated images (PNG -> JPEG conversion, EXIF & IPTC metadata) in a pool of
+# background processes so that GPU workers can move straight on to their next job.
+
+import io
+import os
+import signal
+import shutil
+import threading
+import multiprocessing
+import concurrent.futures
+import scripts.metadata as metadata
+from os.path import exists
+from collections import deque
+from PIL import Image
+from PIL.PngImagePlugin import PngImageFile
+
+
+# how many finalize tasks may be waiting per pool process before GPU workers are made to wait
+MAX_PENDING_PER_PROCESS = 4
+
+
+# pool process initializer; Ctrl+C is handled by the main process, which lets queued work finish
+def ignore_interrupts():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# converts a finished job's images to JPEGs with metadata and removes the job's staging dir (if it has one)
+# runs in a pool process, so everything it needs is passed in via the task dict
+# returns a list of the output files created and a list of problems to report
+def finalize(task):
+    outputs = []
+    messages = []
+    os.makedirs(task['dest_dir'], exist_ok=True)
+    for file in task['files']:
+        src = file['src']
+        try:
+            if file.get('image') != None:
+                # handed over in memory
+                pngImage = Image.open(io.BytesIO(file['image']))
+            else:
+                src = os.path.join(task['samples_dir'], file['src'])
+                pngImage = PngImageFile(src)
+            im = pngImage.convert('RGB')
+        except:
+            messages.append("unable to read generated image " + src + "!")
+            continue
+
+        exif = None
+        if task['exif_source'] == '':
+            exif = im.getexif()
+            exif[0x9286] = file['meta_prompt']
+            exif[0x9c9c] = file['meta_prompt'].encode('utf16')
+            exif[0x0131] = "https://github.com/rbbrdckybk/dream-factory"
+        else:
+            # process mode; keep the original image's exif data
+            exif = metadata.read_exif(task['exif_source'])
+        exif[0x9c9d] = file['description'].encode('utf16')
+
+        # never overwrite an existing image
+        x = 0
+        newfilename = file['name']
+        while exists(os.path.join(task['dest_dir'], newfilename + ".jpg")):
+            newfilename = file['name'] + '-' + str(x)
+            x += 1
+        output_fn = os.path.join(task['dest_dir'], newfilename + ".jpg")
+
+        try:
+            im.save(output_fn, exif=exif, quality=task['quality'])
+        except:
+            messages.append("OS error when attempting to save output image!")
+            continue
+
+        iptc_append = False
+        if task['exif_source'] != '':
+            # re-attach original iptc info
+            metadata.attach_iptc_info(output_fn, metadata.read_iptc(task['exif_source']))
+            iptc_append = task['iptc_append']
+
+        # add IPTC metadata if necesary
+        iptc = task['iptc']
+        if (iptc['title'] != ''
+                or iptc['description'] != ''
+                or iptc['keywords'] != []
+                or iptc['copyright'] != ''):
+
+            if not iptc_append:
+                metadata.write_iptc_info(output_fn, iptc['title'], iptc['description'], iptc['keywords'], iptc['copyright'])
+            else:
+                metadata.write_iptc_info_append(output_fn, iptc['title'], iptc['description'], iptc['keywords'], iptc['copyright'])
+        outputs.append(output_fn)
+
+    if task['samples_dir'] != '':
+        shutil.rmtree(task['samples_dir'], ignore_errors=True)
+    return outputs, messages
+
+
+# hands finalize tasks to a bounded process pool
+# tasks for the same output directory run one at a time in the order they were submitted, so images
+# show up in the order they were generated and unique filenames can be picked safely
+class PostProcessor:
+    def __init__(self, processes):
+        self.pool = None
+        self.slots = None
+        if processes > 0:
+            # spawn rather than fork; forking a process with this many threads running isn't safe
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes, \
+                mp_context=multiprocessing.get_context('spawn'), initializer=ignore_interrupts)
+            self.slots = threading.BoundedSemaphore(processes * MAX_PENDING_PER_PROCESS)
+        self.lock = threading.Condition()
+        self.waiting = {}           # output dir: deque of tasks waiting on an earlier task for that dir
+        self.outstanding = 0        # tasks submitted but not yet finished
+
+    # queue a task; blocks if too many tasks are already waiting
+    # report is called with any problems encountered
+    def submit(self, task, report):
+        if self.pool == None:
+            # no pool; finalize in the caller's thread
+            self.report(finalize(task)[1], report)
+            return
+
+        self.slots.acquire()
+        with self.lock:
+            self.outstanding += 1
+            if task['dest_dir'] in self.waiting:
+                # an earlier task for this dir is still running; go after it
+                self.waiting[task['dest_dir']].append((task, report))
+                return
+            self.waiting[task['dest_dir']] = deque()
+        self.start(task, report)
+
+    def start(self, task, report):
+        try:
+            future = self.pool.submit(finalize, task)
+        except Exception:
+            # pool is broken or shut down; finalize here instead
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(finalize(task))
+            except Exception as e:
+                future.set_exception(e)
+        future.add_done_callback(lambda f: self.task_done(task, report, f))
+
+    def task_done(self, task, report, future):
+        try:
+            messages = future.result()[1]
+        except Exception as e:
+            messages = ["*** ERROR: unable to finalize images for " + task['dest_dir'] + ": " + str(e)]
+        self.report(messages, report)
+
+        next_task = None
+        with self.lock:
+            if len(self.waiting[task['dest_dir']]) > 0:
+                next_task = self.waiting[task['dest_dir']].popleft()
+            else:
+                del self.waiting[task['dest_dir']]
+            self.outstanding -= 1
+            self.lock.notify_all()
+        self.slots.release()
+        if next_task != None:
+            self.start(next_task[0], next_task[1])
+
+    def report(self, messages, report):
+        for message in messages:
+            report(message)
+
+    # blocks until every submitted task has finished
+    def drain(self):
+        with self.lock:
+            while self.outstanding > 0:
+                self.lock.wait()
+
+    # finish outstanding work and stop the pool
+    def shutdown(self):
+        self.drain()
+        if self.pool != None:
+            self.pool.shutdown()
+            self.pool = None
@@ -3,6 +3,9 @@
 
 import json
 import requests
+import urllib3.connection
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import io
 import base64
 import os
@@ -12,254 +15,557 @@ import time
 import sys
 import signal
 import threading
+import concurrent.futures
+import traceback
 import platform
 import shutil
 import atexit
 import psutil
+import scripts.streamjson as streamjson
+import scripts.payload as payloads
+import scripts.aiotransport as aiotransport
 from os.path import exists
+from collections import deque
 from PIL import Image, PngImagePlugin
 from pprint import pprint
 
 
+# raised (via the returned Future) when an SD request fails
+class SDIError(Exception):
+    def __init__(self, message, status_code = None):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+
+# raised when a request is made to (or completes on) an SD instance that is shutting down
+class SDIShutdown(SDIError):
+    pass
+
+
+# raised when the watchdog gave up on a request (SD hung or died while working on it);
+# the job it was for didn't fail on its own, so it should be run again
+class SDIHung(SDIError):
+    pass
+
+
+# result of a txt2img/img2img/upscale request
+class GenerationResult:
+    def __init__(self, files, seeds, infotexts, images):
+        self.files = files              # full paths of the images that were saved (SAVE_INTERMEDIATE_PNGS only)
+        self.seeds = seeds              # actual seed used for each image
+        self.infotexts = infotexts      # SD generation parameters for each image
+        self.images = images            # GeneratedImage for each image
+        self.peak_bytes = 0             # most memory held at once while reading the response
+
+
+# an image SD returned, kept in memory (decoded from the response as it streamed in)
+# until it's sent back for upscaling or finalized
+class GeneratedImage:
+    def __init__(self, name, data, info):
+        self.name = name                # file name it gets on disk, e.g. seed_1234.png or seed_1234_u.png
+        self.data = data                # PNG bytes exactly as SD encoded them
+        self.info = info                # SD infotext
+        self.path = ''                  # where it was saved, if it has been
+
+    # for sending the image back to SD in a request payload
+    def payload_image(self):
+        return payloads.PayloadImage(data=self.data)
+
+    # writes the image to path as a PNG with its infotext attached
+    def save(self, path):
+        image = Image.open(io.BytesIO(self.data))
+        if image.format == 'PNG' and image.info.get('parameters') == self.info:
+            # SD already attached it; no need to re-encode
+            with open(path, 'wb') as f:
+                f.write(self.data)
+        else:
+            pnginfo = PngImagePlugin.PngInfo()
+            pnginfo.add_text("parameters", self.info)
+            image.save(path, pnginfo=pnginfo)
+        self.path = path
+
+
+# pulls the infotext and seed of each image out of a txt2img/img2img response's 'info' JSON, so
+# they don't have to be recovered by sending every image back to SD's png-info endpoint
+# returns a list with an (infotext, seed) tuple per returned image, or None for images the
+# response has no info for (e.g. ControlNet detected maps appended by the extension)
+def parse_generation_info(r):
+    images = r.get('images') or []
+    parsed = [None] * len(images)
+    try:
+        info = json.loads(r.get('info'))
+    except (TypeError, ValueError):
+        return parsed
+    if not isinstance(info, dict):
+        return parsed
+
+    # infotexts line up with the returned images (including a grid, if SD returned one);
+    # all_seeds only covers the actual images, which start at index_of_first_image
+    infotexts = info.get('infotexts') or []
+    all_seeds = info.get('all_seeds') or []
+    first = info.get('index_of_first_image') or 0
+    for x in range(min(len(images), len(infotexts))):
+        if not isinstance(infotexts[x], str):
+            continue
+        seed = seed_from_info(infotexts[x])
+        if seed == None and 0 <= x - first < len(all_seeds):
+            seed = str(all_seeds[x - first])
+        parsed[x] = (infotexts[x], seed if seed != None else '0')
+    return parsed
+
+
+# rough size of a txt2img/img2img request for the watchdog: megapixels x steps for every image
+# (plus the highres fix pass, if there is one); returns None if payload isn't a dict of settings
+def generation_work(payload):
+    if not isinstance(payload, dict):
+        return None
+    try:
+        images = int(payload.get('n_iter', 1)) * int(payload.get('batch_size', 1))
+        steps = int(payload.get('steps', 20))
+        pixels = int(payload.get('width', 512)) * int(payload.get('height', 512))
+        work = pixels * steps
+        if payload.get('enable_hr'):
+            hr_steps = int(payload.get('hr_second_pass_steps') or steps)
+            hr_scale = float(payload.get('hr_scale') or 2)
+            hr_pixels = int(payload.get('hr_resize_x') or 0) * int(payload.get('hr_resize_y') or 0)
+            if hr_pixels == 0:
+                hr_pixels = pixels * hr_scale * hr_scale
+            work += hr_pixels * hr_steps
+    except (TypeError, ValueError):
+        return None
+    return images * work / 1000000
+
+
+# formats a byte count for display
+def format_mb(size):
+    return str(round(size / (1024 * 1024), 1)) + ' MB'
+
+
+# returns the seed from an SD infotext ("..., Seed: 1234, ..."), or None if it doesn't have one
+def seed_from_info(info):
+    if 'Seed:' in info:
+        temp = info.split('Seed:', 1)
+        temp = temp[1].split(',', 1)
+        return temp[0].strip()
+    return None
+
+
+# returns whether path is on a spinning disk (only detectable on Linux)
+def on_rotational_disk(path):
+    if platform.system().lower() != 'linux':
+        return False
+    try:
+        dev = os.stat(path).st_dev
+        device_path = os.path.realpath('/sys/dev/block/' + str(os.major(dev)) + ':' + str(os.minor(dev)))
+        # partitions don't have their own queue settings; their disk (the parent) does
+        for d in [device_path, os.path.dirname(device_path)]:
+            rotational = os.path.join(d, 'queue', 'rotational')
+            if exists(rotational):
+                with open(rotational) as f:
+                    return f.read().strip() == '1'
+    except OSError:
+        pass
+    return False
+
+
+# works out how many SD instances can start up at once (GPU_INIT_STAGGER = auto): as many as there's
+# free system RAM for, but only one at a time if SD is on a spinning disk, where concurrent model
+# loads just fight over the drive; returns (limit, reason)
+def auto_boot_limit(path_to_sd):
+    if on_rotational_disk(path_to_sd):
+        return 1, 'SD is on a rotational disk'
+    available = psutil.virtual_memory().available
+    limit = max(1, int(available // BOOT_RAM_PER_INSTANCE))
+    return limit, str(round(available / (1024 * 1024 * 1024), 1)) + ' GB of system RAM free'
+
+
+# shared, bounded pool for control-plane requests (discovery queries, health checks, interrupts)
+# so that the number of threads stays fixed regardless of how many requests are made; big enough
+# for all of the startup discovery queries to go out at once
+CONTROL_POOL_SIZE = 12
+control_pool = concurrent.futures.ThreadPoolExecutor(max_workers=CONTROL_POOL_SIZE, thread_name_prefix='sd-control')
+
+# each SD instance keeps this many keep-alive connections: enough for every control-plane request
+# plus the instance's own generation/options request to be in flight at once
+HTTP_POOL_SIZE = CONTROL_POOL_SIZE + 1
+
+# (connect, read) timeouts in seconds for each kind of request; generation can legitimately take
+# a very long time (big upscales, slow GPUs) so it only gets a connect timeout
+HTTP_TIMEOUTS = {
+    'generate' : (10, None),
+    'options' : (10, 900),          # includes model loads
+    'query' : (10, 120),
+    'png_info' : (10, 60),
+    'interrupt' : (5, 30),
+    'alive' : (5, 30),
+    'progress' : (5, 10)
+}
+
+# requests that count towards the latency shown in the worker panel (generation time isn't latency)
+HTTP_LATENCY_KINDS = ['query', 'png_info', 'interrupt', 'alive', 'progress']
+
+# a starting SD instance is ready for work once this answers; its API routes are only added once
+# the web UI has finished loading, so an answer here means everything else is up too
+READY_ENDPOINT = '/sdapi/v1/samplers'
+# seconds between readiness probes while SD starts up; doubles after each miss up to BOOT_PROBE_MAX
+BOOT_PROBE_MIN = 0.25
+BOOT_PROBE_MAX = 4
+# system RAM an SD instance needs while it starts up (see GPU_INIT_STAGGER = auto)
+BOOT_RAM_PER_INSTANCE = 10 * 1024 * 1024 * 1024
+
+# while a generation request is running, SD's progress is polled this often (seconds)
+PROGRESS_INTERVAL = 2
+# number of it/s samples kept per GPU (at PROGRESS_INTERVAL, about 5 minutes of generation)
+PROGRESS_HISTORY = 150
+
+# hung-request watchdog (see WATCHDOG_TIMEOUT): a generation request is considered hung once it has
+# run for WATCHDOG_FACTOR times as long as its size suggests it should (but never less than
+# WATCHDOG_TIMEOUT seconds); SD is sent an interrupt, and if it hasn't responded WATCHDOG_GRACE
+# seconds later (or if its process dies) it's restarted, at most WATCHDOG_MAX_RESTARTS times
+WATCHDOG_FACTOR = 4
+WATCHDOG_GRACE = 60
+WATCHDOG_MAX_RESTARTS = 5
+WATCHDOG_INTERVAL = 5
+
+# each SD instance we launch is recorded in a pidfile here, so that a later run can attach to it
+# (SD_ATTACH) or shut it down if it was left running
+PIDFILE_DIR = 'cache'
+
+
+# an HTTPAdapter that counts the connections it opens, for the worker panel's connection reuse stats
+class CountingAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        self.count_lock = threading.Lock()
+        self.connections_opened = 0
+        HTTPAdapter.__init__(self, *args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        adapter = self
+
+        class CountingConnection(urllib3.connection.HTTPConnection):
+            def connect(self):
+                adapter.count_connection()
+                return urllib3.connection.HTTPConnection.connect(self)
+
+        class CountingConnectionPool(urllib3.HTTPConnectionPool):
+            ConnectionCls = CountingConnection
+
+        # SD instances are only ever reached over plain http
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme, http=CountingConnectionPool)
+
+    def count_connection(self):
+        with self.count_lock:
+            self.connections_opened += 1
+
+
+# base class for SD API requests; runs on a pooled thread instead of creating a new thread per request
+# (or on the event loop, with SD_TRANSPORT = asyncio; see scripts/aiotransport.py)
+# subclasses set the endpoint they call; the response is passed to handle(), which runs the callback
+class SDRequest:
+    method = 'GET'
+    endpoint = ''
+    kind = 'query'
+    payload = None
+    hung = False        # set by the watchdog
+
+    def __init__(self):
+        self.future = None
+
+    # the executor this request runs on
+    def executor(self):
+        return control_pool
+
+    # queues the request; returns a Future that resolves to whatever the request's callback returns
+    def start(self):
+        if self.sdi_ref.transport != None:
+            self.future = self.sdi_ref.transport.submit(self, isinstance(self, InstanceRequest))
+        else:
+            self.future = self.executor().submit(self.execute)
+        self.future.add_done_callback(self.report_error)
+        return self.future
+
+    def execute(self):
+        try:
+            return self.run()
+        except requests.exceptions.RequestException as e:
+            return self.failed(e)
+
+    def run(self):
+        return self.finish(self.sdi_ref.http(self.method, self.endpoint, self.kind, **self.http_args()))
+
+    def http_args(self):
+        if self.payload == None:
+            return {}
+        return {'json': self.payload}
+
+    # handles the response, unless the watchdog has given up on this request
+    def finish(self, response):
+        if self.hung:
+            response.close()
+            raise SDIHung(type(self).__name__ + " was interrupted by the watchdog")
+        return self.handle(response)
+
+    def handle(self, response):
+        return self.callback(response)
+
+    # called instead of handle() if the request couldn't be made
+    def failed(self, e):
+        # only a request that couldn't reach SD (or got no answer) may mean that it died; other
+        # errors (an error status, a bad response) don't need the time it takes to check
+        lost = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+        if self.hung:
+            raise SDIHung(type(self).__name__ + " was interrupted by the watchdog") from e
+        if lost and isinstance(self, InstanceRequest) and self.sdi_ref.process_died():
+            if self.sdi_ref.process.returncode == -signal.SIGINT:
+                # Ctrl+C reaches SD too; we're shutting down, there's nothing to run again
+                raise SDIShutdown('SD instance on ' + self.sdi_ref.worker_name + ' is shutting down') from e
+            raise SDIHung(type(self).__name__ + " was interrupted by the watchdog") from e
+        self.sdi_ref.log("*** Error: " + type(self).__name__ + " failed: " + str(e), True)
+        raise SDIError(type(self).__name__ + " failed: " + str(e)) from e
+
+    # pooled threads swallow exceptions, so make sure unexpected ones are seen
+    def report_error(self, future):
+        if not future.cancelled():
+            e = future.exception()
+            if e != None and not isinstance(e, SDIError):
+                self.sdi_ref.log("*** ERROR: " + type(self).__name__ + " failed:\n" \
+                    + ''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+
+# requests that change the state of a single SD instance (generation, option changes) run
+# one at a time on that instance's own executor
+class InstanceRequest(SDRequest):
+    def executor(self):
+        return self.sdi_ref.request_executor
+
+
 # for making txt2img requests
-class Txt2ImgRequest(threading.Thread):
+class Txt2ImgRequest(InstanceRequest):
+    method = 'POST'
+    endpoint = '/sdapi/v1/txt2img'
+    kind = 'generate'
+
     def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
         self.payload = payload
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/txt2img', json=self.payload)
-        self.callback(response)
-
 
 # for making img2img requests
-class Img2ImgRequest(threading.Thread):
+class Img2ImgRequest(InstanceRequest):
+    method = 'POST'
+    endpoint = '/sdapi/v1/img2img'
+    kind = 'generate'
+
     def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
         self.payload = payload
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/img2img', json=self.payload)
-        self.callback(response)
-
 
 # for making ControlNet txt2img requests
-class ControlNet_Txt2ImgRequest(threading.Thread):
+class ControlNet_Txt2ImgRequest(InstanceRequest):
+    method = 'POST'
+    endpoint = '/controlnet/txt2img'
+    kind = 'generate'
+
     def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
         self.payload = payload
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/controlnet/txt2img', json=self.payload)
-        self.callback(response)
-
 
 # for making ControlNet img2img requests
-class ControlNet_Img2ImgRequest(threading.Thread):
+class ControlNet_Img2ImgRequest(InstanceRequest):
+    method = 'POST'
+    endpoint = '/controlnet/img2img'
+    kind = 'generate'
+
     def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
         self.payload = payload
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/controlnet/img2img', json=self.payload)
-        self.callback(response)
-
 
 # for making upscale requests
-class UpscaleRequest(threading.Thread):
+class UpscaleRequest(InstanceRequest):
+    method = 'POST'
+    endpoint = '/sdapi/v1/extra-single-image'
+    kind = 'generate'
+
     def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
         self.payload = payload
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/extra-single-image', json=self.payload)
-        self.callback(response)
-
 
 # for fetching valid samplers
-class GetSamplersRequest(threading.Thread):
+class GetSamplersRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/sdapi/v1/samplers'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/samplers')
-        self.callback(response)
-
 
 # for fetching valid model checkpoints
-class GetModelsRequest(threading.Thread):
+class GetModelsRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/sdapi/v1/sd-models'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/sd-models')
-        self.callback(response)
-
 
 # for fetching hypernetworks
-class GetHyperNetworksRequest(threading.Thread):
+class GetHyperNetworksRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/sdapi/v1/hypernetworks'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/hypernetworks')
-        self.callback(response)
-
 
 # for fetching styles
-class GetStylesRequest(threading.Thread):
+class GetStylesRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/sdapi/v1/prompt-styles'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/prompt-styles')
-        self.callback(response)
-
 
 # for fetching VAEs
-class GetVAEsRequest(threading.Thread):
+class GetVAEsRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/sdapi/v1/sd-vae'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/sd-vae')
-        self.callback(response)
-
 
 # for fetching loras
-class GetLorasRequest(threading.Thread):
+class GetLorasRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/sdapi/v1/loras'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/loras')
-        self.callback(response)
-
 
 # for updating loras
-class LoraRefreshRequest(threading.Thread):
+class LoraRefreshRequest(SDRequest):
+    method = 'POST'
+    endpoint = '/sdapi/v1/refresh-loras'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/refresh-loras')
-        self.callback(response)
-
 
 # for fetching scripts
-class GetScriptsRequest(threading.Thread):
+class GetScriptsRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/sdapi/v1/scripts'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/scripts')
-        self.callback(response)
-
 
 # for fetching upscalers
-class GetUpscalersRequest(threading.Thread):
+class GetUpscalersRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/sdapi/v1/upscalers'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/upscalers')
-        self.callback(response)
-
 
 # for fetching ControlNet models
-class ControlNet_GetModelsRequest(threading.Thread):
+class ControlNet_GetModelsRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/controlnet/model_list'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/controlnet/model_list')
-        self.callback(response)
-
 
 # for fetching ControlNet modules
-class ControlNet_GetModulesRequest(threading.Thread):
+class ControlNet_GetModulesRequest(SDRequest):
+    method = 'GET'
+    endpoint = '/controlnet/module_list'
+    kind = 'query'
+
     def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
 
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/controlnet/module_list')
-        self.callback(response)
-
 
 # for changing server options, including model swaps
-class SetOptionsRequest(threading.Thread):
+class SetOptionsRequest(InstanceRequest):
+    method = 'POST'
+    endpoint = '/sdapi/v1/options'
+    kind = 'options'
+
     def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
         self.callback = callback
         self.payload = payload
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/options', json=self.payload)
-        self.callback(response, self.payload)
+    def handle(self, response):
+        return self.callback(response, self.payload)
 
 
 # for fetching valid model checkpoints
-class InterruptRequest(threading.Thread):
-    def __init__(self, sdi_ref, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/interrupt', json={})
-
+class InterruptRequest(SDRequest):
+    method = 'POST'
+    endpoint = '/sdapi/v1/interrupt'
+    kind = 'interrupt'
 
-# for checking if the server is alive / ready for requests
-class AliveRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+    def __init__(self, sdi_ref, *args):
+        SDRequest.__init__(self)
         self.sdi_ref = sdi_ref
-        self.callback = callback
+        self.payload = {}
 
-    def run(self):
-        response_code = self.check_alive()
-        self.callback(response_code)
-
-    def check_alive(self):
-        code = -1
-        try:
-            response = requests.get(self.sdi_ref.url + '/docs', timeout = 300)
-            code = response.status_code
-        except:
-            code = 999
-        return code
+    def handle(self, response):
+        pass
 
 
 # for monitoring SD server status
@@ -273,117 +579,703 @@ class Monitor(threading.Thread):
     def run(self):
         #print("Monitor for GPU " + str(self.sdi_ref.gpu_id) + " starting!")
         self.sdi_ref.log("waiting for SD instance to be ready...", True)
-        alive_check = AliveRequest(self.sdi_ref, self.alive_check_callback)
-        alive_check.start()
+        probe_delay = BOOT_PROBE_MIN
 
         while self.sdi_ref.isRunning:
-            # monitor progress here
-            time.sleep(1)
+            booting = not self.sdi_ref.ready and not self.sdi_ref.out_of_service
+            if booting:
+                # probe until SD answers, backing off while it's still loading
+                if self.sdi_ref.probe_ready():
+                    probe_delay = BOOT_PROBE_MIN
+                    continue
+                delay = probe_delay
+                probe_delay = min(probe_delay * 2, BOOT_PROBE_MAX)
+            elif self.sdi_ref.watched != None:
+                delay = PROGRESS_INTERVAL
+            else:
+                delay = WATCHDOG_INTERVAL
+
+            with self.sdi_ref.state_change:
+                if self.sdi_ref.isRunning:
+                    self.sdi_ref.state_change.wait(delay)
+            if self.sdi_ref.isRunning:
+                # monitor progress here
+                if self.sdi_ref.watched != None and time.time() - self.sdi_ref.progress_polled >= PROGRESS_INTERVAL:
+                    self.sdi_ref.poll_progress()
+                self.sdi_ref.check_watchdog()
         self.callback()
 
-    # callback for alive check; whether or not server is ready for requests
-    def alive_check_callback(self, response_code):
-        #self.sdi_ref.log(str(response_code))
-        if response_code == 200:
-            self.sdi_ref.ready = True
-            self.sdi_ref.log("SD instance finished initialization; ready for work!")
-        else:
-            # not ready yet; check again
-            time.sleep(0.25)
-            alive_check = AliveRequest(self.sdi_ref, self.alive_check_callback)
-            alive_check.start()
+
+# stands in for the Popen of an SD instance we attached to rather than launched (see SD_ATTACH)
+class AttachedProcess:
+    def __init__(self, pid):
+        self.pid = pid
+        self.process = psutil.Process(pid)
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode == None:
+            try:
+                running = self.process.is_running() and self.process.status() != psutil.STATUS_ZOMBIE
+            except psutil.Error:
+                running = False
+            if not running:
+                # it isn't our child, so there's no way to get its real exit code
+                self.returncode = 1
+        return self.returncode
+
+    def wait(self, timeout = None):
+        try:
+            self.process.wait(timeout)
+        except psutil.TimeoutExpired:
+            raise subprocess.TimeoutExpired('SD (pid ' + str(self.pid) + ')', timeout)
+        except psutil.Error:
+            pass
+        return self.poll()
+
+
+# keeps track of how much of the time something (an SD instance, or all the instances on one GPU)
+# had at least one request outstanding; the clock starts with the first generation request after
+# a reset, so time spent sitting around with nothing queued doesn't count against it
+class BusyTime:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0             # requests outstanding right now
+        self.since = 0              # when the current busy stretch started
+        self.busy_seconds = 0       # total of the finished busy stretches (since the clock started)
+        self.started = None         # when the clock started (None = not since the last reset)
+
+    def start(self, starts_clock = False):
+        with self.lock:
+            now = time.time()
+            if self.started == None and starts_clock:
+                self.started = now
+            if self.active == 0:
+                self.since = now
+            self.active += 1
+
+    def stop(self):
+        with self.lock:
+            self.active -= 1
+            if self.active == 0 and self.started != None:
+                self.busy_seconds += time.time() - max(self.since, self.started)
+
+    # fraction (0-1) of the time since the clock started that there was something outstanding,
+    # or None if the clock hasn't started since the last reset
+    def fraction(self):
+        with self.lock:
+            if self.started == None:
+                return None
+            now = time.time()
+            busy = self.busy_seconds
+            if self.active > 0:
+                busy += now - max(self.since, self.started)
+            if now - self.started <= 0:
+                return 1.0
+            return min(busy / (now - self.started), 1.0)
+
+    def reset(self):
+        with self.lock:
+            self.busy_seconds = 0
+            self.started = None
 
 
 # Stable Diffusion Interface
 # manages the relationship between a GPU and an SD instance
 class SDI:
-    def __init__(self, gpu_id, port, path_to_sd, control_ref, worker_name):
+    # instance is which of the SD instances on this GPU this is (see SD_INSTANCES_PER_GPU), from 1
+    def __init__(self, gpu_id, port, path_to_sd, control_ref, worker_name, instance = 1):
         os.makedirs('logs', exist_ok=True)
 
         self.control_ref = control_ref
+        self.state_change = threading.Condition()   # signalled whenever ready/busy/options_change_in_progress change
         self.worker_name = worker_name
         self.gpu_id = gpu_id
+        self.instance = instance
+        # names this instance's files; the first instance on each GPU keeps the names it's always had
+        self.instance_name = str(gpu_id)
+        if instance > 1:
+            self.instance_name += '-' + str(instance)
         self.platform = platform.system().lower()
         self.path_to_sd = path_to_sd
         self.command = 'webui-user.bat'
-        self.target_command = 'df-start-gpu-' + str(gpu_id) + '.bat'
+        self.target_command = 'df-start-gpu-' + self.instance_name + '.bat'
         self.sd_port = port
         self.url = 'http://localhost:' + str(self.sd_port)
         self.isRunning = True
-        self.logfilename = os.path.join('logs', 'gpu-' + str(self.gpu_id) + '-log.txt')
-        self.errorfilename = os.path.join('logs', 'gpu-' + str(self.gpu_id) + '-errors.txt')
-        self.logfile = open(self.logfilename, 'w')
-        self.errorfile = open(self.errorfilename, 'w')
+        self.logfilename = os.path.join('logs', 'gpu-' + self.instance_name + '-log.txt')
+        self.errorfilename = os.path.join('logs', 'gpu-' + self.instance_name + '-errors.txt')
+        # an instance we attach to keeps writing to the logs it was started with, so don't truncate them
+        log_mode = 'a' if control_ref.config.get('sd_attach') else 'w'
+        self.logfile = open(self.logfilename, log_mode)
+        self.errorfile = open(self.errorfilename, log_mode)
+        self.request_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sd-gpu-' + self.instance_name)
+        self.http_lock = threading.Lock()
+        self.http_stats = {}        # request kind: [requests made, total seconds]
+        self.response_peaks = [0, 0]    # peak bytes held reading generation responses: [last, max]
+        self.session = self.create_session()
+        self.transport = None       # the shared asyncio transport, if SD_TRANSPORT = asyncio
+        if control_ref.config.get('sd_transport') == 'asyncio':
+            self.transport = aiotransport.get()
+            self.transport.register(self, CONTROL_POOL_SIZE)
         self.monitor = None
         self.process = None
         self.init = False           # has init() been run?
         self.ready = False          # is our associated server ready (e.g. has init() finished)?
-        self.busy = False           # is this instance in the process of making a request?
-        self.status = ''            # TODO fill in % done here
+        self.requests_in_flight = 0 # number of requests this instance has outstanding
+        self.status = ''            # % done of the running generation request
+        self.progress = None        # progress of the running generation request: {'step', 'steps', 'percent', 'eta', 'its'}
+        self.its_history = deque(maxlen=PROGRESS_HISTORY)  # [time, it/s] samples
+        self.progress_polled = 0    # when progress was last polled
+        self.progress_last = None   # (time, job, step) as of the last poll, for working out it/s
         self.request_count = 0
         self.output_dir = ''
-        self.options_change_in_progress = False
+        self.options_in_flight = 0  # number of outstanding options changes/model loads
         self.model_loaded = ''
         self.model_loading_now = ''
-        self.last_job_success = True
+        self.last_highres_model = ''    # highres/refiner models used by the last job; SD keeps these cached
+        self.last_refiner_model = ''
+        self.watched = None         # generation request the watchdog is timing: {'request', 'started', 'work', 'deadline', 'interrupted'}
+        self.seconds_per_work = 0   # how long this instance takes per unit of generation_work(), once known
+        self.restarts = 0           # times the watchdog has restarted SD
+        self.out_of_service = False # the watchdog gave up on this instance
+        self.boot_started = 0       # when our SD process was (last) launched
+        self.boot_seconds = 0       # how long SD took to become ready, last time it started
+        self.pidfile = os.path.join(PIDFILE_DIR, 'sd-instance-' + str(port) + '.json')
+        self.detached = False       # left running at exit (SD_DETACH_ON_EXIT)
+        self.attached = False       # adopted an already-running instance (SD_ATTACH)
+        self.busy_time = BusyTime() # how busy this instance is kept
+        # ...and the GPU it's on, shared with any other instances on the same GPU
+        self.gpu_busy_time = control_ref.gpu_busy_times.setdefault(str(gpu_id), BusyTime())
 
         if self.platform == 'linux':
             self.command = 'webui-user.sh'
-            self.target_command = 'df-start-gpu-' + str(gpu_id) + '.sh'
+            self.target_command = 'df-start-gpu-' + self.instance_name + '.sh'
+
+    # ready is a property so that anyone waiting on it (the controller's main work loop) is
+    # woken up immediately when it changes instead of having to poll; busy and
+    # options_change_in_progress are derived from the requests this instance has outstanding
+    @property
+    def ready(self):
+        return self._ready
+
+    @ready.setter
+    def ready(self, value):
+        self.set_state('_ready', value)
+
+    @property
+    def busy(self):
+        return self.requests_in_flight > 0
+
+    @property
+    def options_change_in_progress(self):
+        return self.options_in_flight > 0
+
+    # updates a state flag and wakes up anything waiting on this instance
+    def set_state(self, name, value):
+        with self.state_change:
+            setattr(self, name, value)
+            self.state_change.notify_all()
+        self.control_ref.notify()
+
+    # adjusts the outstanding request counts and wakes up anything waiting on this instance
+    # (and how busy this instance and its GPU are being kept; generation requests start that clock)
+    def track_request(self, delta, options_change = False, generation = False):
+        if delta > 0:
+            self.busy_time.start(generation)
+            self.gpu_busy_time.start(generation)
+        elif delta < 0:
+            self.busy_time.stop()
+            self.gpu_busy_time.stop()
+        with self.state_change:
+            self.requests_in_flight += delta
+            if options_change:
+                self.options_in_flight += delta
+            self.state_change.notify_all()
+        self.control_ref.notify()
+
+    # starts a request on behalf of this instance and tracks it until it finishes;
+    # returns a Future that resolves to the request's result or raises SDIError
+    # work is the size of a generation request (see generation_work()), for the watchdog
+    def submit(self, request, options_change = False, work = None):
+        # queries run on the shared control pool alongside whatever this instance is doing, so they
+        # don't make it busy (its worker can start generating while startup discovery is still going);
+        # they still wake up anything waiting when they finish
+        delta = 0 if request.kind == 'query' else 1
+        self.track_request(delta, options_change, request.kind == 'generate')
+        if request.kind == 'generate':
+            # workers wait for each generation request before making the next, so it starts right away
+            self.watch(request, work)
+        try:
+            future = request.start()
+        except RuntimeError:
+            # executor has already been shut down
+            self.unwatch(request, None)
+            self.track_request(-delta, options_change)
+            raise SDIShutdown('SD instance on ' + self.worker_name + ' is shutting down')
+        future.add_done_callback(lambda f: self.unwatch(request, f))
+        future.add_done_callback(lambda f: self.track_request(-delta, options_change))
+        return future
+
+    # blocks until this instance is ready for work; returns False if it never will be
+    # (the watchdog has taken it out of service, or we're shutting down)
+    def wait_until_ready(self):
+        with self.state_change:
+            while not self.ready and self.isRunning and not self.out_of_service:
+                self.state_change.wait()
+            return self.ready and not self.out_of_service
+
+    # starts timing a generation request for the watchdog
+    def watch(self, request, work):
+        timeout = self.control_ref.config.get('watchdog_timeout', 0)
+        deadline = timeout * WATCHDOG_FACTOR
+        if work != None and self.seconds_per_work > 0:
+            deadline = max(timeout, self.seconds_per_work * work * WATCHDOG_FACTOR)
+        with self.state_change:
+            self.watched = {'request': request, 'started': time.time(), 'work': work, 'deadline': deadline, 'interrupted': 0}
+
+    # stops timing a finished request; successful ones tell us how fast this instance is
+    def unwatch(self, request, future):
+        with self.state_change:
+            watched = self.watched
+            if watched == None or watched['request'] != request:
+                return
+            self.watched = None
+        with self.http_lock:
+            self.progress = None
+            self.progress_last = None
+            self.status = ''
+        if future != None and not future.cancelled() and future.exception() == None and watched['work'] != None and watched['work'] > 0:
+            rate = (time.time() - watched['started']) / watched['work']
+            if self.seconds_per_work == 0:
+                self.seconds_per_work = rate
+            else:
+                self.seconds_per_work = (self.seconds_per_work * 0.7) + (rate * 0.3)
 
-    #waits for SD APIs to be ready and returning expected information
-    def wait_for_server(self, url, api_endpoint, timeout=300):
-        start_time = time.time()
+    # asks SD how far along the running generation request is (called by the monitor); this goes
+    # over its own connection and SD answers it without waiting on the GPU
+    def poll_progress(self):
+        self.progress_polled = time.time()
+        try:
+            response = self.http('GET', '/sdapi/v1/progress?skip_current_image=true', 'progress')
+            r = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            return
+        if not isinstance(r, dict) or self.watched == None:
+            return
+
+        now = time.time()
+        state = r.get('state') or {}
+        step = int(state.get('sampling_step') or 0)
+        steps = int(state.get('sampling_steps') or 0)
+        job = (state.get('job_timestamp'), state.get('job_no'))
+        its = 0
+        with self.http_lock:
+            # sampling speed since the last poll, as long as we're still on the same job
+            last = self.progress_last
+            if last != None and last[1] == job and step > last[2] and now > last[0]:
+                its = (step - last[2]) / (now - last[0])
+                self.its_history.append([round(now), round(its, 2)])
+            elif self.progress != None:
+                its = self.progress['its']
+            self.progress_last = (now, job, step)
+            self.progress = {
+                'step': step,
+                'steps': steps,
+                'percent': round(float(r.get('progress') or 0) * 100),
+                'eta': float(r.get('eta_relative') or 0),
+                'its': its
+            }
+            self.status = str(self.progress['percent']) + '%'
+
+    # short summary of the running generation's progress for the web UI
+    def progress_summary(self):
+        with self.http_lock:
+            progress = self.progress
+            history = [sample[1] for sample in self.its_history]
+        if progress == None or progress['steps'] == 0:
+            return ''
+        summary = 'step ' + str(progress['step']) + '/' + str(progress['steps']) + ' (' + str(progress['percent']) + '%)'
+        if progress['eta'] > 0:
+            summary += ' | ETA: ' + time.strftime("%M:%S", time.gmtime(progress['eta']))
+        if progress['its'] > 0:
+            summary += ' | ' + str(round(progress['its'], 2)) + ' it/s'
+        if len(history) >= 10:
+            average = sum(history) / len(history)
+            recent = history[-5:]
+            summary += ' (avg ' + str(round(average, 2)) + ')'
+            # a GPU that's gotten much slower is likely throttling (or something else is using it)
+            if sum(recent) / len(recent) < average * 0.75:
+                summary += ' - slower than usual!'
+        return summary
+
+    # this instance's stats for the web UI's metrics endpoint
+    def metrics(self):
+        with self.http_lock:
+            progress = None
+            if self.progress != None:
+                progress = dict(self.progress)
+            return {
+                'ready': self.ready,
+                'busy': self.busy,
+                'model': self.model_loaded,
+                'restarts': self.restarts,
+                'boot_seconds': round(self.boot_seconds, 1),
+                'out_of_service': self.out_of_service,
+                'progress': progress,
+                'its_history': [list(sample) for sample in self.its_history],
+                'seconds_per_work': self.seconds_per_work,
+                'utilization': self.busy_time.fraction(),
+                'gpu_utilization': self.gpu_busy_time.fraction(),
+                'http': {kind: {'requests': stats[0], 'seconds': round(stats[1], 3)} for kind, stats in self.http_stats.items()},
+                'response_peak_bytes': self.response_peaks[1]
+            }
 
-        while True:
-            try:
-                response = requests.get(url + api_endpoint)
-                response.raise_for_status()  # Raises stored HTTPError, if one occurred.
+    # called every few seconds by the monitor; interrupts generation requests that are taking
+    # far longer than they should, and restarts SD if that doesn't help or if it has died
+    def check_watchdog(self):
+        if self.control_ref.config.get('watchdog_timeout', 0) <= 0 or not self.init or self.out_of_service:
+            return
+
+        if self.process != None and self.process.poll() != None:
+            if self.process.returncode == -signal.SIGINT:
+                # Ctrl+C reaches SD too; we're about to shut down
+                return
+            self.restart('SD process exited unexpectedly (exit code ' + str(self.process.returncode) + ')')
+            return
+
+        with self.state_change:
+            watched = self.watched
+        if watched == None:
+            return
+        now = time.time()
+        if watched['interrupted'] == 0:
+            if now - watched['started'] > watched['deadline']:
+                self.log("*** WARNING: request has been running for " + str(round(now - watched['started'])) \
+                    + " seconds (expected at most " + str(round(watched['deadline'])) + "); interrupting SD...", True)
+                with self.state_change:
+                    watched['request'].hung = True
+                    watched['interrupted'] = now
+                InterruptRequest(self).start()
+        elif now - watched['interrupted'] > WATCHDOG_GRACE:
+            self.restart('SD did not respond to an interrupt within ' + str(WATCHDOG_GRACE) + ' seconds')
+
+    # returns whether our SD process has died (with the watchdog enabled; it'll restart it),
+    # in which case we're no longer ready for work
+    def process_died(self):
+        if self.control_ref.config.get('watchdog_timeout', 0) <= 0 or self.process == None or not self.isRunning:
+            return False
+        try:
+            # a request failing is often the first sign; give the process a moment to finish exiting
+            self.process.wait(2)
+        except subprocess.TimeoutExpired:
+            return False
+        self.ready = False
+        return True
+
+    # kills and relaunches our SD instance; whatever request it was working on fails with SDIHung
+    def restart(self, reason):
+        with self.state_change:
+            if self.watched != None:
+                self.watched['request'].hung = True
+                # stop timing it, otherwise the next check would see the same request and restart again
+                self.watched = None
+        with self.http_lock:
+            self.progress = None
+            self.progress_last = None
+            self.status = ''
+
+        self.ready = False
+        self.model_loaded = ''
+        self.kill_sd_process()
+        if self.restarts >= WATCHDOG_MAX_RESTARTS:
+            self.log("*** ERROR: " + reason + "; SD has already been restarted " + str(self.restarts) \
+                + " times, taking this GPU out of service!", True)
+            self.set_state('out_of_service', True)
+            return
+
+        self.restarts += 1
+        self.log("*** ERROR: " + reason + "; restarting SD instance (restart #" + str(self.restarts) + ")...", True)
+        # the monitor will probe it until it's ready again
+        self.launch()
+
+    # blocks until all outstanding requests finish (or we're shutting down)
+    def wait_until_idle(self):
+        with self.state_change:
+            while self.requests_in_flight > 0 and self.isRunning:
+                self.state_change.wait()
+
+    # blocks until outstanding options changes/model loads finish (or we're shutting down)
+    def wait_for_options_change(self):
+        with self.state_change:
+            while self.options_in_flight > 0 and self.isRunning:
+                self.state_change.wait()
+
+    # creates the keep-alive session all requests to this instance go through
+    # connection failures (e.g. SD dropped an idle connection) are retried on a fresh connection
+    def create_session(self):
+        retries = Retry(total=None, connect=3, read=2, redirect=0, status=0, backoff_factor=0.1)
+        self.http_adapter = CountingAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries)
+        session = requests.Session()
+        session.mount('http://', self.http_adapter)
+        return session
+
+    # makes an HTTP request to this instance; kind selects the timeouts (see HTTP_TIMEOUTS)
+    def http(self, method, endpoint, kind, **kwargs):
+        if 'json' in kwargs:
+            # build the body ourselves so that images are encoded straight into it (see scripts/payload.py)
+            kwargs['data'] = payloads.encode_payload(kwargs.pop('json'))
+            kwargs['headers'] = {'Content-Type': 'application/json'}
+        if self.transport != None:
+            return self.transport.request(self, method, endpoint, kind, **kwargs)
+
+        start = time.time()
+        # generation responses are read as they stream in; see read_response()
+        kwargs['stream'] = kind == 'generate'
+        response = self.session.request(method, self.url + endpoint, timeout=self.http_timeouts(kind), **kwargs)
+        self.record_http(kind, time.time() - start)
+        return response
+
+    # (connect, read) timeouts for a kind of request
+    def http_timeouts(self, kind):
+        return HTTP_TIMEOUTS[kind]
+
+    # adds a finished request to the stats shown in the worker panel
+    def record_http(self, kind, elapsed):
+        with self.http_lock:
+            if kind not in self.http_stats:
+                self.http_stats[kind] = [0, 0.0]
+            self.http_stats[kind][0] += 1
+            self.http_stats[kind][1] += elapsed
+
+    # number of connections opened to this instance so far
+    def http_connections_opened(self):
+        if self.transport != None:
+            return self.transport.connections_opened(self)
+        return self.http_adapter.connections_opened
+
+    # short summary of connection reuse and control-plane latency for the web UI
+    def http_summary(self):
+        with self.http_lock:
+            total = 0
+            latency_count = 0
+            latency_time = 0.0
+            for kind, stats in self.http_stats.items():
+                total += stats[0]
+                if kind in HTTP_LATENCY_KINDS:
+                    latency_count += stats[0]
+                    latency_time += stats[1]
+        if total == 0:
+            return ''
+        opened = self.http_connections_opened()
+        reused = max(total - opened, 0)
+        summary = str(opened) + ' connections for ' + str(total) + ' requests (' + str(round(reused * 100 / total)) + '% reused)'
+        if latency_count > 0:
+            summary += ' | ' + str(round(latency_time * 1000 / latency_count)) + ' ms avg latency'
+        if self.response_peaks[0] > 0:
+            summary += ' | response peak: ' + format_mb(self.response_peaks[0]) + ' last, ' + format_mb(self.response_peaks[1]) + ' max'
+        return summary
+
+    # short summary of how busy this instance (and, if it shares it, its GPU) has been kept since the
+    # current batch of work started, for the web UI and the end-of-work report; '' if it's done nothing
+    def utilization_summary(self):
+        fraction = self.busy_time.fraction()
+        if fraction == None:
+            return ''
+        summary = 'busy ' + str(round(fraction * 100)) + '%'
+        gpu_fraction = self.gpu_busy_time.fraction()
+        if self.control_ref.config.get('sd_instances_per_gpu', 1) > 1 and gpu_fraction != None:
+            summary += ' (GPU ' + str(round(gpu_fraction * 100)) + '%)'
+        return summary
+
+    # reads a generation response's JSON as it streams in, decoding images one at a time
+    # (see scripts/streamjson.py); returns the response's fields and the peak bytes held
+    def read_response(self, response):
+        try:
+            fields, stream = streamjson.read_response(response.iter_content(streamjson.CHUNK_SIZE))
+        finally:
+            response.close()
+        with self.http_lock:
+            self.response_peaks = [stream.peak, max(self.response_peaks[1], stream.peak)]
+        return fields, stream.peak
+
+    # checks whether SD has finished starting up (called by the monitor until it has); a single
+    # cheap query, so that the GPU's worker can be given work the moment it answers
+    def probe_ready(self):
+        try:
+            response = self.http('GET', READY_ENDPOINT, 'alive')
+            response.raise_for_status()
+            ready = isinstance(response.json(), list)
+        except (requests.exceptions.RequestException, ValueError):
+            ready = False
+
+        if ready:
+            self.boot_seconds = time.time() - self.boot_started
+            self.log("SD instance finished initialization in " + str(round(self.boot_seconds, 1)) + " seconds; ready for work!", True)
+            self.ready = True
+        elif self.process != None and self.process.poll() != None and self.control_ref.config.get('watchdog_timeout', 0) <= 0 \
+                and self.process.returncode != -signal.SIGINT:
+            # (with the watchdog enabled, it'll restart SD instead)
+            self.log("*** ERROR: SD process exited during startup (exit code " + str(self.process.returncode) \
+                + "); see " + self.errorfilename + " for details. Taking this GPU out of service!", True)
+            self.set_state('out_of_service', True)
+        return ready
+
+    # starts up a new SD instance (or, with SD_ATTACH, adopts one that's already running)
+    def initialize(self):
+        self.init = True
+        full_target = os.path.join(self.path_to_sd, self.target_command)
 
-                data = response.json()
-                if 'detail' in data and data['detail'] == 'Not Found':
-                    # If we get 'detail': 'Not Found', the API is not ready.
+        attached = False
+        if self.control_ref.config.get('sd_attach'):
+            attached = self.attach()
+        else:
+            # an instance a previous run left running would be in the way
+            orphan = self.registered_process()
+            if orphan != None:
+                self.log('shutting down SD instance left running by a previous run (pid ' + str(orphan.pid) + ')...', True)
+                self.process = orphan
+                self.kill_sd_process()
+                try:
+                    # give it a chance to let go of the port
+                    orphan.wait(30)
+                except subprocess.TimeoutExpired:
                     pass
-                else:
-                    # If we don't get 'detail': 'Not Found', the API is ready.
-                    break
 
-            except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError, KeyError):
-                pass
-
-            if time.time() - start_time > timeout:
-                raise TimeoutError(f'Server at {url} not responding after {timeout} seconds')
+        if not attached and not self.out_of_service:
+            # we don't have a startup script for this gpu; make one
+            #if not exists(full_target):
+            self.create_startup_batch_file()
 
-            time.sleep(5)  # Wait before trying again
+            self.log('starting new SD instance via: ' + full_target, True)
+            self.launch()
 
-    # starts up a new SD instance
-    def initialize(self):
-        self.init = True
-        full_target = os.path.join(self.path_to_sd, self.target_command)
+        atexit.register(self.exit_sd_process)
 
-        # we don't have a startup script for this gpu; make one
-        #if not exists(full_target):
-        self.create_startup_batch_file()
+        # start monitoring the SD subprocess; it'll mark us ready once SD has finished starting up
+        self.monitor = Monitor(self, self.monitor_done_callback)
+        self.monitor.start()
 
-        self.log('starting new SD instance via: ' + full_target, True)
 
+    # starts the SD subprocess
+    def launch(self):
+        full_target = os.path.join(self.path_to_sd, self.target_command)
+        self.boot_started = time.time()
+        self.attached = False
+        options = {}
+        if self.control_ref.config.get('sd_detach_on_exit'):
+            # keep Ctrl+C from reaching SD too, so that it can outlive us
+            if self.platform == 'windows':
+                options['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+            else:
+                options['start_new_session'] = True
         self.process = subprocess.Popen(full_target, \
             cwd=self.path_to_sd, \
             #stdout=subprocess.PIPE, \
             stdout=self.logfile, \
             stderr=self.errorfile, \
             bufsize=0, \
-            universal_newlines=True
+            universal_newlines=True, \
+            **options
         )
+        self.write_pidfile()
 
-        atexit.register(self.kill_sd_process)
 
-        # start monitoring the SD subprocess's piped output
-        self.monitor = Monitor(self, self.monitor_done_callback)
-        self.monitor.start()
+    # looks for an SD instance that's already running on our port - one a previous run left running
+    # (SD_DETACH_ON_EXIT), or one started some other way - and adopts it instead of launching a new
+    # one; returns whether we did
+    def attach(self):
+        process = self.registered_process()
+        flags = None
+        try:
+            response = self.http('GET', '/sdapi/v1/cmd-flags', 'alive')
+            response.raise_for_status()
+            flags = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+
+        if not isinstance(flags, dict):
+            if process == None:
+                self.log('no running SD instance found on port ' + str(self.sd_port) + '; starting a new one...', True)
+                return False
+            # ours, but still starting up; the monitor will wait for it as usual
+            self.log('attaching to SD instance on port ' + str(self.sd_port) + ' (pid ' + str(process.pid) + '), which is still starting up...', True)
+        else:
+            # make sure it's running on our GPU (SD uses the first device if it isn't given one)
+            device = flags.get('device_id')
+            if device == None or device == '':
+                device = '0'
+            if str(device) != str(self.gpu_id):
+                self.log("*** ERROR: the SD instance already running on port " + str(self.sd_port) + " is using GPU " + str(device) \
+                    + ", not GPU " + str(self.gpu_id) + "; shut it down or change SD_PORT. Taking this GPU out of service!", True)
+                self.set_state('out_of_service', True)
+                return False
+            if process == None:
+                pid = self.port_owner()
+                if pid != None:
+                    process = AttachedProcess(pid)
+                else:
+                    self.log("*** WARNING: can't tell which process is running the SD instance on port " + str(self.sd_port) \
+                        + "; the watchdog won't be able to restart it, and it will be left running at exit", True)
+            self.log('attaching to running SD instance on port ' + str(self.sd_port) \
+                + ('' if process == None else ' (pid ' + str(process.pid) + ')') + '...', True)
+
+        self.process = process
+        self.attached = True
+        self.boot_started = time.time()
+        if process != None:
+            self.write_pidfile()
+        return True
+
+
+    # returns the process in our pidfile if it's still running and was started for this GPU and port
+    # from this SD install, otherwise None (removing the pidfile if it's stale)
+    def registered_process(self):
+        try:
+            with open(self.pidfile, 'r', encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            if entry['gpu_id'] == self.gpu_id and entry['port'] == self.sd_port \
+                    and entry['sd_location'] == os.path.abspath(self.path_to_sd) \
+                    and psutil.Process(entry['pid']).create_time() == entry['created']:
+                return AttachedProcess(entry['pid'])
+        except (psutil.Error, KeyError, TypeError):
+            pass
+        self.remove_pidfile()
+        return None
+
+    # returns the pid of whatever is listening on our port, or None if we can't tell
+    def port_owner(self):
+        try:
+            for c in psutil.net_connections(kind='tcp'):
+                if c.status == psutil.CONN_LISTEN and c.laddr and c.laddr.port == self.sd_port and c.pid != None:
+                    return c.pid
+        except (psutil.Error, OSError):
+            pass
+        return None
+
+    def write_pidfile(self):
+        try:
+            entry = {
+                'pid': self.process.pid,
+                'created': psutil.Process(self.process.pid).create_time(),
+                'gpu_id': self.gpu_id,
+                'port': self.sd_port,
+                'sd_location': os.path.abspath(self.path_to_sd)
+            }
+            os.makedirs(PIDFILE_DIR, exist_ok=True)
+            with open(self.pidfile, 'w', encoding="utf-8") as f:
+                json.dump(entry, f)
+        except (OSError, psutil.Error):
+            pass
 
-        # Wait for server to be ready
-        self.wait_for_server(self.url, "/sdapi/v1/samplers")
+    def remove_pidfile(self):
+        try:
+            os.remove(self.pidfile)
+        except OSError:
+            pass
 
 
     # creates a suitable startup .bat/.sh for this gpu
@@ -505,56 +1397,37 @@ class SDI:
         pass
 
 
-    # make a txt2img request
-    def do_txt2img(self, payload, output_dir = ''):
-        self.busy = True
+    # make a txt2img request; returns a Future that resolves to a GenerationResult
+    # work is the request's size (see generation_work()); it's worked out from payload if it's omitted
+    def txt2img(self, payload, output_dir = '', work = None):
         self.output_dir = output_dir
         #self.log('Making a txt2img request!')
-        txt2img = Txt2ImgRequest(self, payload, self.handle_response)
-        txt2img.start()
+        if work == None:
+            work = generation_work(payload)
+        return self.submit(Txt2ImgRequest(self, payload, lambda response: self.handle_response(response, output_dir)), work=work)
 
 
-    # make a img2img request
-    def do_img2img(self, payload, output_dir = ''):
-        self.busy = True
+    # make a img2img request; returns a Future that resolves to a GenerationResult
+    def img2img(self, payload, output_dir = '', work = None):
         self.output_dir = output_dir
         #self.log('Making a img2img request!')
-        img2img = Img2ImgRequest(self, payload, self.handle_response)
-        img2img.start()
-
-
-    # make a controlnet txt2img request
-    def do_controlnet_txt2img(self, payload, output_dir = ''):
-        self.busy = True
-        self.output_dir = output_dir
-        txt2img = ControlNet_Txt2ImgRequest(self, payload, self.handle_response)
-        txt2img.start()
-
-
-    # make a controlnet img2img request
-    def do_controlnet_img2img(self, payload, output_dir = ''):
-        self.busy = True
-        self.output_dir = output_dir
-        img2img = ControlNet_Img2ImgRequest(self, payload, self.handle_response)
-        img2img.start()
+        if work == None:
+            work = generation_work(payload)
+        return self.submit(Img2ImgRequest(self, payload, lambda response: self.handle_response(response, output_dir)), work=work)
 
 
-    # make an upscale request
-    def do_upscale(self, payload, output_dir = ''):
-        self.busy = True
+    # make an upscale request; returns a Future that resolves to a GenerationResult
+    def upscale(self, payload, output_dir = ''):
         self.output_dir = output_dir
         #self.log('Making an upscale request!')
-        upscale = UpscaleRequest(self, payload, self.handle_upscale_response)
-        upscale.start()
+        return self.submit(UpscaleRequest(self, payload, lambda response: self.handle_upscale_response(response, output_dir)))
 
 
     # gets valid samplers from server
     def get_server_samplers(self):
-        self.busy = True
         #self.log('Fetching samplers from server...')
         self.log('querying SD for available samplers...', True)
-        query = GetSamplersRequest(self, self.sampler_response)
-        query.start()
+        return self.submit(GetSamplersRequest(self, self.sampler_response))
 
     # handle server sampler response
     def sampler_response(self, response):
@@ -569,29 +1442,29 @@ class SDI:
         #self.log('Server indicates the following samplers are available for use:\n' + sampler_str)
         self.log('received sampler query response: SD indicates ' + str(len(samplers)) + ' samplers available for use...', True)
         samplers.sort()
+        unchanged = samplers == self.control_ref.sdi_samplers
         self.control_ref.sdi_samplers = samplers
 
         # reload prompt file if we have one to validate it against samplers
-        if self.control_ref.prompt_file != '':
+        # (unless they're the same as the cached ones it was already validated against)
+        if self.control_ref.prompt_file != '' and not unchanged:
             self.control_ref.new_prompt_file(self.control_ref.prompt_file)
 
-        self.busy = False
+        return samplers
 
 
     # gets valid controlnet models from server
     def get_server_controlnet_models(self):
-        self.busy = True
         #self.log('Fetching models from server...')
         self.log('querying SD for available ControlNet models...', True)
-        query = ControlNet_GetModelsRequest(self, self.controlnet_model_response)
-        query.start()
+        return self.submit(ControlNet_GetModelsRequest(self, self.controlnet_model_response))
 
 
     # handle server controlnet model response
     def controlnet_model_response(self, response):
+        models = []
         try:
             r = response.json()
-            models = []
             for i in r['model_list']:
                 models.append(i)
 
@@ -605,23 +1478,21 @@ class SDI:
             self.log('*** Error: received invalid ControlNet model response (is your ControlNet extension installed properly?); disabling ControlNet functionality!', True)
             self.control_ref.sdi_controlnet_available = False
 
-        self.busy = False
+        return models
 
 
     # gets valid controlnet modules from server
     def get_server_controlnet_modules(self):
-        self.busy = True
         #self.log('Fetching modules from server...')
         self.log('querying SD for available ControlNet preprocessors...', True)
-        query = ControlNet_GetModulesRequest(self, self.controlnet_module_response)
-        query.start()
+        return self.submit(ControlNet_GetModulesRequest(self, self.controlnet_module_response))
 
 
     # handle server controlnet module response
     def controlnet_module_response(self, response):
+        modules = []
         try:
             r = response.json()
-            modules = []
             for i in r['module_list']:
                 modules.append(i)
 
@@ -634,63 +1505,51 @@ class SDI:
         except:
             self.log('*** Error: received invalid ControlNet preprocessor response (is your ControlNet extension up to date?)!', True)
 
-        self.busy = False
+        return modules
 
 
     # gets valid hypernetworks from server
     def get_server_hypernetworks(self):
-        self.busy = True
         self.log('querying SD for available hypernetworks...', True)
-        query = GetHyperNetworksRequest(self, self.hypernetwork_response)
-        query.start()
+        return self.submit(GetHyperNetworksRequest(self, self.hypernetwork_response))
 
 
     # gets valid styles from server
     def get_server_styles(self):
-        self.busy = True
         self.log('querying SD for available styles...', True)
-        query = GetStylesRequest(self, self.style_response)
-        query.start()
+        return self.submit(GetStylesRequest(self, self.style_response))
 
 
     # gets valid VAEs from server
     def get_server_VAEs(self):
-        self.busy = True
         self.log('querying SD for available VAEs...', True)
-        query = GetVAEsRequest(self, self.VAE_response)
-        query.start()
+        return self.submit(GetVAEsRequest(self, self.VAE_response))
 
 
     # gets valid loras from server
     def get_server_loras(self):
-        self.busy = True
         self.log('querying SD for available LoRAs...', True)
-        query = GetLorasRequest(self, self.lora_response)
-        query.start()
+        return self.submit(GetLorasRequest(self, self.lora_response))
 
 
     # update loras on server
     def update_server_loras(self):
-        #self.busy = True       # don't wait for response before starting work
+        # not tracked as busy; don't wait for response before starting work
         #self.log('asking SD to refresh LoRAs...', True)
         query = LoraRefreshRequest(self, self.lora_refresh_response)
-        query.start()
+        return query.start()
 
 
     # gets valid scripts from server
     def get_server_scripts(self):
-        self.busy = True
         self.log('querying SD for available scripts...', True)
-        query = GetScriptsRequest(self, self.script_response)
-        query.start()
+        return self.submit(GetScriptsRequest(self, self.script_response))
 
 
     # gets valid upscalers from server
     def get_server_upscalers(self):
-        self.busy = True
         self.log('querying SD for available upscalers...', True)
-        query = GetUpscalersRequest(self, self.upscaler_response)
-        query.start()
+        return self.submit(GetUpscalersRequest(self, self.upscaler_response))
 
 
     # handle server hypernetwork response
@@ -708,7 +1567,7 @@ class SDI:
         self.log('received hypernetwork query response: SD indicates ' + str(len(networks)) + ' hypernetworks available for use...', True)
         networks = sorted(networks, key=lambda d: d['name'].lower())
         self.control_ref.sdi_hypernetworks = networks
-        self.busy = False
+        return networks
 
 
     # handle server style response
@@ -729,7 +1588,7 @@ class SDI:
         self.log('received style query response: SD indicates ' + str(len(styles)) + ' styles available for use...', True)
         styles = sorted(styles, key=lambda d: d['name'].lower())
         self.control_ref.sdi_styles = styles
-        self.busy = False
+        return styles
 
 
     # handle server VAE response
@@ -747,7 +1606,7 @@ class SDI:
         self.log('received VAE query response: SD indicates ' + str(len(vaes)) + ' VAEs available for use...', True)
         vaes = sorted(vaes, key=lambda d: d['name'].lower())
         self.control_ref.sdi_VAEs = vaes
-        self.busy = False
+        return vaes
 
 
     # handle server lora response
@@ -765,14 +1624,14 @@ class SDI:
         self.log('received LoRA query response: SD indicates ' + str(len(loras)) + ' LoRAs available for use...', True)
         loras = sorted(loras, key=lambda d: d['name'].lower())
         self.control_ref.sdi_loras = loras
-        self.busy = False
+        return loras
 
 
     # handle server lora response
     def lora_refresh_response(self, response):
         r = response.json()
         #self.log('received LoRA refresh response...', True)
-        #self.busy = False
+        return r
 
 
     # handle server script response
@@ -800,7 +1659,7 @@ class SDI:
 
         self.control_ref.sdi_txt2img_scripts = txt2img_scripts
         self.control_ref.sdi_img2img_scripts = img2img_scripts
-        self.busy = False
+        return {'txt2img': txt2img_scripts, 'img2img': img2img_scripts}
 
 
     # handle server upscaler response
@@ -813,16 +1672,14 @@ class SDI:
         self.log('received upscaler query response: SD indicates ' + str(len(upscalers)) + ' upscalers available for use...', True)
         self.control_ref.sdi_upscalers = upscalers
         self.control_ref.check_default_upscaler()
-        self.busy = False
+        return upscalers
 
 
     # gets valid models from server
     def get_server_models(self):
-        self.busy = True
         #self.log('Fetching models from server...')
         self.log('querying SD for available models...', True)
-        query = GetModelsRequest(self, self.model_response)
-        query.start()
+        return self.submit(GetModelsRequest(self, self.model_response))
 
 
     # handle server model response
@@ -842,119 +1699,153 @@ class SDI:
         # send models to controller
         #models.sort()
         models = sorted(models, key=lambda d: d['name'].lower())
+        if models == self.control_ref.sdi_models:
+            # same as the cached catalog we started with; it's already been validated against
+            return models
         self.control_ref.update_models(models)
 
         # reload prompt file if we have one to validate it against models
         if self.control_ref.prompt_file != '':
             self.control_ref.new_prompt_file(self.control_ref.prompt_file)
 
-        self.busy = False
+        return models
 
 
     # handle upscale responses
-    def handle_upscale_response(self, response):
+    def handle_upscale_response(self, response, output_dir = None):
         # only handle if we're not already shutting down
-        if self.isRunning:
-            #self.log('Handling response from server...')
-            try:
-                r = response.json()
-                os.makedirs(self.output_dir, exist_ok=True)
+        if not self.isRunning:
+            response.close()
+            raise SDIShutdown('SD instance on ' + self.worker_name + ' is shutting down')
+
+        if output_dir == None:
+            output_dir = self.output_dir
+        #self.log('Handling response from server...')
+        error = ''
+        peak = 0
+        try:
+            r, peak = self.read_response(response)
 
-                i = r['image']
-                image = Image.open(io.BytesIO(base64.b64decode(i)))
+            data = r['image']
+            image = Image.open(io.BytesIO(data))
 
-                png_payload = {
-                    "image": "data:image/png;base64," + i
-                }
-                response2 = requests.post(url=f'{self.url}/sdapi/v1/png-info', json=png_payload)
+            # extras responses don't include generation info; it's in the image itself
+            info = self.image_info(image, data)
 
-                pnginfo = PngImagePlugin.PngInfo()
-                pnginfo.add_text("parameters", response2.json().get("info"))
+            # get the actual seed used
+            seed = seed_from_info(info) or '0'
 
-                seed = '0'
-                # get the actual seed used
-                if 'Seed:' in response2.json().get("info"):
-                    temp = response2.json().get("info").split('Seed:', 1)
-                    temp = temp[1].split(',', 1)
-                    seed = temp[0].strip()
+            generated = GeneratedImage('seed_' + seed + '_u.png', data, info)
+            if self.save_intermediates():
+                os.makedirs(output_dir, exist_ok=True)
+                generated.save(os.path.join(output_dir, generated.name))
+            #self.log(filename + ' created!')
+        except KeyError:
+            error = str(r.get('detail'))
+        except:
+            #e = sys.exc_info()[0]
+            error = 'if this persists, try lowering your settings'
+        self.request_count += 1
 
-                filename = 'seed_' + seed + '_u.png'
-                image.save(os.path.join(self.output_dir, filename), pnginfo=pnginfo)
-                #self.log(filename + ' created!')
-            except KeyError:
-                self.log('*** Error response received during upscaling! *** : ' + str(r['detail']), True)
-                time.sleep(1)
-            except:
-                #e = sys.exc_info()[0]
-                #self.log('*** Error response received! *** : ' + str(e), True)
-                self.log('*** Error response received during upscaling! *** : if this persists, try lowering your settings', True)
-                time.sleep(1)
+        if error != '':
+            self.log('*** Error response received during upscaling! *** : ' + error, True)
+            time.sleep(1)
+            raise SDIError('upscale failed: ' + error, response.status_code)
+        result = GenerationResult([generated.path] if generated.path != '' else [], [seed], [info], [generated])
+        result.peak_bytes = peak
+        return result
 
-            self.request_count += 1
-            self.busy = False
 
+    # debug option: write every image SD returns to disk as a PNG, as well as keeping it in memory
+    def save_intermediates(self):
+        return self.control_ref.config.get('save_intermediate_pngs') == True
 
-    # handle SD responses, callback for server requests
-    def handle_response(self, response):
-        # only handle if we're not already shutting down
-        if self.isRunning:
-            #self.log('Handling response from server...')
-            self.last_job_success = True
-            try:
-                r = response.json()
-                os.makedirs(self.output_dir, exist_ok=True)
 
-                for i in r['images']:
-                    image = Image.open(io.BytesIO(base64.b64decode(i.split(",",1)[0])))
+    # returns the infotext for an image SD returned without one in the response: read it from the
+    # PNG's own metadata when it's there, otherwise fall back to asking SD (/sdapi/v1/png-info)
+    def image_info(self, image, data):
+        info = image.info.get('parameters')
+        if isinstance(info, str):
+            return info
+        png_payload = {
+            "image": payloads.PayloadImage(data=data)
+        }
+        response2 = self.http('POST', '/sdapi/v1/png-info', 'png_info', json=png_payload)
+        return response2.json().get("info")
 
-                    png_payload = {
-                        "image": "data:image/png;base64," + i
-                    }
-                    response2 = requests.post(url=f'{self.url}/sdapi/v1/png-info', json=png_payload)
 
-                    pnginfo = PngImagePlugin.PngInfo()
-                    pnginfo.add_text("parameters", response2.json().get("info"))
+    # handle SD responses, callback for server requests
+    def handle_response(self, response, output_dir = None):
+        # only handle if we're not already shutting down
+        if not self.isRunning:
+            response.close()
+            raise SDIShutdown('SD instance on ' + self.worker_name + ' is shutting down')
+
+        if output_dir == None:
+            output_dir = self.output_dir
+        #self.log('Handling response from server...')
+        files = []
+        seeds = []
+        infotexts = []
+        images = []
+        error = ''
+        peak = 0
+        r = {}
+        try:
+            r, peak = self.read_response(response)
 
-                    seed = '0'
+            generation_info = parse_generation_info(r)
+            for x, data in enumerate(r['images']):
+                if generation_info[x] != None:
+                    info, seed = generation_info[x]
+                else:
+                    image = Image.open(io.BytesIO(data))
+                    info = self.image_info(image, data)
                     # get the actual seed used
-                    if 'Seed:' in response2.json().get("info"):
-                        temp = response2.json().get("info").split('Seed:', 1)
-                        temp = temp[1].split(',', 1)
-                        seed = temp[0].strip()
-
-                    filename = 'seed_' + seed + '.png'
-                    image.save(os.path.join(self.output_dir, filename), pnginfo=pnginfo)
-                    #self.log(filename + ' created!')
-            except KeyError:
-                self.log('*** Error response received! *** : ' + str(r['detail']), True)
-                time.sleep(1)
-                self.last_job_success = False
-            except:
-                #e = sys.exc_info()[0]
-                #self.log('*** Error response received! *** : ' + str(e), True)
-                self.log('*** Error response received! *** : if this persists, try lowering your settings', True)
-                time.sleep(1)
-                self.last_job_success = False
+                    seed = seed_from_info(info) or '0'
+
+                generated = GeneratedImage('seed_' + seed + '.png', data, info)
+                if self.save_intermediates():
+                    os.makedirs(output_dir, exist_ok=True)
+                    generated.save(os.path.join(output_dir, generated.name))
+                    files.append(generated.path)
+                images.append(generated)
+                seeds.append(seed)
+                infotexts.append(info)
+                #self.log(filename + ' created!')
+        except KeyError:
+            error = str(r.get('detail'))
+        except:
+            #e = sys.exc_info()[0]
+            error = 'if this persists, try lowering your settings'
+        self.request_count += 1
+
+        if error != '':
+            self.log('*** Error response received! *** : ' + error, True)
+            time.sleep(1)
+            raise SDIError('generation failed: ' + error, response.status_code)
+        result = GenerationResult(files, seeds, infotexts, images)
+        result.peak_bytes = peak
+        return result
+
 
-            self.request_count += 1
-            self.busy = False
+    # changes SD server options; returns a Future that resolves to the applied options
+    def set_options(self, payload):
+        return self.submit(SetOptionsRequest(self, payload, self.handle_options_response), True)
 
 
     # tells the SD instance to load the indicated model
     def load_model(self, new_model):
-        self.options_change_in_progress = True
         self.model_loading_now = new_model
         self.log("requesting a new model load: " + new_model, True)
         payload = {
             "sd_model_checkpoint": new_model
         }
-        model_req = SetOptionsRequest(self, payload, self.handle_options_response)
-        model_req.start()
+        return self.set_options(payload)
 
 
     # tells the SD instance to use the legacy highres_fix behavior or current new method
     def set_initial_options(self, hires_fix_mode):
-        self.options_change_in_progress = True
         self.log("passing initial setup options to SD instance...", True)
         if hires_fix_mode == 'advanced':
             payload = {
@@ -964,45 +1855,52 @@ class SDI:
             payload = {
                 "use_old_hires_fix_width_height": True
             }
-        model_req = SetOptionsRequest(self, payload, self.handle_options_response)
-        model_req.start()
+        return self.set_options(payload)
 
 
     # handle option change responses
     def handle_options_response(self, response, payload):
-        if response.status_code == 200:
-            # no errors
-            if "sd_model_checkpoint" in str(payload):
-                self.model_loaded = self.model_loading_now
+        if response.status_code != 200:
+            #r = response.json()
+            if "sd_model_checkpoint" in payload:
+                self.log('*** Error: SD was unable to load model ' + str(payload['sd_model_checkpoint']) + ' (HTTP ' + str(response.status_code) + ')!', True)
                 self.model_loading_now = ''
-                self.log('new model successfully loaded!', True)
-            else:
-                pass
-                # TODO uncomment this if used beyond initial setup
-                #self.log('options successfully changed!', True)
+            raise SDIError('options change failed (HTTP ' + str(response.status_code) + ')', response.status_code)
+
+        # no errors
+        if "sd_model_checkpoint" in payload:
+            self.model_loaded = self.model_loading_now
+            self.model_loading_now = ''
+            self.log('new model successfully loaded!', True)
         else:
-            # TODO handle error reporting
-            #r = response.json()
-            #print('unexpected handle_options_response: ' + str(response.status_code))
             pass
-
-        self.options_change_in_progress = False
+            # TODO uncomment this if used beyond initial setup
+            #self.log('options successfully changed!', True)
+        return payload
 
 
     # shutdown and clean up
     def cleanup(self):
-        self.isRunning = False
+        with self.state_change:
+            self.isRunning = False
+            self.state_change.notify_all()
+        interrupt = None
         if self.busy:
             # if we're busy, send an interrupt request
             self.log("terminating current task...", True)
             int = InterruptRequest(self)
-            int.start()
+            interrupt = int.start()
+        self.request_executor.shutdown(wait=False)
+        if self.transport != None:
+            # refuse new requests now, but let the interrupt go out before closing the connections
+            self.transport.unregister(self, interrupt)
 
         self.logfile.close()
         self.errorfile.close()
 
         # the atexit call should get this, but will check here also
-        self.kill_sd_process()
+        self.exit_sd_process()
+        self.session.close()
 
         # cleanup gpu working dir
         if self.output_dir != '':
@@ -1010,8 +1908,21 @@ class SDI:
                 shutil.rmtree(self.output_dir)
 
 
+    # called at exit; shuts down our SD instance, unless SD_DETACH_ON_EXIT is set - then it's left
+    # running for the next run to attach to (as long as it's still healthy)
+    def exit_sd_process(self):
+        if self.control_ref.config.get('sd_detach_on_exit') and self.process != None and self.process.poll() == None \
+                and not self.out_of_service:
+            if not self.detached:
+                self.detached = True
+                self.log('leaving SD instance running on port ' + str(self.sd_port) + ' (pid ' + str(self.process.pid) + ')')
+            return
+        self.kill_sd_process()
+
+
     # kill the SD child process
     def kill_sd_process(self):
+        self.remove_pidfile()
         if self.process != None:
             #print("attempting to kill SD")
             try:
@@ -1032,6 +1943,7 @@ class SDI:
     def log(self, line, webserver = False):
         #pre = '[GPU ' + str(self.gpu_id) + '] >>> '
         pre = '[' + self.worker_name + '] >>> '
-        print(pre + line)
+        # one write, so that lines logged from concurrent requests don't run together
+        sys.stdout.write(pre + line + '\n')
         if webserver:
             self.control_ref.output_buffer.append(pre + line + '\n')
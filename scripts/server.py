@@ -2,10 +2,12 @@
 # SPDX-License-Identifier: MIT
 
 import os, os.path
+import json
 import random
 import string
 import time
 import scripts.utils as utils
+import scripts.imagecache as imagecache
 from datetime import datetime, timedelta
 import cherrypy
 from cherrypy.lib import auth_basic, static
@@ -280,6 +282,11 @@ def build_prompt_panel(control):
                 buffer += " | loops done: " + str(control.loops) + " | repeat: on\n"
             else:
                 buffer += " | repeat: off\n"
+            if control.sweep_progress != {}:
+                # parallel multi-model sweep; show progress for each model
+                for model, progress in control.sweep_progress.items():
+                    name = model.split('[', 1)[0].strip()
+                    buffer += "\t\t<br>" + name + ": " + str(progress[0]) + " of " + str(progress[1]) + " done\n"
         elif control.get_mode() == 'process':
             buffer += "\t\t" + str(control.jobs_done) + " of " + str(control.orig_work_queue_size) + " work items completed"
             buffer += "\t\t | mode: process\n"
@@ -878,7 +885,8 @@ def build_worker_panel(workers):
                 prompt_text = "<div style=\"color: yellow; padding-top: 6px;\">" + "waiting to be initialized...</div>"
             if worker['sdi_instance'].init and not worker['sdi_instance'].ready:
                 prompt_text = "<div style=\"padding-top: 6px;\">" + "currently being initialized on port " + str(worker['sdi_instance'].sd_port) + "...</div>"
-            if worker['sdi_instance'].ready and worker['sdi_instance'].busy:
+                clock_text = time.strftime("%M:%S", time.gmtime(time.time() - worker['sdi_instance'].boot_started))
+            if worker['sdi_instance'].ready and (worker['sdi_instance'].busy or not worker['sdi_instance'].control_ref.default_model_validated):
                 # this should only happen in this case
                 prompt_text = "<div style=\"padding-top: 6px;\">" + "performing initial data exchange queries with SD instance...</div>"
 
@@ -943,7 +951,20 @@ def build_worker_panel(workers):
         buffer += "<div id=\"worker-" + str(worker["id"]) + "\" class=\"worker-info\">\n"
         buffer += "\t<div class=\"worker-info-header\">\n"
         buffer += "\t\t<div>" + str(worker["name"]) + " (" + str(worker["id"]) + ")</div>\n"
-        buffer += "\t\t<div class=\"small\">" + str(worker["jobs_done"]) + " jobs completed</div>\n"
+        http_summary = worker['sdi_instance'].http_summary()
+        if http_summary != '':
+            http_summary = " | " + http_summary
+        restarts = ''
+        if worker['sdi_instance'].restarts > 0:
+            restarts = " | " + str(worker['sdi_instance'].restarts) + " SD restart(s)"
+        if worker['sdi_instance'].out_of_service:
+            restarts += " | out of service"
+        if worker['sdi_instance'].boot_seconds > 0:
+            restarts += " | SD startup: " + str(round(worker['sdi_instance'].boot_seconds)) + "s"
+        utilization = worker['sdi_instance'].utilization_summary()
+        if utilization != '':
+            restarts += " | " + utilization
+        buffer += "\t\t<div class=\"small\">" + str(worker["jobs_done"]) + " jobs completed" + restarts + http_summary + "</div>\n"
         buffer += "\t</div>\n"
 
         buffer += "\t<div class=\"worker-info-prompt\">\n"
@@ -956,12 +977,23 @@ def build_worker_panel(workers):
         buffer += "\t\t</div>\n"
         buffer += "\t\t<div class=\"right\">\n"
         buffer += "\t\t\t<div class=\"right-top\">" + prompt_text + "</div>\n"
+        progress_summary = ''
+        if not worker["idle"]:
+            progress_summary = worker['sdi_instance'].progress_summary()
+        if progress_summary != '':
+            if prompt_options_text != '':
+                prompt_options_text += ' | '
+            prompt_options_text += progress_summary
         buffer += "\t\t\t<div class=\"right-bottom\">" + prompt_options_text + "</div>\n"
         buffer += "\t\t</div>\n"
         buffer += "\t</div>\n"
         buffer += "</div>\n"
 
         count += 1
+
+    cache_summary = imagecache.cache.summary()
+    if cache_summary != '':
+        buffer += "<div class=\"small\">" + cache_summary + "</div>\n"
     return buffer
 
 
@@ -1048,6 +1080,22 @@ class ArtGeneratorWebService(object):
         buffer_text = build_worker_panel(self.control.workers)
         return buffer_text
 
+    # per-GPU stats (generation progress, it/s history, restarts, request counts) as JSON
+    def METRICS(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        metrics = []
+        for worker in self.control.workers:
+            entry = {
+                'id': worker['id'],
+                'name': worker['name'],
+                'jobs_done': worker['jobs_done'],
+                'idle': worker['idle']
+            }
+            if worker['sdi_instance'] != None:
+                entry.update(worker['sdi_instance'].metrics())
+            metrics.append(entry)
+        return json.dumps({'workers': metrics, 'image_cache': imagecache.cache.summary()}).encode('utf-8')
+
     def PROMPT_REFRESH(self):
         buffer_text = build_prompt_panel(self.control)
         return buffer_text
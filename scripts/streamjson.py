@@ -0,0 +1,244 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# Streaming reader for SD API responses. Generation responses are mostly base64 image data;
+# rather than holding the whole JSON body, the parsed dict and the decoded images all at once,
+# the response is walked as it arrives and each image is base64-decoded straight into its own
+# buffer, so only one network chunk of encoded data is ever held at a time.
+
+import re
+import json
+import binascii
+
+# size of the network reads
+CHUNK_SIZE = 256 * 1024
+
+# top-level members whose values are base64 image data (a list of them, or a single one)
+IMAGE_LISTS = ['images']
+IMAGE_VALUES = ['image']
+
+# top-level members that are skipped entirely; A1111 echoes the request back in 'parameters',
+# which for img2img includes the (base64) init images
+SKIPPED = ['parameters']
+
+STRING_SPECIAL = re.compile(rb'["\\]')
+VALUE_END = re.compile(rb'[\s,\]}]')
+ESCAPES = {b'"': b'"', b'\\': b'\\', b'/': b'/', b'b': b'\b', b'f': b'\f', b'n': b'\n', b'r': b'\r', b't': b'\t'}
+
+
+# decodes base64 data as it arrives in arbitrary-sized pieces
+class Base64Decoder:
+    def __init__(self):
+        self.pending = b''
+        self.parts = []
+        self.size = 0
+        self.started = False
+
+    def write(self, data):
+        data = self.pending + data.translate(None, b' \t\r\n')
+        if not self.started:
+            # strip a data URL prefix (data:image/png;base64,...) if there is one
+            if len(data) < 64 and b',' not in data:
+                self.pending = data
+                return
+            if data.startswith(b'data:') and b',' in data:
+                data = data.split(b',', 1)[1]
+            self.started = True
+        usable = len(data) - len(data) % 4
+        if usable > 0:
+            decoded = binascii.a2b_base64(data[:usable])
+            self.parts.append(decoded)
+            self.size += len(decoded)
+        self.pending = data[usable:]
+
+    def finish(self):
+        if self.pending != b'':
+            decoded = binascii.a2b_base64(self.pending + b'=' * (-len(self.pending) % 4))
+            self.parts.append(decoded)
+            self.size += len(decoded)
+            self.pending = b''
+        return b''.join(self.parts)
+
+
+# pull parser over a stream of byte chunks
+class JSONStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.pos = 0
+        self.received = 0           # total bytes read from the stream
+        self.peak = 0               # most bytes held at once (stream buffer plus decoded images)
+        self.held = 0               # bytes of decoded images held so far
+        self.decoder = None         # the image currently being decoded
+
+    # reads another chunk; returns False at the end of the stream
+    def fill(self):
+        for chunk in self.chunks:
+            if len(chunk) == 0:
+                continue
+            self.buffer = self.buffer[self.pos:] + chunk
+            self.pos = 0
+            self.received += len(chunk)
+            self.note_peak()
+            return True
+        return False
+
+    # returns the next non-whitespace byte without consuming it
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos:self.pos+1].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos:self.pos+1]
+            if not self.fill():
+                raise ValueError('unexpected end of response')
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError('expected ' + c.decode() + ' in response')
+        self.pos += 1
+
+    # consumes a string (the opening quote must be next), passing its unescaped contents to sink;
+    # if raw is given, the string's exact JSON text is appended to it as well
+    def read_string(self, sink, raw = None):
+        self.expect(b'"')
+        if raw != None:
+            raw.append(b'"')
+        while True:
+            match = STRING_SPECIAL.search(self.buffer, self.pos)
+            if match == None:
+                if self.pos < len(self.buffer):
+                    self.emit(self.buffer[self.pos:], sink, raw)
+                self.pos = len(self.buffer)
+                if not self.fill():
+                    raise ValueError('unterminated string in response')
+                continue
+            end = match.start()
+            if end > self.pos:
+                self.emit(self.buffer[self.pos:end], sink, raw)
+            self.pos = end + 1
+            if self.buffer[end:end+1] == b'"':
+                if raw != None:
+                    raw.append(b'"')
+                return
+            # escape sequence
+            while len(self.buffer) - self.pos < 5 and self.fill():
+                pass
+            code = self.buffer[self.pos:self.pos+1]
+            if code == b'u':
+                escaped = b'\\' + self.buffer[self.pos:self.pos+5]
+                self.pos += 5
+                if raw != None:
+                    raw.append(escaped)
+                if sink != None:
+                    sink(json.loads(b'"' + escaped + b'"').encode('utf-8'))
+            else:
+                self.pos += 1
+                if raw != None:
+                    raw.append(b'\\' + code)
+                if sink != None:
+                    sink(ESCAPES.get(code, code))
+
+    def emit(self, data, sink, raw):
+        if sink != None:
+            sink(data)
+        if raw != None:
+            raw.append(data)
+
+    # consumes any value; if raw is given, the value's JSON text is appended to it
+    def skip_value(self, raw = None):
+        c = self.peek()
+        if c == b'"':
+            self.read_string(None, raw)
+        elif c == b'{' or c == b'[':
+            close = b'}' if c == b'{' else b']'
+            self.pos += 1
+            if raw != None:
+                raw.append(c)
+            first = True
+            while True:
+                if self.peek() == close:
+                    self.pos += 1
+                    if raw != None:
+                        raw.append(close)
+                    return
+                if not first:
+                    self.expect(b',')
+                    if raw != None:
+                        raw.append(b',')
+                first = False
+                if close == b'}':
+                    self.read_string(None, raw)
+                    self.expect(b':')
+                    if raw != None:
+                        raw.append(b':')
+                self.skip_value(raw)
+        else:
+            # number, true/false/null
+            while True:
+                match = VALUE_END.search(self.buffer, self.pos)
+                if match != None:
+                    self.emit(self.buffer[self.pos:match.start()], None, raw)
+                    self.pos = match.start()
+                    return
+                self.emit(self.buffer[self.pos:], None, raw)
+                self.pos = len(self.buffer)
+                if not self.fill():
+                    return
+
+    def note_peak(self):
+        held = len(self.buffer) + self.held
+        if self.decoder != None:
+            held += self.decoder.size
+        self.peak = max(self.peak, held)
+
+    # consumes a base64 string and returns the decoded bytes
+    def read_image(self):
+        self.decoder = Base64Decoder()
+        self.read_string(self.decoder.write)
+        data = self.decoder.finish()
+        self.decoder = None
+        self.held += len(data)
+        self.note_peak()
+        return data
+
+
+# reads an SD API response body (a JSON object) from chunks of bytes
+# returns a dict of the top-level members; image data members hold decoded bytes
+# (a list of them for 'images'), and members listed in SKIPPED are left out
+def read_response(chunks):
+    stream = JSONStream(chunks)
+    fields = {}
+    stream.expect(b'{')
+    first = True
+    while True:
+        if stream.peek() == b'}':
+            stream.pos += 1
+            break
+        if not first:
+            stream.expect(b',')
+        first = False
+
+        key = []
+        stream.read_string(key.append)
+        key = b''.join(key).decode('utf-8')
+        stream.expect(b':')
+
+        if key in IMAGE_LISTS and stream.peek() == b'[':
+            images = []
+            stream.pos += 1
+            while stream.peek() != b']':
+                if len(images) > 0:
+                    stream.expect(b',')
+                images.append(stream.read_image())
+            stream.pos += 1
+            fields[key] = images
+        elif key in IMAGE_VALUES and stream.peek() == b'"':
+            fields[key] = stream.read_image()
+        elif key in SKIPPED:
+            stream.skip_value()
+        else:
+            raw = []
+            stream.skip_value(raw)
+            fields[key] = json.loads(b''.join(raw))
+    return fields, stream
@@ -14,7 +14,9 @@ import glob
 import os
 import itertools
 import copy
+import types
 import scripts.metadata as metadata
+import scripts.imagecache as imagecache
 from zipfile import ZipFile
 from os.path import exists, isdir, basename
 from datetime import datetime as dt
@@ -46,6 +48,165 @@ class PromptSection():
             print("tokens list is empty")
         print('\n')
 
+# deque-like queue of work items that can be fed lazily by generators
+# items are only pulled from the generators as they're needed (popped, or peeked at via indexing),
+# so huge prompt files never have to be held in memory all at once
+# len() is the number of buffered items plus the expected number still to be generated;
+# it's never reported as zero while work remains
+class WorkQueue():
+    def __init__(self, items = None):
+        self.buffer = deque(items if items != None else [])
+        self.sources = deque()          # generators still to be drained, in order
+        self.pending = 0                # expected number of items the sources have yet to produce
+        self.lock = threading.RLock()
+
+    # add a generator to the end of the queue; count is how many items it's expected to produce
+    def add_source(self, generator, count):
+        with self.lock:
+            self.sources.append(generator)
+            self.pending += count
+
+    # pull items from the sources until at least n are buffered (or everything has been generated)
+    def fill(self, n):
+        with self.lock:
+            while len(self.buffer) < n and len(self.sources) > 0:
+                try:
+                    item = next(self.sources[0])
+                except StopIteration:
+                    self.sources.popleft()
+                    if len(self.sources) == 0:
+                        # everything's been generated; drop any estimate error
+                        self.pending = 0
+                    continue
+                self.buffer.append(item)
+                if self.pending > 0:
+                    self.pending -= 1
+
+    def popleft(self):
+        with self.lock:
+            self.fill(1)
+            return self.buffer.popleft()
+
+    def append(self, item):
+        with self.lock:
+            if len(self.sources) > 0:
+                self.add_source(iter([item]), 1)
+            else:
+                self.buffer.append(item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    # puts an item back at the front of the queue
+    def appendleft(self, item):
+        with self.lock:
+            self.buffer.appendleft(item)
+
+    # returns (up to) the next n items without removing them
+    def peek(self, n):
+        with self.lock:
+            self.fill(n)
+            return list(itertools.islice(self.buffer, n))
+
+    def clear(self):
+        with self.lock:
+            self.buffer.clear()
+            self.sources.clear()
+            self.pending = 0
+
+    def __len__(self):
+        with self.lock:
+            self.fill(1)
+            if len(self.sources) == 0:
+                return len(self.buffer)
+            return len(self.buffer) + max(self.pending, 1)
+
+    def __getitem__(self, index):
+        with self.lock:
+            self.fill(index + 1)
+            return self.buffer[index]
+
+    def __delitem__(self, index):
+        with self.lock:
+            self.fill(index + 1)
+            del self.buffer[index]
+
+    # note that this generates (and holds) everything that's left
+    def __iter__(self):
+        with self.lock:
+            self.fill(float('inf'))
+            return iter(list(self.buffer))
+
+# immutable copy of a PromptManager config that's shared by every job queued while it was current
+# the version goes up each time a config is snapshotted, so jobs can tell which settings they came from
+class ConfigSnapshot():
+    __slots__ = ('values', 'version')
+    versions = itertools.count(1)
+
+    def __init__(self, config):
+        self.values = types.MappingProxyType(copy.deepcopy(config))
+        self.version = next(ConfigSnapshot.versions)
+
+# a queued job: a shared ConfigSnapshot plus only the fields that are specific to this job
+# (prompt, input images, and whatever gets settled on while the job is being prepared)
+# reads and writes like the config dict it stands in for; list/dict values are copied the first
+# time they're read so changes to them never leak into the shared snapshot
+class Job():
+    __slots__ = ('snapshot', 'overrides')
+
+    def __init__(self, snapshot, overrides = None):
+        self.snapshot = snapshot
+        self.overrides = overrides if overrides != None else {}
+
+    def __getitem__(self, key):
+        if key in self.overrides:
+            return self.overrides[key]
+        value = self.snapshot.values[key]
+        if isinstance(value, (list, dict)):
+            value = copy.deepcopy(value)
+            self.overrides[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+
+    def __contains__(self, key):
+        return key in self.overrides or key in self.snapshot.values
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(dict.fromkeys(itertools.chain(self.snapshot.values, self.overrides)))
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, values):
+        self.overrides.update(values)
+
+    # lists/dicts a job has already taken out of the snapshot are copied too, so that changing
+    # them on one job can't change the other
+    def copy(self):
+        overrides = {}
+        for key, value in self.overrides.items():
+            if isinstance(value, (list, dict)):
+                value = copy.deepcopy(value)
+            overrides[key] = value
+        return Job(self.snapshot, overrides)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
 # for easy management of input files
 # input_path is the directory of the input images to use
 class InputManager():
@@ -346,7 +507,12 @@ class PromptManager():
 
 
     # handle prompt file config directives
-    def handle_directive(self, command, value):
+    # config and model_state default to this manager's config and the controller's model queue
+    def handle_directive(self, command, value, config = None, model_state = None):
+        if config == None:
+            config = self.config
+        if model_state == None:
+            model_state = self.control
         if command == 'width':
             if value != '':
                 try:
@@ -354,7 +520,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'WIDTH' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'width' : value})
+                    config.update({'width' : value})
 
         elif command == 'height':
             if value != '':
@@ -363,16 +529,16 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'HEIGHT' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'height' : value})
+                    config.update({'height' : value})
 
         elif command == 'auto_size':
             value = value.lower().strip()
             if value == 'off' or value == '':
-                self.config.update({'auto_size' : 'off'})
+                config.update({'auto_size' : 'off'})
             elif value == 'match_controlnet_image_size' or value == 'match_controlnet_image_aspect_ratio':
-                self.config.update({'auto_size' : value})
+                config.update({'auto_size' : value})
             elif value == 'match_input_image_size' or value == 'match_input_image_aspect_ratio':
-                self.config.update({'auto_size' : value})
+                config.update({'auto_size' : value})
             elif 'resize_longest_dimension:' in value:
                 dimension = value.split(':', 1)[1].strip()
                 try:
@@ -380,17 +546,17 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: invalid dimension supplied (" + value + ") for !AUTO_SIZE; it will be ignored!")
                 else:
-                    self.config.update({'auto_size' : value})
+                    config.update({'auto_size' : value})
             else:
                 self.control.print("*** WARNING: specified 'AUTO_SIZE' value (" + value + ") not understood; it will be ignored!")
 
         elif command == 'auto_insert_model_trigger':
             if value == 'start' or value == 'end' or value == 'first_comma' or value == 'off' or 'keyword:' in value:
-                self.config.update({'auto_insert_model_trigger' : value})
+                config.update({'auto_insert_model_trigger' : value})
 
         elif command == 'highres_fix':
             if value == 'yes' or value == 'no':
-                self.config.update({'highres_fix' : value})
+                config.update({'highres_fix' : value})
 
         elif command == 'highres_scale_factor':
             if self.control.config['hires_fix_mode'] == 'advanced':
@@ -400,26 +566,26 @@ class PromptManager():
                     except:
                         self.control.print("*** WARNING: specified 'HIGHRES_SCALE_FACTOR' is not a valid number; it will be ignored!")
                     else:
-                        self.config.update({'highres_scale_factor' : value})
+                        config.update({'highres_scale_factor' : value})
                 else:
-                    self.config.update({'highres_scale_factor' : ''})
+                    config.update({'highres_scale_factor' : ''})
             else:
                 self.control.print("*** WARNING: specified 'HIGHRES_SCALE_FACTOR' but config.txt specifies simple highres_fix mode; it will be ignored!")
 
         elif command == 'highres_upscaler':
             if value != '':
                 if value.lower().strip() == 'latent':
-                    self.config.update({'highres_upscaler' : 'Latent'})
+                    config.update({'highres_upscaler' : 'Latent'})
                 elif value.lower().strip() == 'none':
-                    self.config.update({'highres_upscaler' : 'None'})
+                    config.update({'highres_upscaler' : 'None'})
                 else:
                     upscale_model = self.control.validate_upscale_model(value.strip())
                     if upscale_model != '':
-                        self.config.update({'highres_upscaler' : upscale_model})
+                        config.update({'highres_upscaler' : upscale_model})
                     else:
                         self.control.print("*** WARNING: HIGHRES_UPSCALER value (" + value.strip() + ") doesn't match any server values; ignoring it! ***")
             else:
-                self.config.update({'highres_upscaler' : ''})
+                config.update({'highres_upscaler' : ''})
 
         elif command == 'highres_ckpt_file':
             model = ''
@@ -436,37 +602,37 @@ class PromptManager():
               if len(validated_models) > 0:
                   # we have at least one valid model, start with the first one
                   # store list with the controller
-                  self.control.highres_models = validated_models
-                  model = self.control.highres_models[0]
+                  model_state.highres_models = validated_models
+                  model = model_state.highres_models[0]
                   # this is lazy but should always be incremented to zero on the first loop
-                  self.control.highres_model_index = -1
+                  model_state.highres_model_index = -1
             else:
                 model = self.control.validate_model(value)
                 if model == '':
                     self.control.print("*** WARNING: prompt file command HIGHRES_CKPT_FILE value (" + value + ") doesn't match any server values; ignoring it! ***")
                 else:
                   # to cover cases where there are multiple !HIGHRES_CKPT_FILE directives in a single prompt file
-                  self.control.highres_models = []
-                  self.control.highres_model_index = 0
-            self.config.update({'highres_ckpt_file' : model})
+                  model_state.highres_models = []
+                  model_state.highres_model_index = 0
+            config.update({'highres_ckpt_file' : model})
 
         elif command == 'highres_vae':
             if value != '':
                 model = self.control.validate_VAE(value)
                 if model == '':
                     self.control.print("*** WARNING: prompt file command HIGHRES_VAE value (" + value + ") doesn't match any server values; ignoring it! ***")
-                    self.config.update({'highres_vae' : ''})
+                    config.update({'highres_vae' : ''})
                 else:
-                    self.config.update({'highres_vae' : model})
+                    config.update({'highres_vae' : model})
             else:
-                self.config.update({'highres_vae' : ''})
+                config.update({'highres_vae' : ''})
 
         elif command == 'highres_sampler':
             if value != '':
                 sampler = self.validate_sampler(value)
-                self.config.update({'highres_sampler' : sampler})
+                config.update({'highres_sampler' : sampler})
             else:
-                self.config.update({'highres_sampler' : ''})
+                config.update({'highres_sampler' : ''})
 
         elif command == 'highres_steps':
             if value != '':
@@ -475,15 +641,15 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'HIGHRES_STEPS' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'highres_steps' : value})
+                    config.update({'highres_steps' : value})
             else:
-                self.config.update({'highres_steps' : ''})
+                config.update({'highres_steps' : ''})
 
         elif command == 'highres_prompt':
-            self.config.update({'highres_prompt' : value})
+            config.update({'highres_prompt' : value})
 
         elif command == 'highres_neg_prompt':
-            self.config.update({'highres_neg_prompt' : value})
+            config.update({'highres_neg_prompt' : value})
 
         elif command == 'refiner_ckpt_file':
             model = ''
@@ -491,7 +657,7 @@ class PromptManager():
                 model = self.control.validate_model(value)
                 if model == '':
                     self.control.print("*** WARNING: prompt file command REFINER_CKPT_FILE value (" + value + ") doesn't match any server values; ignoring it! ***")
-            self.config.update({'refiner_ckpt_file' : model})
+            config.update({'refiner_ckpt_file' : model})
 
         elif command == 'refiner_switch':
             if value != '':
@@ -501,11 +667,11 @@ class PromptManager():
                     self.control.print("*** WARNING: specified 'REFINER_SWITCH' is not a valid number; it will be ignored!")
                 else:
                     if float(value) >= 0 and float(value) <= 1:
-                        self.config.update({'refiner_switch' : value})
+                        config.update({'refiner_switch' : value})
                     else:
                         self.control.print("*** WARNING: 'REFINER_SWITCH' value must be between 0-1; it will be ignored!")
             else:
-                self.config.update({'refiner_switch' : ''})
+                config.update({'refiner_switch' : ''})
 
         elif command == 'seed':
             if value != '':
@@ -514,19 +680,19 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'SEED' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'seed' : value})
+                    config.update({'seed' : value})
 
         elif command == 'steps':
             if value != '':
                 if self.validate_int_range(value):
-                    self.config.update({'steps' : value})
+                    config.update({'steps' : value})
                 else:
                     self.control.print("*** WARNING: specified 'STEPS' is not a valid number; it will be ignored!")
 
         elif command == 'scale':
             if value != '':
                 if self.validate_float_range(value):
-                    self.config.update({'scale' : value})
+                    config.update({'scale' : value})
                 else:
                     self.control.print("*** WARNING: specified 'SCALE' is not a valid number; it will be ignored!")
 
@@ -537,7 +703,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'MIN_SCALE' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'min_scale' : value})
+                    config.update({'min_scale' : value})
 
         elif command == 'max_scale':
             if value != '':
@@ -546,7 +712,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'MAX_SCALE' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'max_scale' : value})
+                    config.update({'max_scale' : value})
 
         elif command == 'samples':
             if value != '':
@@ -555,7 +721,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'SAMPLES' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'samples' : value})
+                    config.update({'samples' : value})
 
         elif command == 'batch_size':
             if value != '':
@@ -564,12 +730,12 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'BATCH_SIZE' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'batch_size' : value})
+                    config.update({'batch_size' : value})
 
         elif command == 'strength':
             if value != '':
                 if self.validate_float_range(value):
-                    self.config.update({'strength' : value})
+                    config.update({'strength' : value})
                 else:
                     self.control.print("*** WARNING: specified 'STRENGTH' is not a valid number; it will be ignored!")
 
@@ -580,7 +746,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'MIN_STRENGTH' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'min_strength' : value})
+                    config.update({'min_strength' : value})
 
         elif command == 'max_strength':
             if value != '':
@@ -589,11 +755,11 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'MAX_STRENGTH' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'max_strength' : value})
+                    config.update({'max_strength' : value})
 
         elif command == 'use_upscale':
             if value == 'yes' or value == 'no':
-                self.config.update({'use_upscale' : value})
+                config.update({'use_upscale' : value})
 
         elif command == 'upscale_amount':
             if value != '':
@@ -602,7 +768,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'UPSCALE_AMOUNT' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'upscale_amount' : value})
+                    config.update({'upscale_amount' : value})
 
         elif command == 'upscale_codeformer_amount':
             if value != '':
@@ -611,7 +777,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'UPSCALE_CODEFORMER_AMOUNT' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'upscale_codeformer_amount' : value})
+                    config.update({'upscale_codeformer_amount' : value})
 
         elif command == 'upscale_gfpgan_amount':
             if value != '':
@@ -620,7 +786,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'UPSCALE_GFPGAN_AMOUNT' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'upscale_gfpgan_amount' : value})
+                    config.update({'upscale_gfpgan_amount' : value})
 
         elif command == 'upscale_sd_strength':
             if value != '':
@@ -629,34 +795,34 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'UPSCALE_SD_STRENGTH' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'upscale_sd_strength' : value})
+                    config.update({'upscale_sd_strength' : value})
 
         elif command == 'upscale_keep_org':
             if value == 'yes' or value == 'no':
-                self.config.update({'upscale_keep_org' : value})
+                config.update({'upscale_keep_org' : value})
 
         elif command == 'upscale_model':
             if value != '':
                 upscale_model = self.control.validate_upscale_model(value.strip())
                 if upscale_model != '':
-                    self.config.update({'upscale_model' : upscale_model})
+                    config.update({'upscale_model' : upscale_model})
                 else:
                     self.control.print("*** WARNING: !UPSCALE_MODEL value (" + value.strip() + ") doesn't match any server values; ignoring it! ***")
             else:
-                self.config.update({'upscale_model' : 'ESRGAN_4x'})
+                config.update({'upscale_model' : 'ESRGAN_4x'})
 
         elif command == 'upscale_ult_model':
             if value != '':
                 if self.control.sdi_ultimate_upscale_available:
                     upscale_model = self.control.validate_ultimate_upscale_model(value.strip())
                     if upscale_model != '':
-                        self.config.update({'upscale_ult_model' : upscale_model})
+                        config.update({'upscale_ult_model' : upscale_model})
                     else:
                         self.control.print("*** WARNING: !UPSCALE_ULT_MODEL value (" + value.strip() + ") doesn't match any server values; ignoring it! ***")
                 else:
                     self.control.print("*** WARNING: !UPSCALE_ULT_MODEL isn't usuable without Auto1111 sd_ultimate_upscale extension installed; ignoring it! ***")
             else:
-                self.config.update({'upscale_ult_model' : ''})
+                config.update({'upscale_ult_model' : ''})
 
         elif command == 'override_max_output_size':
             value = value.replace(',', '')
@@ -667,11 +833,11 @@ class PromptManager():
                     self.control.print("*** WARNING: specified 'OVERRIDE_MAX_OUTPUT_SIZE' is not a valid number; it will be ignored!")
                 else:
                     if int(value) >= 262144:
-                        self.config.update({'override_max_output_size' : value})
+                        config.update({'override_max_output_size' : value})
                     else:
                         self.control.print("*** WARNING: specified 'OVERRIDE_MAX_OUTPUT_SIZE' is too low; it will be ignored!")
             else:
-                self.config.update({'override_max_output_size' : 0})
+                config.update({'override_max_output_size' : 0})
 
         elif command == 'override_steps':
             if value != '':
@@ -681,101 +847,101 @@ class PromptManager():
                     self.control.print("*** WARNING: specified 'OVERRIDE_STEPS' is not a valid number; it will be ignored!")
                 else:
                     if int(value) > 0:
-                        self.config.update({'override_steps' : value})
+                        config.update({'override_steps' : value})
                     else:
                         self.control.print("*** WARNING: specified 'OVERRIDE_STEPS' is too low; it will be ignored!")
             else:
-                self.config.update({'override_steps' : 0})
+                config.update({'override_steps' : 0})
 
         elif command == 'mode':
             if value == 'random' or value == 'standard' or value == 'process':
-                self.config.update({'mode' : value})
+                config.update({'mode' : value})
 
         elif command == 'input_image':
             if value != '':
                 orig_value = value
                 value = check_path(value)
                 if value != '':
-                    self.config.update({'input_image' : value})
+                    config.update({'input_image' : value})
                 else:
                     self.control.print("*** WARNING: specified 'INPUT_IMAGE' (" + orig_value + ") does not exist; it will be ignored!")
             else:
-                self.config.update({'input_image' : ''})
+                config.update({'input_image' : ''})
 
         elif command == 'random_input_image_dir':
             if value != '':
                 orig_value = value
                 value = check_path(value)
                 if value != '':
-                    self.config.update({'random_input_image_dir' : value})
+                    config.update({'random_input_image_dir' : value})
                 else:
                     self.control.print("*** WARNING: specified 'RANDOM_INPUT_IMAGE_DIR' (" + orig_value + ") does not exist; it will be ignored!")
 
         elif command == 'output_dir':
             if value != '':
                 #if os.path.exists(value):
-                self.config.update({'output_dir' : value})
+                config.update({'output_dir' : value})
                 #else:
                 #    self.control.print("*** WARNING: specified 'OUTPUT_DIR' (" + value + ") does not exist; it will be ignored!")
 
         elif command == 'seamless_tiling':
             if value == 'yes' or value == 'on':
-                self.config.update({'tiling' : True})
+                config.update({'tiling' : True})
             elif value == 'no' or value == 'off':
-                self.config.update({'tiling' : False})
+                config.update({'tiling' : False})
 
         elif command == 'controlnet_input_image':
             if value != '':
                 orig_value = value
                 value = check_path(value)
                 if value != '':
-                    self.config.update({'controlnet_input_image' : value})
+                    config.update({'controlnet_input_image' : value})
                 else:
                     self.control.print("*** WARNING: specified 'CONTROLNET_INPUT_IMAGE' (" + orig_value + ") does not exist; it will be ignored!")
             else:
-                self.config.update({'controlnet_input_image' : ''})
+                config.update({'controlnet_input_image' : ''})
 
         elif command == 'controlnet_pre':
             if value != '':
-                self.config.update({'controlnet_pre' : value})
+                config.update({'controlnet_pre' : value})
             else:
-                self.config.update({'controlnet_pre' : 'none'})
+                config.update({'controlnet_pre' : 'none'})
 
         elif command == 'controlnet_model':
             if value != '':
                 cn_model = self.validate_controlnet_model(value)
-                self.config.update({'controlnet_model' : cn_model})
+                config.update({'controlnet_model' : cn_model})
             else:
-                self.config.update({'controlnet_model' : ''})
+                config.update({'controlnet_model' : ''})
 
         elif command == 'controlnet_lowvram':
             if value == 'yes' or value == 'on':
-                self.config.update({'controlnet_lowvram' : True})
+                config.update({'controlnet_lowvram' : True})
             elif value == 'no' or value == 'off':
-                self.config.update({'controlnet_lowvram' : False})
+                config.update({'controlnet_lowvram' : False})
 
         elif command == 'controlnet_guessmode':
             self.control.print("*** WARNING: specified 'CONTROLNET_GUESSMODE' (" + value + ") is deprecated; it will be ignored in the latest ControlNet extension!")
             if value == 'yes' or value == 'on':
-                self.config.update({'controlnet_guessmode' : True})
+                config.update({'controlnet_guessmode' : True})
             elif value == 'no' or value == 'off':
-                self.config.update({'controlnet_guessmode' : False})
+                config.update({'controlnet_guessmode' : False})
 
         elif command == 'controlnet_controlmode':
             if value == 'balanced':
-                self.config.update({'controlnet_controlmode' : "Balanced"})
+                config.update({'controlnet_controlmode' : "Balanced"})
             elif value == 'prompt':
-                self.config.update({'controlnet_controlmode' : "My prompt is more important"})
+                config.update({'controlnet_controlmode' : "My prompt is more important"})
             elif value == 'controlnet':
-                self.config.update({'controlnet_controlmode' : "ControlNet is more important"})
+                config.update({'controlnet_controlmode' : "ControlNet is more important"})
             else:
                 self.control.print("*** WARNING: specified 'CONTROLNET_CONTROLMODE' (" + value + ") is not valid; it will be ignored!")
 
         elif command == 'controlnet_pixelperfect':
             if value == 'yes' or value == 'on':
-                self.config.update({'controlnet_pixelperfect' : True})
+                config.update({'controlnet_pixelperfect' : True})
             elif value == 'no' or value == 'off':
-                self.config.update({'controlnet_pixelperfect' : False})
+                config.update({'controlnet_pixelperfect' : False})
 
         elif command == 'controlnet_weight':
             if value != '':
@@ -784,28 +950,28 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'CONTROLNET_WEIGHT' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'controlnet_weight' : value})
+                    config.update({'controlnet_weight' : value})
 
         elif command == 'adetailer_use':
             if value == 'yes' or value == 'on':
                 if self.control.sdi_adetailer_available:
-                    self.config.update({'adetailer_use' : True})
+                    config.update({'adetailer_use' : True})
                 else:
                     self.control.print("*** WARNING: !ADETAILER_USE isn't usuable without Auto1111 adetailer extension installed; ignoring it! ***")
             elif value == 'no' or value == 'off':
-                self.config.update({'adetailer_use' : False})
+                config.update({'adetailer_use' : False})
 
         elif command == 'adetailer_model':
             if value != '':
-                self.config.update({'adetailer_model' : value})
+                config.update({'adetailer_model' : value})
             else:
-                self.config.update({'adetailer_model' : ''})
+                config.update({'adetailer_model' : ''})
 
         elif command == 'adetailer_prompt':
-            self.config.update({'adetailer_prompt' : value})
+            config.update({'adetailer_prompt' : value})
 
         elif command == 'adetailer_neg_prompt':
-            self.config.update({'adetailer_neg_prompt' : value})
+            config.update({'adetailer_neg_prompt' : value})
 
         elif command == 'adetailer_ckpt_file':
             if value != '':
@@ -813,20 +979,20 @@ class PromptManager():
                 if model == '':
                     self.control.print("*** WARNING: prompt file command ADETAILER_CKPT_FILE value (" + value + ") doesn't match any server values; ignoring it! ***")
                 else:
-                    self.config.update({'adetailer_ckpt_file' : model})
+                    config.update({'adetailer_ckpt_file' : model})
             else:
-                self.config.update({'adetailer_ckpt_file' : ''})
+                config.update({'adetailer_ckpt_file' : ''})
 
         elif command == 'adetailer_vae':
             if value != '':
                 model = self.control.validate_VAE(value)
                 if model == '':
                     self.control.print("*** WARNING: prompt file command ADETAILER_VAE value (" + value + ") doesn't match any server values; ignoring it! ***")
-                    self.config.update({'adetailer_vae' : ''})
+                    config.update({'adetailer_vae' : ''})
                 else:
-                    self.config.update({'adetailer_vae' : model})
+                    config.update({'adetailer_vae' : model})
             else:
-                self.config.update({'adetailer_vae' : ''})
+                config.update({'adetailer_vae' : ''})
 
         elif command == 'adetailer_strength':
             if value != '':
@@ -835,7 +1001,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'ADETAILER_STRENGTH' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'adetailer_strength' : value})
+                    config.update({'adetailer_strength' : value})
 
         elif command == 'adetailer_steps':
             if value != '':
@@ -844,9 +1010,9 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'ADETAILER_STEPS' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'adetailer_steps' : value})
+                    config.update({'adetailer_steps' : value})
             else:
-                self.config.update({'adetailer_steps' : ''})
+                config.update({'adetailer_steps' : ''})
 
         elif command == 'adetailer_width':
             if value != '':
@@ -855,9 +1021,9 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'ADETAILER_WIDTH' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'adetailer_width' : value})
+                    config.update({'adetailer_width' : value})
             else:
-                self.config.update({'adetailer_width' : ''})
+                config.update({'adetailer_width' : ''})
 
         elif command == 'adetailer_height':
             if value != '':
@@ -866,9 +1032,9 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'ADETAILER_HEIGHT' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'adetailer_height' : value})
+                    config.update({'adetailer_height' : value})
             else:
-                self.config.update({'adetailer_height' : ''})
+                config.update({'adetailer_height' : ''})
 
         elif command == 'adetailer_scale':
             if value != '':
@@ -877,7 +1043,7 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'ADETAILER_SCALE' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'adetailer_scale' : value})
+                    config.update({'adetailer_scale' : value})
 
         elif command == 'adetailer_clip_skip':
             if value != '':
@@ -886,16 +1052,16 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'ADETAILER_CLIP_SKIP' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'adetailer_clip_skip' : value})
+                    config.update({'adetailer_clip_skip' : value})
             else:
-                self.config.update({'adetailer_clip_skip' : ''})
+                config.update({'adetailer_clip_skip' : ''})
 
         elif command == 'adetailer_sampler':
             if value != '':
                 sampler = self.validate_sampler(value)
-                self.config.update({'adetailer_sampler' : sampler})
+                config.update({'adetailer_sampler' : sampler})
             else:
-                self.config.update({'adetailer_sampler' : ''})
+                config.update({'adetailer_sampler' : ''})
 
         elif command == 'repeat':
             if value == 'yes':
@@ -906,8 +1072,8 @@ class PromptManager():
         elif command == 'delim':
             if value != '':
                 if value.startswith('\"') and value.endswith('\"'):
-                    self.config.update({'delim' : value.strip('\"')})
-                    #print("New delim: \"" + self.config.get('delim')  + "\"")
+                    config.update({'delim' : value.strip('\"')})
+                    #print("New delim: \"" + config.get('delim')  + "\"")
                 else:
                     self.control.print("*** WARNING: prompt file command DELIM value (" + value + ") not understood (make sure to put quotes around it)! ***")
                     time.sleep(1.5)
@@ -924,7 +1090,7 @@ class PromptManager():
                             match = True
                             value += '.prompts'
                             value = os.path.join(os.path.abspath(self.control.config.get('prompts_location')), value)
-                            self.config.update({'next_prompt_file' : value})
+                            config.update({'next_prompt_file' : value})
                             break
             if not match:
                 self.control.print("*** WARNING: prompt file command NEXT_PROMPT_FILE value (" + value + ") is not a valid prompt file and will be ignored! ***")
@@ -941,16 +1107,16 @@ class PromptManager():
                         # the actual value is everything that follows the []
                         value = value.split('>', 1)[1]
                         # add the key/value pair to the history
-                        if key in self.config['iptc_title_history']:
-                            self.config['iptc_title_history'][key].append(value)
+                        if key in config['iptc_title_history']:
+                            config['iptc_title_history'][key].append(value)
                         else:
-                            self.config['iptc_title_history'][key] = [value]
+                            config['iptc_title_history'][key] = [value]
                     else:
-                        self.config['iptc_title'] += value[1:]
+                        config['iptc_title'] += value[1:]
                 else:
-                    self.config.update({'iptc_title' : value})
+                    config.update({'iptc_title' : value})
             else:
-                self.config.update({'iptc_title' : ''})
+                config.update({'iptc_title' : ''})
 
         elif command == 'iptc_description':
             if value != '':
@@ -963,16 +1129,16 @@ class PromptManager():
                         # the actual value is everything that follows the []
                         value = value.split('>', 1)[1]
                         # add the key/value pair to the history
-                        if key in self.config['iptc_description_history']:
-                            self.config['iptc_description_history'][key].append(value)
+                        if key in config['iptc_description_history']:
+                            config['iptc_description_history'][key].append(value)
                         else:
-                            self.config['iptc_description_history'][key] = [value]
+                            config['iptc_description_history'][key] = [value]
                     else:
-                        self.config['iptc_description'] += value[1:]
+                        config['iptc_description'] += value[1:]
                 else:
-                    self.config.update({'iptc_description' : value})
+                    config.update({'iptc_description' : value})
             else:
-                self.config.update({'iptc_description' : ''})
+                config.update({'iptc_description' : ''})
 
         elif command == 'iptc_keywords':
             if value != '':
@@ -999,31 +1165,31 @@ class PromptManager():
                     if addon:
                         if history:
                             # add the key/value pair to the history
-                            if key in self.config['iptc_keywords_history']:
-                                self.config['iptc_keywords_history'][key].append(keywords)
+                            if key in config['iptc_keywords_history']:
+                                config['iptc_keywords_history'][key].append(keywords)
                             else:
-                                self.config['iptc_keywords_history'][key] = [keywords]
+                                config['iptc_keywords_history'][key] = [keywords]
                         else:
                             #keywords[0] = keywords[0][1:]
                             for k in keywords:
-                                if k not in self.config['iptc_keywords']:
-                                    self.config['iptc_keywords'].append(k)
+                                if k not in config['iptc_keywords']:
+                                    config['iptc_keywords'].append(k)
                     else:
-                        self.config.update({'iptc_keywords' : keywords})
+                        config.update({'iptc_keywords' : keywords})
             else:
-                self.config.update({'iptc_keywords' : []})
+                config.update({'iptc_keywords' : []})
 
         elif command == 'iptc_copyright':
             if value != '':
-                self.config.update({'iptc_copyright' : value})
+                config.update({'iptc_copyright' : value})
             else:
-                self.config.update({'iptc_copyright' : ''})
+                config.update({'iptc_copyright' : ''})
 
         elif command == 'iptc_append':
             if value == 'yes' or value == 'on':
-                self.config.update({'iptc_append' : True})
+                config.update({'iptc_append' : True})
             elif value == 'no' or value == 'off':
-                self.config.update({'iptc_append' : False})
+                config.update({'iptc_append' : False})
 
         elif command == 'clip_skip':
             if value != '':
@@ -1032,31 +1198,31 @@ class PromptManager():
                 except:
                     self.control.print("*** WARNING: specified 'CLIP_SKIP' is not a valid number; it will be ignored!")
                 else:
-                    self.config.update({'clip_skip' : value})
+                    config.update({'clip_skip' : value})
             else:
-                self.config.update({'clip_skip' : ''})
+                config.update({'clip_skip' : ''})
 
         elif command == 'vae':
             if value != '':
                 model = self.control.validate_VAE(value)
                 if model == '':
                     self.control.print("*** WARNING: prompt file command VAE value (" + value + ") doesn't match any server values; ignoring it! ***")
-                    self.config.update({'vae' : ''})
+                    config.update({'vae' : ''})
                 else:
-                    self.config.update({'vae' : model})
+                    config.update({'vae' : model})
             else:
-                self.config.update({'vae' : ''})
+                config.update({'vae' : ''})
 
         elif command == 'override_vae':
             if value != '':
                 model = self.control.validate_VAE(value)
                 if model == '':
                     self.control.print("*** WARNING: prompt file command OVERRIDE_VAE value (" + value + ") doesn't match any server values; ignoring it! ***")
-                    self.config.update({'override_vae' : ''})
+                    config.update({'override_vae' : ''})
                 else:
-                    self.config.update({'override_vae' : model})
+                    config.update({'override_vae' : model})
             else:
-                self.config.update({'override_vae' : ''})
+                config.update({'override_vae' : ''})
 
         elif command == 'styles':
             if value != '':
@@ -1082,7 +1248,7 @@ class PromptManager():
                     else:
                         self.control.print("*** WARNING: prompt file command STYLES value (" + value + ") not understood; assuming 1 random style! ***")
                         final += ' 1'
-                    self.config.update({'styles' : [final]})
+                    config.update({'styles' : [final]})
                 else:
                     # validate user-supplied styles
                     styles = []
@@ -1093,9 +1259,9 @@ class PromptManager():
                             self.control.print("*** WARNING: prompt file command STYLES value (" + s + ") doesn't match any server values; ignoring it! ***")
                         else:
                             styles.append(style)
-                    self.config.update({'styles' : styles})
+                    config.update({'styles' : styles})
             else:
-                self.config.update({'styles' : []})
+                config.update({'styles' : []})
 
         elif command == 'ckpt_file':
             model = ''
@@ -1103,12 +1269,12 @@ class PromptManager():
                 if value == 'all':
                     # we're queueing all the models; copy the validated model list
                     if self.control.sdi_models != None and len(self.control.sdi_models) > 0:
-                        self.control.models = []
+                        model_state.models = []
                         for m in self.control.sdi_models:
-                            self.control.models.append(m['name'])
-                        model = self.control.models[0]
+                            model_state.models.append(m['name'])
+                        model = model_state.models[0]
                         # this is lazy but should always be incremented to zero on the first loop
-                        self.control.model_index = -1
+                        model_state.model_index = -1
                     else:
                         self.control.print("*** WARNING: unable to validate 'CKPT_FILE = all' (has your GPU finished initializing?)! ***")
                 elif ',' in value:
@@ -1124,19 +1290,19 @@ class PromptManager():
                     if len(validated_models) > 0:
                         # we have at least one valid model, start with the first one
                         # store list with the controller
-                        self.control.models = validated_models
-                        model = self.control.models[0]
+                        model_state.models = validated_models
+                        model = model_state.models[0]
                         # this is lazy but should always be incremented to zero on the first loop
-                        self.control.model_index = -1
+                        model_state.model_index = -1
                 else:
                     model = self.control.validate_model(value)
                     if model == '':
                         self.control.print("*** WARNING: prompt file command CKPT_FILE value (" + value + ") doesn't match any server values; ignoring it! ***")
                     else:
                         # to cover cases where there are multiple !CKPT_FILE directives in a single prompt file
-                        self.control.models = []
-                        self.control.model_index = 0
-            self.config.update({'ckpt_file' : model})
+                        model_state.models = []
+                        model_state.model_index = 0
+            config.update({'ckpt_file' : model})
 
         elif command == 'override_ckpt_file':
             if value != '':
@@ -1144,26 +1310,26 @@ class PromptManager():
                 if model == '':
                     self.control.print("*** WARNING: prompt file command OVERRIDE_CKPT_FILE value (" + value + ") doesn't match any server values; ignoring it! ***")
                 else:
-                    self.config.update({'override_ckpt_file' : model})
+                    config.update({'override_ckpt_file' : model})
             else:
-                self.config.update({'override_ckpt_file' : ''})
+                config.update({'override_ckpt_file' : ''})
 
         elif command == 'sampler':
             sampler = self.validate_sampler(value)
-            self.config.update({'sampler' : sampler})
+            config.update({'sampler' : sampler})
 
         elif command == 'override_sampler':
             if value != '':
                 sampler = self.validate_sampler(value)
-                self.config.update({'override_sampler' : sampler})
+                config.update({'override_sampler' : sampler})
             else:
-                self.config.update({'override_sampler' : ''})
+                config.update({'override_sampler' : ''})
 
         elif command == 'neg_prompt':
-            self.config.update({'neg_prompt' : value})
+            config.update({'neg_prompt' : value})
 
         elif command == 'filename':
-            self.config.update({'filename' : value})
+            config.update({'filename' : value})
 
         else:
             self.control.print("*** WARNING: prompt file command not recognized: " + command.upper() + " (it will be ignored)! ***")
@@ -1228,27 +1394,41 @@ class PromptManager():
                     self.handle_directive(command, value)
 
 
-    # return a list of all possible PromptSection combinations
+    # returns a lazy WorkQueue of every combination of the PromptSections
+    # embedded !DIRECTIVES are applied as the queue reaches them, just as if it had been built up front
     def build_combinations(self):
-        prompt_work_queue = deque()
+        prompt_work_queue = WorkQueue()
+        prompt_work_queue.add_source(self.iter_combinations(), self.count_combinations())
+        return prompt_work_queue
+
 
+    # generator that yields the work item(s) for each combination of the PromptSections in turn
+    # if config is given, the generator works from (and applies embedded directives to) that config
+    # instead of self.config and leaves the controller's model list alone, so that several of them
+    # can be consumed side by side; extra is merged into every work item
+    def iter_combinations(self, config = None, extra = None):
         # convert PromptSections to simple lists so they're iterable
         all_prompts = list()
         for ps in self.prompts:
             prompts = list()
             prompts = ps.tokens
             all_prompts.append(prompts)
+        return self.generate_combinations(all_prompts, self.control.prompt_file, config, extra)
 
-        # get all possible combos
-        prompt_combos = itertools.product(*all_prompts)
 
-        # associate a copy of config info with each prompt
-        for prompt in prompt_combos:
-            #work = self.config.copy()
-            # switched to deep copy here to handle IPTC metadata history stuff
-            work = copy.deepcopy(self.config)
+    def generate_combinations(self, all_prompts, prompt_file, config, extra):
+        detached = config != None
 
-            work['prompt_file'] = self.control.prompt_file
+        # directory listings for INPUT_IMAGE/CONTROLNET_INPUT_IMAGE, looked up once per directory
+        dir_cache = {}
+
+        # jobs share a snapshot of the config until a directive changes it
+        snapshot = None
+
+        # all possible combos, generated one at a time
+        for prompt in itertools.product(*all_prompts):
+            if not detached:
+                config = self.config
             str_prompt = ""
             fragments = 0
             is_directive = False
@@ -1261,67 +1441,113 @@ class PromptManager():
                     command = ss.group(1).lower().strip()
                     #value = fragment.split("=",1)[1].lower().strip()
                     value = fragment.split("=",1)[1].strip()
-                    self.handle_directive(command, value)
+                    if detached:
+                        self.handle_detached_directive(config, command, value)
+                    else:
+                        self.handle_directive(command, value)
                     is_directive = True
                     break
 
                 if fragment.strip() != '.':
                     if fragments > 0:
                         if not (fragment.startswith(',') or fragment.startswith(';')):
-                            str_prompt += self.config.get('delim')
+                            str_prompt += config.get('delim')
                     str_prompt += fragment
                     fragments += 1
 
-            if not is_directive:
-                work['prompt'] = str_prompt
-
-                # check for input/controlnet input images that are directories
-                # if found, iterate over contained files, submit work for each
-                subdir_processed = False
-                if os.path.isdir(work['input_image']) and os.path.isdir(work['controlnet_input_image']):
-                    # need to add combination of input/control files
-                    input_files = get_images_in_dir(work['input_image'])
-                    controlnet_files = get_images_in_dir(work['controlnet_input_image'])
-                    if len(input_files) > 0 and len(controlnet_files) > 0:
-                        subdir_processed = True
-                        for i in input_files:
-                            for c in controlnet_files:
-                                work['input_image'] = i
-                                work['controlnet_input_image'] = c
-                                prompt_work_queue.append(work.copy())
-                    #else:
-                        # one or both directories are empty, fall through to below and handle
-
-                if not subdir_processed and os.path.isdir(work['input_image']):
-                    # input image is a directory, add a work item for each file
-                    files = get_images_in_dir(work['input_image'])
-                    if len(files) > 0:
-                        subdir_processed = True
-                        for f in files:
-                            # queue each image in the input dir
-                            work['input_image'] = f
-                            prompt_work_queue.append(work.copy())
-                    else:
-                        self.control.print("*** WARNING: prompt file command INPUT_IMAGE refers to an empty directory (" + work['input_image'] + "); ignoring it! ***")
-                        work['input_image'] = ''
-
-                if not subdir_processed and os.path.isdir(work['controlnet_input_image']):
-                    # ControlNet input image is a directory, add a work item for each file
-                    files = get_images_in_dir(work['controlnet_input_image'])
-                    if len(files) > 0:
-                        subdir_processed = True
-                        for f in files:
-                            # queue each image in the input dir
-                            work['controlnet_input_image'] = f
-                            prompt_work_queue.append(work.copy())
-                    else:
-                        self.control.print("*** WARNING: prompt file command CONTROLNET_INPUT_IMAGE refers to an empty directory (" + work['controlnet_input_image'] + "); ignoring it! ***")
-                        work['controlnet_input_image'] = ''
+            if is_directive:
+                # if the directive changed anything, take a new snapshot when the next job is queued
+                if snapshot != None and snapshot.values != config:
+                    snapshot = None
+                continue
+
+            if snapshot == None:
+                snapshot = ConfigSnapshot(config)
+            work = Job(snapshot, {'prompt_file' : prompt_file, 'prompt' : str_prompt})
+            if extra != None:
+                work.update(extra)
+
+            # input/controlnet input images that are directories get a work item for each contained file
+            for input_image, controlnet_input_image in self.expand_input_dirs(work, dir_cache):
+                job = work.copy()
+                job['input_image'] = input_image
+                job['controlnet_input_image'] = controlnet_input_image
+                yield job
+
+
+    # handles an embedded directive for a detached iter_combinations generator: only the
+    # generator's own config is changed, model list directives go to a throwaway copy of the
+    # controller's model queue; nothing shared is touched, so lanes can generate side by side
+    def handle_detached_directive(self, config, command, value):
+        model_state = types.SimpleNamespace(models = list(self.control.models), \
+            model_index = self.control.model_index, \
+            highres_models = list(self.control.highres_models), \
+            highres_model_index = self.control.highres_model_index)
+        self.handle_directive(command, value, config, model_state)
+
+
+    # returns the list of (input image, controlnet input image) pairs to queue for a work item;
+    # each file is used when INPUT_IMAGE and/or CONTROLNET_INPUT_IMAGE is a directory
+    def expand_input_dirs(self, work, dir_cache, warn = True):
+        input_image = work['input_image']
+        controlnet_input_image = work['controlnet_input_image']
+        input_files = self.list_input_dir(input_image, dir_cache)
+        controlnet_files = self.list_input_dir(controlnet_input_image, dir_cache)
+
+        if input_files and controlnet_files:
+            # need to add combination of input/control files
+            return [(i, c) for i in input_files for c in controlnet_files]
+        # one or both directories are empty, handle them individually
+
+        if input_files != None:
+            if len(input_files) > 0:
+                return [(f, controlnet_input_image) for f in input_files]
+            if warn:
+                self.control.print("*** WARNING: prompt file command INPUT_IMAGE refers to an empty directory (" + input_image + "); ignoring it! ***")
+            input_image = ''
+
+        if controlnet_files != None:
+            if len(controlnet_files) > 0:
+                return [(input_image, f) for f in controlnet_files]
+            if warn:
+                self.control.print("*** WARNING: prompt file command CONTROLNET_INPUT_IMAGE refers to an empty directory (" + controlnet_input_image + "); ignoring it! ***")
+            controlnet_input_image = ''
+
+        return [(input_image, controlnet_input_image)]
+
+
+    # returns the images in path if it's a directory, otherwise None
+    def list_input_dir(self, path, dir_cache):
+        if path not in dir_cache:
+            dir_cache[path] = None
+            if os.path.isdir(path):
+                dir_cache[path] = get_images_in_dir(path)
+        return dir_cache[path]
+
+
+    # returns the names (lowercase) of the !DIRECTIVES embedded in the [prompts] sections
+    def embedded_directives(self):
+        directives = set()
+        for ps in self.prompts:
+            for token in ps.tokens:
+                ss = re.search('!(.+?)=', token)
+                if ss:
+                    directives.add(ss.group(1).lower().strip())
+        return directives
 
-                if not subdir_processed:
-                    prompt_work_queue.append(work.copy())
 
-        return prompt_work_queue
+    # closed-form count of the work items build_combinations will produce: the product of the
+    # non-directive line counts of each section, times the input image directory expansion
+    # (exact unless embedded directives change INPUT_IMAGE/CONTROLNET_INPUT_IMAGE partway through)
+    def count_combinations(self, config = None):
+        if config == None:
+            config = self.config
+        count = 1
+        for ps in self.prompts:
+            count *= len([t for t in ps.tokens if not re.search('!(.+?)=', t)])
+        if count > 0:
+            count *= len(self.expand_input_dirs(config, {}, False))
+        return count
 
 
     # for !MODE = process
@@ -1386,7 +1612,8 @@ class PromptManager():
 
                         # if these are going to be SD upscaled, then
                         # sort files by model used to minimize loads
-                        if work['use_upscale'] == 'yes' and work['upscale_model'] == 'sd':
+                        models = {}
+                        if work['use_upscale'] == 'yes' and (work['upscale_model'] == 'sd' or work['upscale_model'] == 'ultimate'):
                             sorted_files = []
                             for x in files:
                                 fm = {}
@@ -1410,6 +1637,7 @@ class PromptManager():
                             files = []
                             for fm in sorted_files:
                                 files.append(fm['file'])
+                                models[fm['file']] = fm['model']
 
 
                         if len(files) > 0:
@@ -1417,6 +1645,9 @@ class PromptManager():
                             for f in files:
                                 # queue each image in the input dir
                                 work['input_image'] = f
+                                # remember the original model so the queue planner/dispatcher can group by it
+                                if f in models:
+                                    work['original_ckpt_file'] = models[f]
                                 prompt_work_queue.append(work.copy())
                         else:
                             self.control.print("*** WARNING: prompt file command INPUT_IMAGE refers to an empty directory (" + work['input_image'] + "); ignoring it! ***")
@@ -2205,12 +2436,8 @@ def create_zip(dir):
 def get_image_size(filepath):
     size = []
     if os.path.exists(filepath):
-        try:
-           with Image.open(filepath) as img:
-               width, height = img.size
-               size = [width, height]
-        except:
-           size = []
+        # dimensions are cached along with the encoded image (see scripts/imagecache.py)
+        size = imagecache.cache.dimensions(filepath)
 
         if len(size) == 2:
             if size[0] % 64 != 0:
@@ -0,0 +1,95 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# the on-disk SD catalog cache (scripts/catalog.py)
+
+import os
+import json
+import pytest
+import scripts.catalog as catalog
+
+CATALOG = {'sdi_models': [{'name': 'modelA.safetensors [aaaa]'}], 'sdi_samplers': [{'name': 'Euler'}], 'sdi_adetailer_available': False}
+
+
+@pytest.fixture
+def sd(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, 'CATALOG_FILE', str(tmp_path / 'cache' / 'catalog.json'))
+    sd = tmp_path / 'sd'
+    (sd / 'models' / 'Stable-diffusion').mkdir(parents=True)
+    (sd / 'models' / 'Stable-diffusion' / 'modelA.safetensors').write_bytes(b'a')
+    (sd / 'embeddings').mkdir()
+    (sd / 'extensions' / 'sd-webui-controlnet' / 'scripts').mkdir(parents=True)
+    (sd / 'styles.csv').write_text('name,prompt\n')
+    return sd
+
+
+# directory mtimes only change as fast as the filesystem's clock ticks; make sure they move
+def touch_dir(path):
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def test_fingerprint_is_stable(sd):
+    assert catalog.fingerprint(str(sd)) == catalog.fingerprint(str(sd))
+
+
+def test_adding_a_model_changes_the_fingerprint(sd):
+    before = catalog.fingerprint(str(sd))
+    (sd / 'models' / 'Stable-diffusion' / 'modelB.safetensors').write_bytes(b'b')
+    touch_dir(sd / 'models' / 'Stable-diffusion')
+    assert catalog.fingerprint(str(sd)) != before
+
+
+def test_adding_an_extension_changes_the_fingerprint(sd):
+    before = catalog.fingerprint(str(sd))
+    (sd / 'extensions' / 'adetailer').mkdir()
+    touch_dir(sd / 'extensions')
+    assert catalog.fingerprint(str(sd)) != before
+
+
+def test_files_inside_extensions_are_ignored(sd):
+    before = catalog.fingerprint(str(sd))
+    scripts = sd / 'extensions' / 'sd-webui-controlnet' / 'scripts'
+    (scripts / 'new.py').write_text('')
+    touch_dir(scripts)
+    assert catalog.fingerprint(str(sd)) == before
+
+
+def test_editing_styles_changes_the_fingerprint(sd):
+    before = catalog.fingerprint(str(sd))
+    (sd / 'styles.csv').write_text('name,prompt\nnew,style\n')
+    assert catalog.fingerprint(str(sd)) != before
+
+
+def test_save_and_load(sd):
+    fingerprint = catalog.fingerprint(str(sd))
+    assert catalog.load(fingerprint) == None
+    assert catalog.save(fingerprint, CATALOG)
+    assert catalog.load(fingerprint) == CATALOG
+    assert not os.path.exists(catalog.CATALOG_FILE + '.tmp')
+
+
+def test_other_fingerprints_are_rejected(sd):
+    catalog.save('abc', CATALOG)
+    assert catalog.load('def') == None
+
+
+@pytest.mark.parametrize('data', [
+    {'version': catalog.CATALOG_VERSION + 1, 'fingerprint': 'abc', 'catalog': CATALOG},
+    {'fingerprint': 'abc', 'catalog': CATALOG},
+    {'version': catalog.CATALOG_VERSION, 'fingerprint': 'abc', 'catalog': {'sdi_samplers': []}},
+    {'version': catalog.CATALOG_VERSION, 'fingerprint': 'abc', 'catalog': ['not', 'a', 'dict']},
+    ['not', 'a', 'dict']
+], ids=['newer version', 'no version', 'no models', 'bad catalog', 'bad file'])
+def test_unusable_catalogs_are_rejected(sd, data):
+    os.makedirs(os.path.dirname(catalog.CATALOG_FILE))
+    with open(catalog.CATALOG_FILE, 'w') as f:
+        json.dump(data, f)
+    assert catalog.load('abc') == None
+
+
+def test_corrupt_file_is_rejected(sd):
+    os.makedirs(os.path.dirname(catalog.CATALOG_FILE))
+    with open(catalog.CATALOG_FILE, 'w') as f:
+        f.write('{"version": 1, "finger')
+    assert catalog.load('abc') == None
@@ -0,0 +1,120 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# txt2img/img2img responses: the streamed reader (scripts/streamjson.py) and parse_generation_info()
+# in scripts/sdi.py, run against the response fixtures in tests/fixtures
+
+import io
+import os
+import json
+import base64
+import pytest
+from PIL import Image
+import scripts.streamjson as streamjson
+from scripts.sdi import parse_generation_info
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixture_bytes(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+# splits data into chunks of size bytes, the way the response arrives from the network
+def chunked(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+# what read_response() should return for a response: images decoded, SKIPPED members left out
+def expected_fields(data):
+    fields = json.loads(data)
+    for key in streamjson.SKIPPED:
+        fields.pop(key, None)
+    fields['images'] = [base64.b64decode(image) for image in fields['images']]
+    return fields
+
+
+@pytest.mark.parametrize('name', ['txt2img-batch.json', 'txt2img-grid.json', 'img2img-controlnet.json'])
+@pytest.mark.parametrize('size', [1, 7, 64, streamjson.CHUNK_SIZE])
+def test_streamed_response_matches_json(name, size):
+    data = fixture_bytes(name)
+    fields, stream = streamjson.read_response(chunked(data, size))
+    assert fields == expected_fields(data)
+    assert stream.received == len(data)
+
+
+def test_skipped_members_are_not_kept():
+    # img2img echoes its init and ControlNet images back in 'parameters'
+    data = fixture_bytes('img2img-controlnet.json')
+    assert 'init_images' in json.loads(data)['parameters']
+    fields, stream = streamjson.read_response(chunked(data, 64))
+    assert 'parameters' not in fields
+    # the echoed images are skipped, not decoded
+    assert stream.held == sum(len(image) for image in fields['images'])
+
+
+def test_streamed_images_are_pngs():
+    fields, stream = streamjson.read_response(chunked(fixture_bytes('txt2img-batch.json'), 100))
+    for data in fields['images']:
+        assert Image.open(io.BytesIO(data)).format == 'PNG'
+
+
+def test_escaped_strings_are_unescaped():
+    fields, stream = streamjson.read_response(chunked(fixture_bytes('txt2img-batch.json'), 3))
+    info = json.loads(fields['info'])
+    assert info['prompt'] == 'a lighthouse at dusk, "oil painting" étude'
+    assert '\nNegative prompt: ' in info['infotexts'][0]
+
+
+def test_data_url_prefix_is_stripped():
+    png = base64.b64decode(json.loads(fixture_bytes('txt2img-batch.json'))['images'][0])
+    data = b'{"image": "data:image/png;base64,' + base64.b64encode(png) + b'"}'
+    fields, stream = streamjson.read_response(chunked(data, 5))
+    assert fields['image'] == png
+
+
+def test_truncated_response_is_an_error():
+    data = fixture_bytes('txt2img-batch.json')
+    with pytest.raises(ValueError):
+        streamjson.read_response(chunked(data[:len(data) // 2], 64))
+
+
+def test_generation_info_for_batch():
+    fields, stream = streamjson.read_response([fixture_bytes('txt2img-batch.json')])
+    parsed = parse_generation_info(fields)
+    assert [seed for info, seed in parsed] == ['3095011234', '3095011235']
+    assert parsed[0][0] == json.loads(fields['info'])['infotexts'][0]
+
+
+def test_generation_info_with_grid():
+    # the grid comes first and shares the first image's infotext; all_seeds starts at index_of_first_image
+    fields, stream = streamjson.read_response([fixture_bytes('txt2img-grid.json')])
+    parsed = parse_generation_info(fields)
+    assert len(parsed) == 3
+    assert [seed for info, seed in parsed] == ['771', '771', '772']
+
+
+def test_generation_info_seed_from_all_seeds():
+    # infotexts without a Seed: fall back to all_seeds, offset by index_of_first_image
+    fields, stream = streamjson.read_response([fixture_bytes('txt2img-grid.json')])
+    info = json.loads(fields['info'])
+    info['infotexts'] = [text.replace('Seed: ', 'Noise: ') for text in info['infotexts']]
+    fields['info'] = json.dumps(info)
+    assert [seed for info, seed in parse_generation_info(fields)] == ['0', '771', '772']
+
+
+def test_generation_info_controlnet_detected_map():
+    # the ControlNet detected map appended after the generated image has no infotext
+    fields, stream = streamjson.read_response([fixture_bytes('img2img-controlnet.json')])
+    parsed = parse_generation_info(fields)
+    assert len(parsed) == 2
+    assert parsed[0][1] == '42'
+    assert 'ControlNet 0: ' in parsed[0][0]
+    assert parsed[1] == None
+
+
+@pytest.mark.parametrize('info', [None, '', 'not json', '[1, 2]'])
+def test_generation_info_without_usable_info(info):
+    fields = {'images': [b'a', b'b'], 'info': info}
+    assert parse_generation_info(fields) == [None, None]
@@ -0,0 +1,101 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# GPU discovery (scripts/gpus.py)
+
+import subprocess
+import pytest
+import scripts.gpus as gpus
+
+DEVICES = [
+    [0, 'NVIDIA GeForce RTX 3090', 'GPU-6b1e1a4c-0d5e-4a5f-9c1e-2b3a4c5d6e7f'],
+    [1, 'NVIDIA GeForce RTX 4090', 'GPU-0f9e8d7c-6b5a-4f3e-8d2c-1b0a9f8e7d6c'],
+    [2, 'NVIDIA RTX A6000', 'GPU-a1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c5d']
+]
+
+NVIDIA_SMI_OUTPUT = """GPU 0: NVIDIA GeForce RTX 3090 (UUID: GPU-6b1e1a4c-0d5e-4a5f-9c1e-2b3a4c5d6e7f)
+GPU 1: NVIDIA GeForce RTX 4090 (UUID: GPU-0f9e8d7c-6b5a-4f3e-8d2c-1b0a9f8e7d6c)
+  MIG 1g.10gb     Device  0: (UUID: MIG-11111111-2222-3333-4444-555555555555)
+GPU 2: NVIDIA RTX A6000 (UUID: GPU-a1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c5d)
+"""
+
+
+@pytest.fixture
+def nvidia_smi(monkeypatch):
+    result = {'returncode': 0, 'stdout': NVIDIA_SMI_OUTPUT, 'error': None}
+    def run(args, **kwargs):
+        assert args == ['nvidia-smi', '-L']
+        if result['error'] != None:
+            raise result['error']
+        return subprocess.CompletedProcess(args, result['returncode'], result['stdout'], '')
+    monkeypatch.setattr(gpus.subprocess, 'run', run)
+    return result
+
+
+def test_nvidia_smi_output_is_parsed(nvidia_smi):
+    assert gpus.nvidia_smi_devices() == DEVICES
+
+
+def test_nvidia_smi_without_uuids(nvidia_smi):
+    nvidia_smi['stdout'] = 'GPU 0: Tesla T4\nGPU 1: Tesla T4\n'
+    assert gpus.nvidia_smi_devices() == [[0, 'Tesla T4', ''], [1, 'Tesla T4', '']]
+
+
+@pytest.mark.parametrize('failure', ['missing', 'failed', 'timeout'])
+def test_nvidia_smi_unavailable(nvidia_smi, failure):
+    if failure == 'missing':
+        nvidia_smi['error'] = FileNotFoundError('nvidia-smi')
+    elif failure == 'timeout':
+        nvidia_smi['error'] = subprocess.TimeoutExpired('nvidia-smi', gpus.NVIDIA_SMI_TIMEOUT)
+    else:
+        nvidia_smi['returncode'] = 9
+        nvidia_smi['stdout'] = 'NVIDIA-SMI has failed because it couldn\'t communicate with the NVIDIA driver.'
+    assert gpus.nvidia_smi_devices() == None
+
+
+@pytest.mark.parametrize('setting, expected', [
+    (None, [[0, 'NVIDIA GeForce RTX 3090'], [1, 'NVIDIA GeForce RTX 4090'], [2, 'NVIDIA RTX A6000']]),
+    ('2,0', [[0, 'NVIDIA RTX A6000'], [1, 'NVIDIA GeForce RTX 3090']]),
+    (' 1 ', [[0, 'NVIDIA GeForce RTX 4090']]),
+    ('GPU-a1b2c3d4', [[0, 'NVIDIA RTX A6000']]),
+    ('0,GPU-0f9e', [[0, 'NVIDIA GeForce RTX 3090'], [1, 'NVIDIA GeForce RTX 4090']]),
+    # CUDA stops at the first entry it can't use
+    ('1,7,0', [[0, 'NVIDIA GeForce RTX 4090']]),
+    ('', []),
+    ('-1', [])
+])
+def test_cuda_visible_devices(monkeypatch, setting, expected):
+    if setting == None:
+        monkeypatch.delenv('CUDA_VISIBLE_DEVICES', raising=False)
+    else:
+        monkeypatch.setenv('CUDA_VISIBLE_DEVICES', setting)
+    assert gpus.visible(DEVICES) == expected
+
+
+def test_detect_prefers_nvml(monkeypatch):
+    monkeypatch.delenv('CUDA_VISIBLE_DEVICES', raising=False)
+    monkeypatch.setattr(gpus, 'nvml_devices', lambda: DEVICES[:1])
+    monkeypatch.setattr(gpus, 'nvidia_smi_devices', lambda: pytest.fail('nvidia-smi used'))
+    assert gpus.detect() == ([[0, 'NVIDIA GeForce RTX 3090']], 'NVML')
+
+
+def test_detect_falls_back_to_nvidia_smi(monkeypatch, nvidia_smi):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '1')
+    monkeypatch.setattr(gpus, 'nvml_devices', lambda: None)
+    assert gpus.detect() == ([[0, 'NVIDIA GeForce RTX 4090']], 'nvidia-smi')
+
+
+def test_detect_falls_back_to_torch(monkeypatch):
+    monkeypatch.setattr(gpus, 'nvml_devices', lambda: None)
+    monkeypatch.setattr(gpus, 'nvidia_smi_devices', lambda: None)
+    monkeypatch.setattr(gpus, 'torch_devices', lambda: [[0, 'torch GPU']])
+    assert gpus.detect() == ([[0, 'torch GPU']], 'torch')
+
+
+def test_quick_name(monkeypatch):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '2')
+    monkeypatch.setattr(gpus, 'nvml_devices', lambda: DEVICES)
+    assert gpus.quick_name(0) == 'NVIDIA RTX A6000'
+    assert gpus.quick_name(1) == ''
+    monkeypatch.setattr(gpus, 'nvml_devices', lambda: None)
+    assert gpus.quick_name(0) == None
@@ -0,0 +1,81 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# the input image cache (scripts/imagecache.py)
+
+import os
+import base64
+from PIL import Image
+from scripts.imagecache import ImageCache, ENTRY_OVERHEAD
+
+
+def make_image(path, size = (8, 8), color = (255, 0, 0)):
+    Image.new('RGB', size, color).save(str(path))
+    return str(path)
+
+
+def encoded_cost(path):
+    return len(base64.b64encode(open(path, 'rb').read())) + ENTRY_OVERHEAD
+
+
+def test_encoded_and_dimensions_are_cached(tmp_path):
+    path = make_image(tmp_path / 'a.png', (16, 8))
+    cache = ImageCache()
+    encoded = cache.encoded(path)
+    assert base64.b64decode(encoded) == open(path, 'rb').read()
+    assert cache.encoded(path) is encoded
+    assert cache.dimensions(path) == [16, 8]
+    assert cache.dimensions(path) == [16, 8]
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert len(cache.entries) == 1
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    paths = [make_image(tmp_path / (name + '.png')) for name in 'abc']
+    cache = ImageCache(encoded_cost(paths[0]) * 2)
+    cache.encoded(paths[0])
+    cache.encoded(paths[1])
+    # using a makes b the least recently used
+    cache.encoded(paths[0])
+    cache.encoded(paths[2])
+    cached = [key[0] for key in cache.entries]
+    assert cached == [os.path.abspath(paths[0]), os.path.abspath(paths[2])]
+    assert cache.used <= cache.budget
+
+
+def test_shrinking_the_budget_evicts(tmp_path):
+    paths = [make_image(tmp_path / (name + '.png')) for name in 'ab']
+    cache = ImageCache()
+    for path in paths:
+        cache.encoded(path)
+    cache.configure(encoded_cost(paths[0]))
+    assert [key[0] for key in cache.entries] == [os.path.abspath(paths[1])]
+    assert cache.used == encoded_cost(paths[1])
+
+
+def test_changed_file_replaces_its_entry(tmp_path):
+    path = make_image(tmp_path / 'a.png', (8, 8))
+    cache = ImageCache()
+    assert cache.dimensions(path) == [8, 8]
+    make_image(tmp_path / 'a.png', (32, 16))
+    os.utime(path, ns=(0, 123456789))
+    assert cache.dimensions(path) == [32, 16]
+    assert len(cache.entries) == 1
+
+
+def test_images_too_large_or_disabled_are_not_cached(tmp_path):
+    path = make_image(tmp_path / 'a.png')
+    assert ImageCache(ENTRY_OVERHEAD).encoded(path) == None
+    disabled = ImageCache(0)
+    assert disabled.encoded(path) == None
+    assert disabled.dimensions(path) == [8, 8]
+    assert len(disabled.entries) == 0
+
+
+def test_missing_and_invalid_files(tmp_path):
+    cache = ImageCache()
+    assert cache.encoded(str(tmp_path / 'missing.png')) == None
+    assert cache.dimensions(str(tmp_path / 'missing.png')) == []
+    bad = tmp_path / 'bad.png'
+    bad.write_bytes(b'not an image')
+    assert cache.dimensions(str(bad)) == []
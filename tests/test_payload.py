@@ -0,0 +1,95 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# request body building (scripts/payload.py): PayloadImages are swapped for placeholders,
+# the rest is serialized, and each image is encoded into its place
+
+import io
+import json
+import base64
+import pytest
+from PIL import Image
+import scripts.payload as payloads
+import scripts.imagecache as imagecache
+
+
+def png_bytes(size = (8, 8), color = (0, 128, 255)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def data_url(data):
+    return 'data:image/png;base64,' + base64.b64encode(data).decode()
+
+
+# budget 0 streams files from disk, the default budget serves them from the cache
+@pytest.fixture(params=[0, 64 * 1024 * 1024], ids=['streamed', 'cached'])
+def cache(request, monkeypatch):
+    cache = imagecache.ImageCache(request.param)
+    monkeypatch.setattr(imagecache, 'cache', cache)
+    return cache
+
+
+def test_images_are_encoded_in_place(tmp_path, cache):
+    file_data = png_bytes((64, 48))
+    path = tmp_path / 'init.png'
+    path.write_bytes(file_data)
+    memory_data = png_bytes((8, 8), (1, 2, 3))
+    payload = {
+        'prompt': 'a "quoted" prompt, étude',
+        'init_images': [payloads.PayloadImage(path=str(path))],
+        'alwayson_scripts': {'controlnet': {'args': [{'input_image': payloads.PayloadImage(data=memory_data), 'weight': 1.0}]}},
+        'steps': 20
+    }
+    body = payloads.encode_payload(payload)
+    assert isinstance(body, bytearray)
+    decoded = json.loads(bytes(body))
+    assert decoded == {
+        'prompt': 'a "quoted" prompt, étude',
+        'init_images': [data_url(file_data)],
+        'alwayson_scripts': {'controlnet': {'args': [{'input_image': data_url(memory_data), 'weight': 1.0}]}},
+        'steps': 20
+    }
+
+
+def test_same_image_used_twice(tmp_path, cache):
+    data = png_bytes()
+    path = tmp_path / 'init.png'
+    path.write_bytes(data)
+    image = payloads.PayloadImage(path=str(path))
+    decoded = json.loads(bytes(payloads.encode_payload({'a': image, 'b': [image, image]})))
+    assert decoded == {'a': data_url(data), 'b': [data_url(data), data_url(data)]}
+
+
+def test_large_images_span_several_reads(tmp_path, cache, monkeypatch):
+    monkeypatch.setattr(payloads, 'READ_SIZE', 3 * 10)
+    data = bytes(range(256)) * 7
+    path = tmp_path / 'big.png'
+    path.write_bytes(data)
+    decoded = json.loads(bytes(payloads.encode_payload({'file': payloads.PayloadImage(path=str(path)), 'memory': payloads.PayloadImage(data=data)})))
+    assert decoded == {'file': data_url(data), 'memory': data_url(data)}
+
+
+def test_payloads_without_images():
+    payload = {'prompt': 'a cat', 'steps': 20, 'styles': [], 'override_settings': {'CLIP_stop_at_last_layers': 2}}
+    body = payloads.encode_payload(payload)
+    assert isinstance(body, bytearray)
+    assert json.loads(bytes(body)) == payload
+
+
+def test_prebuilt_bodies_pass_through():
+    body = b'{"prompt": "a cat"}'
+    assert payloads.encode_payload(body) is body
+
+
+def test_uncached_files_are_streamed(tmp_path, monkeypatch):
+    cache = imagecache.ImageCache()
+    monkeypatch.setattr(imagecache, 'cache', cache)
+    data = png_bytes()
+    path = tmp_path / 'once.png'
+    path.write_bytes(data)
+    decoded = json.loads(bytes(payloads.encode_payload({'image': payloads.PayloadImage(str(path), cache=False)})))
+    assert decoded == {'image': data_url(data)}
+    assert len(cache.entries) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
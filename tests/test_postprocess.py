@@ -0,0 +1,116 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# image finalization (scripts/postprocess.py)
+
+import io
+import os
+import time
+import threading
+import concurrent.futures
+from PIL import Image
+import scripts.postprocess as postprocess
+
+
+def png_bytes(color = (255, 0, 0)):
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def make_task(dest_dir, name, prompt, samples_dir = ''):
+    return {
+        'files': [{'src': name + '.png', 'image': png_bytes(), 'name': name, 'meta_prompt': prompt, 'description': 'test'}],
+        'samples_dir': samples_dir,
+        'dest_dir': dest_dir,
+        'quality': 90,
+        'exif_source': '',
+        'iptc_append': False,
+        'iptc': {'title': '', 'description': '', 'keywords': [], 'copyright': ''}
+    }
+
+
+def test_finalize_writes_jpegs_without_overwriting(tmp_path):
+    dest = str(tmp_path / 'out')
+    staging = tmp_path / 'staging'
+    staging.mkdir()
+    outputs = []
+    for i in range(3):
+        files, messages = postprocess.finalize(make_task(dest, 'image', 'prompt ' + str(i), str(staging)))
+        assert messages == []
+        outputs += files
+    assert [os.path.basename(f) for f in outputs] == ['image.jpg', 'image-0.jpg', 'image-1.jpg']
+    for i, f in enumerate(outputs):
+        with Image.open(f) as image:
+            assert image.format == 'JPEG'
+            assert image.getexif()[0x9286] == 'prompt ' + str(i)
+    # the staging dir is removed once it's been finalized
+    assert not staging.exists()
+
+
+def test_finalize_reports_unreadable_images(tmp_path):
+    task = make_task(str(tmp_path), 'image', 'prompt')
+    task['files'][0]['image'] = b'not an image'
+    files, messages = postprocess.finalize(task)
+    assert files == []
+    assert len(messages) == 1
+
+
+def test_without_a_pool_tasks_run_right_away(tmp_path):
+    processor = postprocess.PostProcessor(0)
+    processor.submit(make_task(str(tmp_path), 'image', 'prompt'), lambda message: None)
+    assert os.path.exists(str(tmp_path / 'image.jpg'))
+    processor.shutdown()
+
+
+def test_tasks_for_a_directory_run_in_order(monkeypatch):
+    # stand-in pool and finalize(): earlier tasks take longer, so they'd finish last if tasks for
+    # the same directory were allowed to run at the same time
+    log = []
+    lock = threading.Lock()
+    def finalize(task):
+        with lock:
+            log.append(('start', task['dest_dir'], task['order']))
+        time.sleep(task['delay'])
+        with lock:
+            log.append(('end', task['dest_dir'], task['order']))
+        return [], []
+    monkeypatch.setattr(postprocess, 'finalize', finalize)
+
+    processor = postprocess.PostProcessor(0)
+    processor.pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    processor.slots = threading.BoundedSemaphore(16)
+    for order in range(4):
+        for dest in ['a', 'b']:
+            processor.submit({'dest_dir': dest, 'order': order, 'delay': 0.02 * (4 - order)}, lambda message: None)
+    processor.drain()
+    processor.shutdown()
+
+    for dest in ['a', 'b']:
+        events = [(event, order) for event, d, order in log if d == dest]
+        # one at a time, in the order they were submitted
+        assert events == [(event, order) for order in range(4) for event in ['start', 'end']]
+    # the two directories were worked on side by side
+    assert log[0][0] == 'start' and log[1][0] == 'start'
+    assert processor.outstanding == 0
+    assert processor.waiting == {}
+
+
+def test_errors_are_reported_and_dont_block_the_directory(monkeypatch):
+    def finalize(task):
+        if task['fail']:
+            raise OSError('disk full')
+        return [], ['finished ' + str(task['order'])]
+    monkeypatch.setattr(postprocess, 'finalize', finalize)
+
+    messages = []
+    processor = postprocess.PostProcessor(0)
+    processor.pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    processor.slots = threading.BoundedSemaphore(8)
+    processor.submit({'dest_dir': 'a', 'order': 0, 'fail': True}, messages.append)
+    processor.submit({'dest_dir': 'a', 'order': 1, 'fail': False}, messages.append)
+    processor.drain()
+    processor.shutdown()
+    assert len(messages) == 2
+    assert 'disk full' in messages[0]
+    assert messages[1] == 'finished 1'
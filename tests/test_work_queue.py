@@ -0,0 +1,207 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+# the lazy work queue (scripts/utils.py): WorkQueue, Job/ConfigSnapshot, and how PromptManager
+# generates and counts the combinations of a prompt file
+
+import os
+import pytest
+from PIL import Image
+import scripts.utils as utils
+
+MODELS = ['modelA.safetensors [aaaa]', 'modelB.safetensors [bbbb]', 'modelC.safetensors [cccc]']
+
+
+# just enough of the Controller for a PromptManager
+class FakeControl:
+    def __init__(self, prompt_file):
+        self.prompt_file = prompt_file
+        self.config = {'width': 512, 'height': 512, 'steps': 20, 'scale': 7.5, 'samples': 1, 'ckpt_file': '',
+            'sampler': 'Euler', 'neg_prompt': '', 'highres_fix': 'no', 'auto_insert_model_trigger': 'start',
+            'use_upscale': 'no', 'upscale_amount': 2.0, 'upscale_codeformer_amount': 0.0, 'upscale_gfpgan_amount': 0.0,
+            'upscale_sd_strength': 0.3, 'upscale_keep_org': 'no', 'upscale_model': 'esrgan', 'filename': '<date>-<time>',
+            'output_location': 'output'}
+        self.sdi_models = [{'name': name} for name in MODELS]
+        self.models = []
+        self.model_index = 0
+        self.highres_models = []
+        self.highres_model_index = 0
+        self.repeat_jobs = False
+        self.messages = []
+
+    def print(self, text):
+        self.messages.append(text)
+
+    def validate_model(self, model):
+        if len(model) > 5:
+            for m in self.sdi_models:
+                if model.lower() in m['name'].lower():
+                    return m['name']
+        return ''
+
+
+def prompt_manager(tmp_path, text):
+    path = tmp_path / 't.prompts'
+    path.write_text(text, encoding='utf-8')
+    manager = utils.PromptManager(FakeControl(str(path)))
+    manager.handle_config()
+    return manager
+
+
+PROMPTS = """
+[config]
+!MODE = standard
+[prompts]
+a cat
+a dog
+!WIDTH = 768
+a bird
+[prompts]
+red
+blue
+"""
+
+
+def test_work_queue_order_and_length():
+    queue = utils.WorkQueue([1, 2])
+    queue.add_source(iter([3, 4, 5]), 3)
+    queue.append(6)
+    assert len(queue) == 6
+    assert queue.peek(4) == [1, 2, 3, 4]
+    assert len(queue) == 6
+    queue.appendleft(0)
+    assert [queue.popleft() for i in range(7)] == [0, 1, 2, 3, 4, 5, 6]
+    assert len(queue) == 0
+
+
+def test_work_queue_generates_lazily():
+    produced = []
+    def source():
+        for i in range(100):
+            produced.append(i)
+            yield i
+    queue = utils.WorkQueue()
+    queue.add_source(source(), 100)
+    assert len(queue) == 100
+    assert queue[2] == 2
+    del queue[0]
+    assert queue.popleft() == 1
+    assert len(produced) < 10
+    queue.clear()
+    assert len(queue) == 0
+
+
+def test_work_queue_estimate_is_dropped_once_generated():
+    # a source that produces fewer items than it said it would
+    queue = utils.WorkQueue()
+    queue.add_source(iter([1, 2]), 5)
+    assert list(queue) == [1, 2]
+    assert len(queue) == 2
+
+
+def test_job_reads_through_to_snapshot():
+    snapshot = utils.ConfigSnapshot({'width': 512, 'iptc_keywords': ['a']})
+    job = utils.Job(snapshot, {'prompt': 'a cat'})
+    assert job['width'] == 512
+    assert job.get('prompt') == 'a cat'
+    assert job.get('missing', 'default') == 'default'
+    assert set(job.keys()) == {'width', 'iptc_keywords', 'prompt'}
+    job['width'] = 768
+    assert job['width'] == 768
+    assert snapshot.values['width'] == 512
+
+
+def test_job_lists_never_leak_into_snapshot_or_copies():
+    snapshot = utils.ConfigSnapshot({'iptc_keywords': ['a']})
+    job = utils.Job(snapshot)
+    job['iptc_keywords'].append('b')
+    assert job['iptc_keywords'] == ['a', 'b']
+    assert snapshot.values['iptc_keywords'] == ['a']
+
+    other = job.copy()
+    other['iptc_keywords'].append('c')
+    other['prompt'] = 'a dog'
+    assert job['iptc_keywords'] == ['a', 'b']
+    assert 'prompt' not in job
+    assert utils.Job(snapshot)['iptc_keywords'] == ['a']
+
+
+def test_queue_length_matches_count(tmp_path):
+    manager = prompt_manager(tmp_path, PROMPTS)
+    queue = manager.build_combinations()
+    assert manager.count_combinations() == 6
+    assert len(queue) == 6
+    jobs = list(queue)
+    assert len(jobs) == 6
+    assert [job['prompt'] for job in jobs] == ['a cat red', 'a cat blue', 'a dog red', 'a dog blue', 'a bird red', 'a bird blue']
+
+
+def test_embedded_directives_apply_when_reached(tmp_path):
+    manager = prompt_manager(tmp_path, PROMPTS)
+    queue = manager.build_combinations()
+    first = [queue.popleft() for i in range(4)]
+    assert [job['width'] for job in first] == [512, 512, 512, 512]
+    # the directive hasn't been reached yet
+    assert manager.config['width'] == 512
+    rest = list(queue)
+    assert [job['width'] for job in rest] == ['768', '768']
+    assert manager.config['width'] == '768'
+    # jobs queued before the directive share one snapshot, later ones another
+    assert first[0].snapshot is first[3].snapshot
+    assert rest[0].snapshot is not first[0].snapshot
+
+
+def test_embedded_directives_found(tmp_path):
+    manager = prompt_manager(tmp_path, PROMPTS)
+    assert manager.embedded_directives() == {'width'}
+
+
+def test_detached_generators_keep_their_own_config(tmp_path):
+    manager = prompt_manager(tmp_path, """
+[config]
+!CKPT_FILE = modelA, modelB
+[prompts]
+a cat
+!CKPT_FILE = modelC
+!WIDTH = 640
+a dog
+""")
+    assert manager.control.models == MODELS[:2]
+    saved = dict(manager.config)
+    config = dict(manager.config)
+    jobs = list(manager.iter_combinations(config, {'sweep_model': 'lane'}))
+    assert [job['prompt'] for job in jobs] == ['a cat', 'a dog']
+    assert [job['ckpt_file'] for job in jobs] == [MODELS[0], MODELS[2]]
+    assert [job['width'] for job in jobs] == [512, '640']
+    assert jobs[0]['sweep_model'] == 'lane'
+    # only the generator's config was changed; the manager's and the controller's model list weren't
+    assert config['ckpt_file'] == MODELS[2]
+    assert manager.config == saved
+    assert manager.control.models == MODELS[:2]
+    assert manager.count_combinations(config) == 2
+
+
+def test_input_directories_are_expanded(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    for name in ['1.png', '2.png', '3.jpg']:
+        Image.new('RGB', (8, 8)).save(str(images / name))
+    (images / 'notes.txt').write_text('not an image')
+    manager = prompt_manager(tmp_path, PROMPTS)
+    manager.config['input_image'] = str(images)
+    assert manager.count_combinations() == 18
+    jobs = list(manager.build_combinations())
+    assert len(jobs) == 18
+    assert sorted(os.path.basename(job['input_image']) for job in jobs[:3]) == ['1.png', '2.png', '3.jpg']
+
+
+def test_empty_input_directory_is_ignored(tmp_path):
+    empty = tmp_path / 'empty'
+    empty.mkdir()
+    manager = prompt_manager(tmp_path, PROMPTS)
+    manager.config['input_image'] = str(empty)
+    assert manager.count_combinations() == 6
+    jobs = list(manager.build_combinations())
+    assert len(jobs) == 6
+    assert jobs[0]['input_image'] == ''
+    assert any('empty directory' in message for message in manager.control.messages)